@@ -145,6 +145,8 @@ USER_LOCK_FILE = u"lockfile"
 USER_ERROR_LOG = u"error-log.txt"
 USER_EXTENSIONS_DIR = u"extensions"
 USER_EXTENSIONS_DATA_DIR = u"extensions_data"
+USER_HTTP_CACHE_FILE = u"http_cache.sqlite"
+USER_HTTP_JOURNAL_DIR = u"http_journal"
 PORTABLE_FILE = u"portable.txt"
 
 
@@ -356,6 +358,20 @@ def get_user_extensions_data_dir(pref_dir=None, home=None):
     return os.path.join(pref_dir, USER_EXTENSIONS_DATA_DIR)
 
 
+def get_user_http_cache_file(pref_dir=None, home=None):
+    """Returns the cache file of remote notebook connections"""
+    if pref_dir is None:
+        pref_dir = get_user_pref_dir(home)
+    return os.path.join(pref_dir, USER_HTTP_CACHE_FILE)
+
+
+def get_user_http_journal_dir(pref_dir=None, home=None):
+    """Returns the directory of journals of offline remote notebook writes"""
+    if pref_dir is None:
+        pref_dir = get_user_pref_dir(home)
+    return os.path.join(pref_dir, USER_HTTP_JOURNAL_DIR)
+
+
 def get_system_extensions_dir():
     """Returns system-wide extensions directory"""
     return os.path.join(BASEDIR, u"extensions")
@@ -734,8 +750,7 @@ class KeepNote (object):
         self._conns = keepnote.notebook.connection.NoteBookConnections()
         self._conns.add(
             "file", keepnote.notebook.connection.fs.NoteBookConnectionFS)
-        self._conns.add(
-            "http", keepnote.notebook.connection.http.NoteBookConnectionHttp)
+        self._conns.add("http", self._new_http_connection)
 
         # external apps
         self._external_apps = []
@@ -847,6 +862,13 @@ class KeepNote (object):
     def get_pref_dir(self):
         return self.pref.get_pref_dir()
 
+    def _new_http_connection(self):
+        """Returns a new connection for notebooks served over HTTP"""
+        pref_dir = self.get_pref_dir()
+        return keepnote.notebook.connection.http.NoteBookConnectionHttp(
+            cache_file=get_user_http_cache_file(pref_dir),
+            journal_dir=get_user_http_journal_dir(pref_dir))
+
     #==================================
     # Notebooks
 
@@ -37,6 +37,7 @@ import keepnote.extension
 import keepnote.gui.extension
 from keepnote.notebook.connection.fs import NoteBookConnectionFS
 from keepnote.server import NoteBookHttpServer
+from keepnote.server import WORKERS
 
 
 class Extension (keepnote.gui.extension.Extension):
@@ -54,8 +55,16 @@ class Extension (keepnote.gui.extension.Extension):
             # window commands
             AppCommand("start-http",
                        self.start_http,
-                       metavar="PORT NOTEBOOK",
-                       help="start HTTP server on PORT with NOTEBOOK"),
+                       metavar="[--metrics] PORT NOTEBOOK [WORKERS]",
+                       help="start HTTP server on PORT with NOTEBOOK "
+                       "using WORKERS threads (default: %d).  With "
+                       "--metrics, statistics are served at /metrics"
+                       % WORKERS),
+            AppCommand("start-http-notebooks",
+                       self.start_http_notebooks,
+                       metavar="[--metrics] PORT DIR [WORKERS]",
+                       help="start HTTP server on PORT with the notebooks "
+                       "in DIR at /notebooks/NAME/"),
             AppCommand("stop-http",
                        self.stop_http,
                        metavar="PORT",
@@ -83,23 +92,47 @@ class Extension (keepnote.gui.extension.Extension):
             for command in self.commands:
                 self.app.remove_command(command.name)
 
-
     #====================================================
     # commands
 
+    def _parse_args(self, args):
+        """Returns the args of a command without flags, and its metrics flag"""
+        metrics = "--metrics" in args
+        return [arg for arg in args if arg != "--metrics"], metrics
+
     def start_http(self, app, args):
 
+        args, metrics = self._parse_args(args)
         port = int(args[1])
         notebook_path = unicode(args[2])
+        workers = int(args[3]) if len(args) > 3 else WORKERS
 
         # connect to notebook on disk
         conn = NoteBookConnectionFS()
         conn.connect(notebook_path)
 
         # start server in another thread
-        host = "localhost"
+        server = NoteBookHttpServer(conn, host="localhost", port=port,
+                                    workers=workers, metrics=metrics)
+        self._start_server(server)
+
+    def start_http_notebooks(self, app, args):
+
+        args, metrics = self._parse_args(args)
+        port = int(args[1])
+        notebook_dir = unicode(args[2])
+        workers = int(args[3]) if len(args) > 3 else WORKERS
+
+        server = NoteBookHttpServer(None, host="localhost", port=port,
+                                    workers=workers, metrics=metrics,
+                                    notebook_dir=notebook_dir)
+        self._start_server(server)
+
+    def _start_server(self, server):
+
+        host = server.host
+        port = server.port
         url = "http://%s:%d/" % (host, port)
-        server = NoteBookHttpServer(conn, host="localhost", port=port)
 
         if port in self._ports:
             raise Exception("Server already on port %d" % port)
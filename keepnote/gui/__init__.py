@@ -44,6 +44,7 @@ from keepnote import get_resource, unicode_gtk
 from keepnote import tasklib
 from keepnote.notebook import NoteBookError
 import keepnote.notebook as notebooklib
+from keepnote.notebook.connection.fs import BaseNoteBookConnectionFS
 import keepnote.gui.dialog_app_options
 import keepnote.gui.dialog_node_icon
 import keepnote.gui.dialog_wait
@@ -61,6 +62,7 @@ IMAGE_DIR = u"images"
 CONTEXT_MENU_ACCEL_PATH = "<main>/context_menu"
 
 DEFAULT_AUTOSAVE_TIME = 10 * 1000  # 10 sec (in msec)
+DEFAULT_INDEX_MAINTENANCE_TIME = 30 * 60 * 1000  # 30 min (in msec)
 
 # font constants
 DEFAULT_FONT_FAMILY = "Sans"
@@ -411,6 +413,10 @@ class KeepNote (keepnote.KeepNote):
         self._auto_save_registered = False  # True if autosave is registered
         self._auto_save_pause = 0           # >0 if autosave is paused
 
+        # index maintenance
+        self._index_maintenance = None      # iterator of maintenance steps
+        self._index_maintenance_registered = False
+
     def init(self):
         """Initialize application from disk"""
         keepnote.KeepNote.init(self)
@@ -441,6 +447,8 @@ class KeepNote (keepnote.KeepNote):
         # set defaults for auto save
         p = self.pref
         p.get("autosave_time", default=DEFAULT_AUTOSAVE_TIME)
+        p.get("index_maintenance_time",
+              default=DEFAULT_INDEX_MAINTENANCE_TIME)
 
         # set style
         set_gtk_style(font_size=p.get("look_and_feel", "app_font_size",
@@ -456,6 +464,7 @@ class KeepNote (keepnote.KeepNote):
 
         # start autosave loop, if requested
         self.begin_auto_save()
+        self.begin_index_maintenance()
 
     def save_preferences(self):
         """Save information into preferences"""
@@ -704,6 +713,61 @@ class KeepNote (keepnote.KeepNote):
         """Pauses autosaving"""
         self._auto_save_pause += 1 if pause else -1
 
+    #=====================================
+    # index maintenance
+
+    def begin_index_maintenance(self):
+        """Begin periodic index maintenance callbacks"""
+        if not self._index_maintenance_registered:
+            self._index_maintenance_registered = True
+            gobject.timeout_add(self.pref.get("index_maintenance_time"),
+                                self.index_maintenance)
+
+    def index_maintenance(self):
+        """Callback for starting index maintenance"""
+
+        # maintenance steps are performed only when the gui is idle
+        if self._index_maintenance is None:
+            self._index_maintenance = self._iter_index_maintenance()
+            gobject.idle_add(self._index_maintenance_step,
+                             priority=gobject.PRIORITY_LOW)
+
+        # NOTE: return True to activate next timeout callback
+        return True
+
+    def _index_maintenance_step(self):
+        """Perform one step of index maintenance"""
+        try:
+            self._index_maintenance.next()
+            return True
+        except StopIteration:
+            self._index_maintenance = None
+            return False
+
+    def _iter_index_maintenance(self):
+        """Iterate through maintenance steps of all open notebooks"""
+        for notebook in list(self.iter_notebooks()):
+            if not isinstance(notebook.get_connection(),
+                              BaseNoteBookConnectionFS):
+                continue
+
+            task = tasklib.Task()
+            try:
+                for step in notebook.index(["maintain", task]):
+                    yield step
+                    # stop if notebook was closed between steps
+                    if notebook not in list(self.iter_notebooks()):
+                        break
+            except Exception, e:
+                log_error(e, sys.exc_info()[2])
+                continue
+
+            stats = task.get_result()
+            if stats:
+                keepnote.log_message(
+                    "index maintenance: %d bytes reclaimed, %d bytes total\n"
+                    % (stats["reclaimed"], stats["size"]))
+
     #===========================================
     # node icons
 
@@ -841,7 +841,10 @@ class KeepNoteWindow (gtk.Window):
             return
 
         def update(task):
-            notebook.index("compact")
+            notebook.index(["compact"])
+            for step in notebook.index(["maintain", task]):
+                if task.aborted():
+                    break
 
         # launch task
         self.wait_dialog(_("Compacting notebook index"), _("Compacting..."),
@@ -1591,7 +1594,8 @@ class SearchBox (gtk.Entry):
 
         self.search_box_list.clear()
         if len(text) > 0:
-            results = self._window.get_notebook().search_node_titles(text)[:10]
+            results = self._window.get_notebook().search_node_titles(
+                text, 10)
             for nodeid, title in results:
                 self.search_box_list.append([title, nodeid])
 
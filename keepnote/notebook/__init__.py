@@ -1002,9 +1002,20 @@ class NoteBookNode (object):
         """Iterate through children
            Returns temporary node objects
         """
-        for childid in self._attr["childrenids"]:
+        childids = self._attr["childrenids"]
+        try:
+            attrs = self._conn.read_nodes(childids)
+        except:
+            keepnote.log_error()
+            attrs = [None] * len(childids)
+
+        for childid, attr in zip(childids, attrs):
             try:
-                yield self._notebook._read_node(childid, parent=self)
+                if attr is None:
+                    # read again on its own to report the error
+                    yield self._notebook._read_node(childid, parent=self)
+                else:
+                    yield self._notebook._new_node(attr, parent=self)
             except:
                 keepnote.log_error()
                 continue
@@ -1329,6 +1340,9 @@ class NoteBook (NoteBookNode):
         self._attr.update(attr)
         self._init_attr()
 
+        # catch up with changes made while the notebook was closed
+        self._conn.check_changes()
+
         self._init_trash()
 
         self._read_attr_defs()
@@ -1382,6 +1396,7 @@ class NoteBook (NoteBookNode):
         # catches all the desired attr's
         self._conn.index_attr("icon", "TEXT")
         self._conn.index_attr("title", "TEXT", index_value=True)
+        self._conn.index_attr("modified_time", "INTEGER", index_value=True)
 
     #--------------------------------------
     # input/output
@@ -1437,7 +1452,12 @@ class NoteBook (NoteBookNode):
 
     def _read_node(self, nodeid, parent=None,
                    default_content_type=CONTENT_TYPE_DIR):
-        attr = self._conn.read_node(nodeid)
+        return self._new_node(self._conn.read_node(nodeid), parent,
+                              default_content_type)
+
+    def _new_node(self, attr, parent=None,
+                  default_content_type=CONTENT_TYPE_DIR):
+        """Make a node object for a node attr read from the connection"""
         node = NoteBookNode(
             attr.get("title", DEFAULT_PAGE_NAME),
             parent=parent, notebook=self,
@@ -1611,9 +1631,9 @@ class NoteBook (NoteBookNode):
         """Lookup node path by nodeid"""
         return self._conn.get_node_path_by_id(nodeid)
 
-    def search_node_titles(self, text):
-        """Search nodes by title"""
-        return self._conn.search_node_titles(text)
+    def search_node_titles(self, text, limit=None):
+        """Search nodes by title, returning at most 'limit' results"""
+        return self._conn.search_node_titles(text, limit)
 
     def search_node_contents(self, text):
         """Search nodes by content"""
@@ -25,8 +25,16 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA.
 #
 
+import hashlib
+import tempfile
 import urlparse
 
+from keepnote.notebook.connection.delta import apply_delta
+from keepnote.notebook.connection.delta import DELTA_BLOCK_SIZE
+from keepnote.notebook.connection.delta import DeltaError
+from keepnote.notebook.connection.delta import get_signature
+from keepnote.notebook.connection.delta import read_delta_header
+
 
 #=============================================================================
 # errors
@@ -64,11 +72,25 @@ class UnknownFile (FileError):
         FileError.__init__(self, msg)
 
 
+class DeltaBasisError (FileError):
+    def __init__(self, msg="file has changed since its signature"):
+        FileError.__init__(self, msg)
+
+
 class CorruptIndex (ConnectionError):
     def __init__(self, msg="index error", error=None):
         ConnectionError.__init__(self, msg, error)
 
 
+# node operations that can be performed with NoteBookConnection.batch()
+BATCH_OPERATIONS = set([
+    "read_node", "update_node", "has_node", "list_dir", "has_file"])
+
+# errors that can be returned for individual batch operations
+BATCH_ERRORS = dict((cls.__name__, cls) for cls in (
+    ConnectionError, UnknownNode, NodeExists, FileError, UnknownFile))
+
+
 #=============================================================================
 # file path functions
 
@@ -113,6 +135,32 @@ def is_dir(filename):
     return filename.endswith('/')
 
 
+def hash_stream(stream):
+    """Returns the SHA-1 hex digest of the rest of a file stream"""
+    digest = hashlib.sha1()
+    while True:
+        data = stream.read(1024*4)
+        if len(data) == 0:
+            break
+        digest.update(data)
+    return digest.hexdigest()
+
+
+def discard_stream(stream):
+    """Close a written file stream, discarding its data when possible"""
+    if hasattr(stream, "discard"):
+        stream.discard()
+    else:
+        stream.close()
+
+
+def limit_results(results, limit=None, offset=0):
+    """Returns at most 'limit' of a list of results, after 'offset'"""
+    if limit is None:
+        return results[offset:]
+    return results[offset:offset + limit]
+
+
 #=============================================================================
 
 class NoteBookConnection (object):
@@ -134,6 +182,10 @@ class NoteBookConnection (object):
         """Save any unsynced state"""
         pass
 
+    def is_thread_safe(self):
+        """Returns True if several threads may use the connection at once"""
+        return False
+
     #======================
     # Node I/O API
 
@@ -166,6 +218,38 @@ class NoteBookConnection (object):
         """Returns nodeid of notebook root node"""
         raise NotImplementedError("get_rootid")
 
+    def batch(self, ops):
+        """
+        Perform several node operations
+
+        'ops' is a list of operations [name, arg1, arg2, ...] where name is
+        one of BATCH_OPERATIONS.  Returns a list with the result of each
+        operation, or the ConnectionError it raised.
+        """
+        results = []
+        for op in ops:
+            if op[0] not in BATCH_OPERATIONS:
+                raise ConnectionError("unknown batch operation '%s'" % op[0])
+            try:
+                result = getattr(self, op[0])(*op[1:])
+                if op[0] == "list_dir":
+                    result = list(result)
+                results.append(result)
+            except ConnectionError, e:
+                results.append(e)
+        return results
+
+    def read_nodes(self, nodeids):
+        """
+        Read the attr of several nodes
+
+        Returns a list of attrs in the order of 'nodeids'.  Nodes that
+        could not be read are given as None.
+        """
+        return [None if isinstance(attr, Exception) else attr
+                for attr in self.batch([("read_node", nodeid)
+                                        for nodeid in nodeids])]
+
     #===============
     # file API
 
@@ -197,6 +281,78 @@ class NoteBookConnection (object):
     def has_file(self, nodeid, filename):
         raise NotImplementedError("has_file")
 
+    def get_file_hash(self, nodeid, filename):
+        """Returns the SHA-1 hex digest of a node file's contents"""
+        stream = self.open_file(nodeid, filename)
+        try:
+            return hash_stream(stream)
+        finally:
+            stream.close()
+
+    def get_file_signature(self, nodeid, filename,
+                           block_size=DELTA_BLOCK_SIZE):
+        """
+        Returns the block signature of a node file
+
+        The signature is used to make a delta for patch_file().
+        """
+        stream = self.open_file(nodeid, filename)
+        try:
+            return get_signature(stream, block_size)
+        finally:
+            stream.close()
+
+    def patch_file(self, nodeid, filename, delta):
+        """
+        Write a node file from a delta of its current contents
+
+        'delta' is a file stream of a delta made against the file's
+        signature (see get_file_signature()).  Raises DeltaBasisError if
+        the file has changed since the signature was made.
+        """
+        header = self._read_delta_header(delta)
+
+        # the file is rewritten while it is read, so copy it first
+        basis = tempfile.TemporaryFile()
+        try:
+            digest = hashlib.sha1()
+            stream = self.open_file(nodeid, filename)
+            try:
+                while True:
+                    data = stream.read(1024*64)
+                    if len(data) == 0:
+                        break
+                    digest.update(data)
+                    basis.write(data)
+            finally:
+                stream.close()
+
+            if digest.hexdigest() != header["basis_hash"]:
+                raise DeltaBasisError()
+            self._apply_delta(nodeid, filename, basis, delta, header)
+        finally:
+            basis.close()
+
+    def _read_delta_header(self, delta):
+        try:
+            return read_delta_header(delta)
+        except DeltaError, e:
+            raise FileError("bad delta: %s" % e, e)
+
+    def _apply_delta(self, nodeid, filename, basis, delta, header):
+        """Write a node file from a delta and its basis"""
+        stream = self.open_file(nodeid, filename, "w")
+        try:
+            apply_delta(basis, delta, stream, header["block_size"])
+        except DeltaError, e:
+            discard_stream(stream)
+            raise FileError("cannot patch file '%s' '%s': %s" %
+                            (nodeid, filename, e), e)
+        except:
+            discard_stream(stream)
+            raise
+        stream.close()
+
     def move_file(self, nodeid1, filename1, nodeid2, filename2):
         """
         Move or rename a node file
@@ -261,11 +417,15 @@ class NoteBookConnection (object):
 
         # built-in queries
         # ["index_attr", key, (index_value)]
-        # ["search", "title", text]
+        # ["search", "title", text, (limit, (offset))]
         # ["search_fulltext", text]
         # ["has_fulltext"]
         # ["node_path", nodeid]
         # ["get_attr", nodeid, key]
+        # ["modified_since", mtime]
+        # ["deleted_since", mtime]
+        # ["file_hash", nodeid, filename]
+        # ["file_signature", nodeid, filename, (block_size)]
 
         if query[0] == "index_attr":
             index_value = query[3] if len(query) == 4 else False
@@ -273,7 +433,7 @@ class NoteBookConnection (object):
 
         elif query[0] == "search":
             assert query[1] == "title"
-            return self.search_node_titles(query[2])
+            return self.search_node_titles(*query[2:])
 
         elif query[0] == "search_fulltext":
             return self.search_node_contents(query[1])
@@ -287,6 +447,20 @@ class NoteBookConnection (object):
         elif query[0] == "get_attr":
             return self.get_attr_by_id(query[1], query[2])
 
+        elif query[0] == "modified_since":
+            return self.search_node_modified(query[1])
+
+        elif query[0] == "deleted_since":
+            return self.search_node_deleted(query[1])
+
+        elif query[0] == "file_hash":
+            return self.get_file_hash(query[1], query[2])
+
+        elif query[0] == "file_signature":
+            if len(query) == 4:
+                return self.get_file_signature(query[1], query[2], query[3])
+            return self.get_file_signature(query[1], query[2])
+
         # FS-specific
         elif query[0] == "init":
             return self.init_index()
@@ -308,14 +482,40 @@ class NoteBookConnection (object):
         """Add indexing for an attribute"""
         return self.index(["index_attr", key, datatype, index_value])
 
-    def search_node_titles(self, text):
-        """Search nodes by title"""
-        return self.index(["search", "title", text])
+    def search_node_titles(self, text, limit=None, offset=0):
+        """
+        Search nodes by title
+
+        Returns (nodeid, title) of at most 'limit' ranked results, after
+        skipping the first 'offset'.
+        """
+        if limit is None and not offset:
+            return self.index(["search", "title", text])
+        return self.index(["search", "title", text, limit, offset])
 
     def search_node_contents(self, text):
         """Search nodes by content"""
         return self.index(["search_fulltext", text])
 
+    def search_node_modified(self, mtime):
+        """
+        Search nodes by modified_time
+
+        Returns (nodeid, modified_time) of the nodes modified at or after
+        'mtime', or None if the index cannot answer the query.
+        """
+        return self.index(["modified_since", mtime])
+
+    def search_node_deleted(self, mtime):
+        """
+        Search nodes deleted at or after 'mtime'
+
+        Returns (nodeid, deleted_time) of the nodes deleted at or after
+        'mtime', or every recorded deletion if 'mtime' is None.  Returns
+        None if the index cannot answer the query.
+        """
+        return self.index(["deleted_since", mtime])
+
     def get_node_path_by_id(self, nodeid):
         """Lookup node path by nodeid"""
         return self.index(["node_path", nodeid])
@@ -334,6 +534,15 @@ class NoteBookConnection (object):
     def index_needed(self):
         return self.index(["index_needed"])
 
+    def check_changes(self):
+        """
+        Look for changes made to the notebook outside of this connection
+
+        Changed nodes are reindexed in the background.  By default there
+        is nothing to check.
+        """
+        pass
+
     def clear_index(self):
         return self.index(["clear_index"])
 
@@ -0,0 +1,335 @@
+"""
+
+    KeepNote
+
+    Block-level deltas of node files
+
+"""
+
+#
+#  KeepNote
+#  Copyright (c) 2008-2011 Matt Rasmussen
+#  Author: Matt Rasmussen <rasmus@alum.mit.edu>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+
+# A delta turns an old copy of a file (the basis) into a new one, in the
+# manner of rsync.  The holder of the basis sends its signature, a weak
+# rolling checksum and a strong hash of each block.  The holder of the new
+# file then finds the blocks it shares with the basis and sends only
+# references to them plus the data in between.
+#
+# Delta format:
+#
+#   DELTA_MAGIC
+#   JSON header line: {"block_size": int, "basis_hash": sha1}
+#   ops:  "C" index count   copy 'count' blocks of the basis from 'index'
+#         "D" length data   literal data
+#         "E" sha1          end, with the SHA-1 hex digest of the new file
+
+# python imports
+from collections import defaultdict
+import hashlib
+import json
+import struct
+import zlib
+
+
+DELTA_MAGIC = "KNDELTA1\n"
+DELTA_BLOCK_SIZE = 32 * 1024     # bytes per signature block
+DELTA_CHUNK_SIZE = 1024 * 1024   # bytes read at once, and largest data op
+
+ADLER_MOD = 65521
+
+_COPY = struct.Struct(">II")
+_DATA = struct.Struct(">I")
+
+
+class DeltaError (Exception):
+    pass
+
+
+class DeltaTooLarge (DeltaError):
+    """A delta would need more literal data than allowed"""
+    pass
+
+
+def read_full(stream, size):
+    """Read 'size' bytes from a stream, or less at the end of the stream"""
+    parts = []
+    while size > 0:
+        data = stream.read(size)
+        if not data:
+            break
+        parts.append(data)
+        size -= len(data)
+    return "".join(parts)
+
+
+def get_signature(stream, block_size=DELTA_BLOCK_SIZE):
+    """
+    Returns the signature of a file stream
+
+    The signature is a dict with the 'block_size', the 'size' and SHA-1
+    'hash' of the file, and 'blocks', the list of [weak, strong] checksums
+    of each block.  weak is the Adler-32 of the block and strong its MD5
+    hex digest.
+    """
+    blocks = []
+    digest = hashlib.sha1()
+    size = 0
+    while True:
+        data = read_full(stream, block_size)
+        if not data:
+            break
+        digest.update(data)
+        size += len(data)
+        blocks.append([zlib.adler32(data) & 0xffffffff,
+                       hashlib.md5(data).hexdigest()])
+
+    return {"block_size": block_size,
+            "size": size,
+            "hash": digest.hexdigest(),
+            "blocks": blocks}
+
+
+def iter_delta(signature, stream, chunk_size=DELTA_CHUNK_SIZE,
+               max_literal=None):
+    """
+    Iterate the ops that turn the basis of 'signature' into 'stream'
+
+    Ops are ("copy", index) for a block of the basis and ("data", data)
+    for anything else.  Data ops are at most 'chunk_size' bytes.
+
+    Raises DeltaTooLarge as soon as more than 'max_literal' bytes of
+    'stream' are found not to match the basis.
+    """
+    size = signature["block_size"]
+    blocks = signature["blocks"]
+    literal = 0     # bytes of data ops so far
+
+    # full blocks by weak checksum
+    table = defaultdict(list)
+    for i, (weak, strong) in enumerate(blocks):
+        if i < len(blocks) - 1 or signature["size"] % size == 0:
+            table[weak].append(i)
+
+    def find_block(weak, pos):
+        indexes = table.get(weak)
+        if indexes:
+            strong = hashlib.md5(str(buf[pos:pos+size])).hexdigest()
+            for i in indexes:
+                if blocks[i][1] == strong:
+                    return i
+        return None
+
+    buf = bytearray()
+    start = 0       # start of unmatched data in buf
+    pos = 0         # start of window in buf
+    eof = False
+    a = b = None    # Adler-32 parts of the window
+    while True:
+        # read the window and the byte after it
+        while not eof and len(buf) < pos + size + 1:
+            data = stream.read(chunk_size)
+            if data:
+                buf.extend(data)
+            else:
+                eof = True
+        if len(buf) - pos < size:
+            break
+
+        if a is None:
+            weak = zlib.adler32(str(buf[pos:pos+size])) & 0xffffffff
+            a, b = weak & 0xffff, weak >> 16
+
+        index = find_block((b << 16) | a, pos)
+        if index is not None:
+            if pos > start:
+                literal += pos - start
+                yield ("data", str(buf[start:pos]))
+            yield ("copy", index)
+            pos += size
+            start = pos
+            a = b = None
+        elif max_literal is not None and literal + pos - start > max_literal:
+            raise DeltaTooLarge("more than %d bytes of literal data" %
+                                max_literal)
+        elif pos - start >= chunk_size:
+            literal += pos - start
+            yield ("data", str(buf[start:pos]))
+            start = pos
+
+        if start > chunk_size:
+            # drop data that is done with
+            del buf[:start]
+            pos -= start
+            start = 0
+
+        if a is not None:
+            if len(buf) < pos + size + 1:
+                # end of stream
+                break
+            # roll the window by one byte
+            out = buf[pos]
+            a = (a - out + buf[pos + size]) % ADLER_MOD
+            b = (b - size * out + a - 1) % ADLER_MOD
+            pos += 1
+
+    # the last block of the basis may be short
+    tail = str(buf[pos:])
+    if (tail and len(tail) == signature["size"] % size and
+            hashlib.md5(tail).hexdigest() == blocks[-1][1]):
+        if pos > start:
+            yield ("data", str(buf[start:pos]))
+        yield ("copy", len(blocks) - 1)
+    elif len(buf) > start:
+        yield ("data", str(buf[start:]))
+
+
+def write_delta(out, signature, stream, max_literal=None):
+    """
+    Write the delta from the basis of 'signature' to 'stream' into 'out'
+
+    Returns the number of bytes of literal data in the delta.  Raises
+    DeltaTooLarge if there would be more than 'max_literal' of them.
+    """
+    digest = hashlib.sha1()
+    literal = 0
+
+    def write_copy(index, count):
+        out.write("C" + _COPY.pack(index, count))
+
+    out.write(DELTA_MAGIC)
+    out.write(json.dumps({"block_size": signature["block_size"],
+                          "basis_hash": signature["hash"]}) + "\n")
+
+    # consecutive blocks are copied with one op
+    run = None
+    for op in iter_delta(signature, HashStream(stream, digest),
+                         max_literal=max_literal):
+        if op[0] == "copy":
+            if run and run[0] + run[1] == op[1]:
+                run[1] += 1
+                continue
+            if run:
+                write_copy(*run)
+            run = [op[1], 1]
+        else:
+            if run:
+                write_copy(*run)
+                run = None
+            out.write("D" + _DATA.pack(len(op[1])) + op[1])
+            literal += len(op[1])
+    if run:
+        write_copy(*run)
+
+    if max_literal is not None and literal > max_literal:
+        raise DeltaTooLarge("more than %d bytes of literal data" %
+                            max_literal)
+
+    out.write("E" + digest.hexdigest())
+    return literal
+
+
+def read_delta_hash(delta):
+    """
+    Returns the SHA-1 hex digest of the new file of a seekable delta
+
+    The position of the delta is kept.
+    """
+    pos = delta.tell()
+    try:
+        delta.seek(-41, 2)
+        end = delta.read(41)
+    finally:
+        delta.seek(pos)
+    if len(end) != 41 or end[0] != "E":
+        raise DeltaError("truncated delta")
+    return end[1:]
+
+
+def read_delta_header(delta):
+    """Read the header of a delta stream"""
+    if read_full(delta, len(DELTA_MAGIC)) != DELTA_MAGIC:
+        raise DeltaError("not a delta")
+    line = []
+    while True:
+        c = delta.read(1)
+        if not c:
+            raise DeltaError("truncated delta header")
+        if c == "\n":
+            break
+        line.append(c)
+    try:
+        return json.loads("".join(line))
+    except ValueError, e:
+        raise DeltaError("bad delta header: %s" % e)
+
+
+def apply_delta(basis, delta, out, block_size):
+    """
+    Write the new file of a delta to 'out'
+
+    'basis' must be seekable and 'delta' positioned after its header.
+    Raises DeltaError if the delta is corrupt or the result does not
+    match the hash in the delta.
+    """
+    digest = hashlib.sha1()
+    while True:
+        op = delta.read(1)
+        if op == "C":
+            index, count = _COPY.unpack(read_full(delta, _COPY.size))
+            basis.seek(index * block_size)
+            remain = count * block_size
+            while remain > 0:
+                data = basis.read(min(remain, DELTA_CHUNK_SIZE))
+                if not data:
+                    break
+                digest.update(data)
+                out.write(data)
+                remain -= len(data)
+            # only the last block of the basis may be short
+            if remain >= block_size:
+                raise DeltaError("block %d is not in the basis" % index)
+
+        elif op == "D":
+            length = _DATA.unpack(read_full(delta, _DATA.size))[0]
+            data = read_full(delta, length)
+            if len(data) != length:
+                raise DeltaError("truncated delta")
+            digest.update(data)
+            out.write(data)
+
+        elif op == "E":
+            if read_full(delta, 40) != digest.hexdigest():
+                raise DeltaError("delta result does not match its hash")
+            return
+
+        else:
+            raise DeltaError("truncated delta")
+
+
+class HashStream (object):
+    """Reads a file stream while hashing what is read"""
+
+    def __init__(self, stream, digest):
+        self._stream = stream
+        self._digest = digest
+
+    def read(self, *args):
+        data = self._stream.read(*args)
+        self._digest.update(data)
+        return data
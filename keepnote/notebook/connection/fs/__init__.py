@@ -96,6 +96,7 @@ from keepnote import safefile, plist, maskdict
 from keepnote import trans
 import keepnote.notebook
 from keepnote.notebook.connection import ConnectionError
+from keepnote.notebook.connection import DeltaBasisError
 from keepnote.notebook.connection import NodeExists
 from keepnote.notebook.connection import NoteBookConnection
 from keepnote.notebook.connection import UnknownNode
@@ -995,27 +996,15 @@ class BaseNoteBookConnectionFS (NoteBookConnection):
         index_mtime = self._index.get_node_mtime(nodeid)
         return mtime <= index_mtime, mtime
 
-    def _reindex_node(self, nodeid, parentid, path, attr, mtime, warn=True):
-        """Reindex a node that has been tampered"""
-        if warn:
-            keepnote.log_message(
-                u"Unmanaged change detected. Reindexing '%s'\n" % path)
-
-        # TODO: to prevent a full recurse I could index children but
-        # use 0 for mtime, so that they will still trigger an index for them
-        # selves
-        # reindex all children in case their parentid's changed
-        #for path2 in iter_child_node_paths(path):
-        #    attr2 = self._read_node(nodeid, path2, _full=False,
-        #                            _force_index=True)
-            #self._index.add_node(
-            #    attr2["nodeid"], nodeid,
-            #    os.path.basename(path2), attr2,
-            #    get_path_mtime(path2))
-
-        # reindex this node
-        self._index.add_node(
-            nodeid, parentid, os.path.basename(path), attr, mtime)
+    def _reindex_node(self, nodeid, parentid, path, attr, mtime):
+        """
+        Reindex a node that has been tampered
+
+        The node is queued and indexed in the background, so that reading
+        a notebook changed by other programs does not stall on the index.
+        """
+        self._index.queue_node(
+            nodeid, parentid, os.path.basename(path), attr, mtime, path)
 
     def _get_node_attr_file(self, nodeid, path=None):
         """Returns the meta file for the node"""
@@ -1070,6 +1059,25 @@ class BaseNoteBookConnectionFS (NoteBookConnection):
         """Return True is file exists."""
         return self._filefs.has_file(nodeid, filename, _path=_path)
 
+    def get_file_hash(self, nodeid, filename, _path=None):
+        """Return the SHA-1 hex digest of a node file."""
+        return self._filefs.get_file_hash(nodeid, filename, _path=_path,
+                                          index=self._index)
+
+    def patch_file(self, nodeid, filename, delta, _path=None):
+        """Write a node file from a delta of its current contents."""
+        header = self._read_delta_header(delta)
+        if (self.get_file_hash(nodeid, filename, _path=_path) !=
+                header["basis_hash"]):
+            raise DeltaBasisError()
+
+        # Writes go to a temp file, so the basis can be read in place.
+        basis = self._filefs.open_file(nodeid, filename, _path=_path)
+        try:
+            self._apply_delta(nodeid, filename, basis, delta, header)
+        finally:
+            basis.close()
+
     def move_file(self, nodeid1, filename1, nodeid2, filename2,
                   _path1=None, _path2=None):
         """Rename a node file."""
@@ -1099,6 +1107,11 @@ class BaseNoteBookConnectionFS (NoteBookConnection):
     def index_needed(self):
         return self._index.index_needed()
 
+    def check_changes(self):
+        """Reindex nodes changed on disk in the background."""
+        if self._index and not self._index.index_needed():
+            self._index.check_changes()
+
     def clear_index(self):
         return self._index.clear()
 
@@ -1140,6 +1153,15 @@ class BaseNoteBookConnectionFS (NoteBookConnection):
         elif query[0] == "compact":
             return self._index.compact()
 
+        elif query[0] == "maintain":
+            return self._index.maintain(*query[1:])
+
+        elif query[0] == "index_stats":
+            return self._index.get_stats()
+
+        elif query[0] == "index_changes":
+            return self._index.index_changes()
+
         else:
             return NoteBookConnection.index(self, query)
 
@@ -1159,14 +1181,22 @@ class BaseNoteBookConnectionFS (NoteBookConnection):
         self._index.add_attr(AttrIndex(key, index_type,
                                        index_value=index_value))
 
-    def search_node_titles(self, text):
+    def search_node_titles(self, text, limit=None, offset=0):
         """Search nodes by title"""
-        return self._index.search_titles(text)
+        return self._index.search_titles(text, limit, offset)
 
     def search_node_contents(self, text):
         """Search nodes by content"""
         return self._index.search_contents(text)
 
+    def search_node_modified(self, mtime):
+        """Search nodes by modified_time"""
+        return self._index.search_modified(mtime)
+
+    def search_node_deleted(self, mtime):
+        """Search nodes deleted at or after 'mtime'"""
+        return self._index.search_deleted(mtime)
+
     def has_fulltext_search(self):
         return self._index.has_fulltext_search()
 
@@ -2,7 +2,9 @@ import os
 import shutil
 
 from keepnote import safefile
+from keepnote.cache import LRUDict
 from keepnote.notebook.connection import FileError
+from keepnote.notebook.connection import hash_stream
 from keepnote.notebook.connection import path_join
 from keepnote.notebook.connection import UnknownFile
 from keepnote.notebook.connection.fs.paths import get_node_meta_file
@@ -10,6 +12,10 @@ from keepnote.notebook.connection.fs.paths import path_node2local
 from keepnote.notebook.connection.fs.paths import NODE_META_FILE
 
 
+# number of file hashes kept in memory
+FILE_HASH_CACHE_SIZE = 1000
+
+
 def get_node_filename(node_path, filename):
     """
     Returns a full local path to a node file
@@ -34,6 +40,8 @@ class FileFS(object):
         nodeid2path: a function that returns a filesystem path for a nodeid.
         """
         self._nodeid2path = nodeid2path
+        # local path -> (size, mtime, digest)
+        self._hashes = LRUDict(FILE_HASH_CACHE_SIZE)
 
     def get_node_path(self, nodeid):
         return self._nodeid2path(nodeid)
@@ -131,6 +139,39 @@ class FileFS(object):
         else:
             return os.path.isfile(get_node_filename(path, filename))
 
+    def get_file_hash(self, nodeid, filename, _path=None, index=None):
+        """
+        Return the SHA-1 hex digest of a node file.
+
+        Digests are cached, and stored in 'index' if given, and reused
+        while the file's size and mtime are unchanged.
+        """
+        path = self.get_node_path(nodeid) if _path is None else _path
+        fullname = get_node_filename(path, filename)
+
+        try:
+            stat = os.stat(fullname)
+            key = (stat.st_size, stat.st_mtime)
+            cached = self._hashes.get(fullname)
+            if cached and cached[:2] == key:
+                return cached[2]
+            digest = None
+            if index:
+                digest = index.get_file_hash(nodeid, filename,
+                                             stat.st_size, stat.st_mtime)
+            if digest is None:
+                with open(fullname, "rb") as infile:
+                    digest = hash_stream(infile)
+                if index:
+                    index.set_file_hash(nodeid, filename, stat.st_size,
+                                        stat.st_mtime, digest)
+        except (IOError, OSError):
+            raise UnknownFile("cannot hash file '%s' '%s'" %
+                              (nodeid, filename))
+
+        self._hashes[fullname] = key + (digest,)
+        return digest
+
     def move_file(self, nodeid1, filename1, nodeid2, filename2,
                   _path1=None, _path2=None):
         """Rename a node file."""
@@ -26,9 +26,13 @@
 
 
 # python imports
+import atexit
+from collections import deque
 import os
 import sys
+import threading
 import time
+import weakref
 
 # import sqlite
 try:
@@ -43,11 +47,31 @@ except Exception, e:
 import keepnote
 import keepnote.notebook
 from keepnote.notebook.connection.index import NodeIndex
+from keepnote.notebook.connection.index import key_to_nodeid
+from keepnote.notebook.connection.index import nodeid_to_key
 
 
 # index filename
 INDEX_FILE = u"index.sqlite"
-INDEX_VERSION = 3
+INDEX_VERSION = 5
+
+# sqlite auto_vacuum modes
+AUTO_VACUUM_NONE = 0
+AUTO_VACUUM_FULL = 1
+AUTO_VACUUM_INCREMENTAL = 2
+
+# number of file hashes kept in the index
+FILE_HASH_LIMIT = 10000
+
+# number of free pages reclaimed per maintenance step
+MAINTENANCE_PAGES = 64
+
+# most errors reported by an index check
+CHECK_MAX_ERRORS = 10
+
+# background reindexing of unmanaged changes
+REINDEX_BATCH_SIZE = 50   # nodes indexed per batch
+REINDEX_DELAY = .1        # seconds to pause between batches
 
 #=============================================================================
 
@@ -62,7 +86,10 @@ class NoteBookIndex (NodeIndex):
         self._index_file = index_file
         self._uniroot = keepnote.notebook.UNIVERSAL_ROOT
         self.con = None     # sqlite connection
-        self.cur = None     # sqlite cursor
+        self._local = threading.local()  # per thread sqlite cursors
+        self._cursors = []
+        self._lock = threading.RLock()   # serializes writes to connection
+        self._reindex = ReindexQueue(self)
 
         # index state/capabilities
         self._need_index = False
@@ -83,7 +110,7 @@ class NoteBookIndex (NodeIndex):
                                       isolation_level="DEFERRED",
                                       #isolation_level="IMMEDIATE",
                                       check_same_thread=False)
-            self.cur = self.con.cursor()
+            self.clear_handles()
             #self.con.execute(u"PRAGMA read_uncommitted = true;")
 
             self.init_index(auto_clear=auto_clear)
@@ -93,25 +120,69 @@ class NoteBookIndex (NodeIndex):
 
     def close(self):
         """Close connection to index"""
+        self._reindex.stop()
         if self.con is not None:
             try:
                 self.con.commit()
+                # cursors of other threads must not outlive the connection
+                for cur in self._cursors:
+                    cur.close()
+                self._cursors = []
                 self.con.close()
             except:
                 # close should always happen without propogating errors
                 pass
             self.con = None
-            self.cur = None
+
+    def _get_cursor(self):
+        """Returns the sqlite cursor of the calling thread"""
+        if self.con is None:
+            return None
+        cur = getattr(self._local, "cur", None)
+        if cur is None or cur.connection is not self.con:
+            cur = self._local.cur = LockedCursor(self.con.cursor(), self._lock)
+            self._cursors.append(cur)
+        return cur
+
+    def release_cursor(self):
+        """Close the sqlite cursor of the calling thread"""
+        cur = getattr(self._local, "cur", None)
+        if cur is None:
+            return
+        self._local.cur = None
+        if cur in self._cursors:
+            self._cursors.remove(cur)
+        try:
+            cur.close()
+        except sqlite.Error:
+            pass
+
+    # threads share the connection but each uses its own cursor
+    cur = property(_get_cursor)
+
+    def commit(self):
+        """Commit pending writes to the index"""
+        with self._lock:
+            if self.con is not None:
+                self.con.commit()
+
+    def rollback(self):
+        """Discard pending writes to the index"""
+        with self._lock:
+            try:
+                if self.con is not None:
+                    self.con.rollback()
+            except sqlite.Error:
+                pass
+            # handles created since the last commit are gone
+            self.clear_handles()
 
     def save(self):
         """Save index"""
         try:
-            mtime = time.time()
-            self.con.execute(
-                """UPDATE NodeGraph SET mtime = ? WHERE nodeid = ?;""",
-                (mtime, self._nconn.get_rootid()))
+            self.set_node_mtime(self._nconn.get_rootid())
             try:
-                self.con.commit()
+                self.commit()
             except:
                 self.open()
         except Exception, e:
@@ -149,6 +220,10 @@ class NoteBookIndex (NodeIndex):
         con = self.con
 
         try:
+            # only takes effect for new index files, older ones are
+            # converted by compact()
+            con.execute(u"PRAGMA auto_vacuum = INCREMENTAL;")
+
             # check database version
             version = self._get_version()
             if version is None or version != INDEX_VERSION:
@@ -158,19 +233,43 @@ class NoteBookIndex (NodeIndex):
                 self._set_version()
                 self._need_index = True
 
+            # init nodeid handles
+            self.init_handles(self.cur)
+
             # init NodeGraph table
             con.execute(u"""CREATE TABLE IF NOT EXISTS NodeGraph
-                           (nodeid TEXT,
-                            parentid TEXT,
+                           (handle INTEGER PRIMARY KEY,
+                            parent INTEGER,
                             basename TEXT,
                             mtime FLOAT,
-                            symlink BOOLEAN,
-                            UNIQUE(nodeid) ON CONFLICT REPLACE);
+                            symlink BOOLEAN);
+                        """)
+            con.execute(u"""CREATE INDEX IF NOT EXISTS IdxNodeGraphParent
+                           ON NodeGraph (parent);""")
+
+            # init FileHashes table, newest rows have the largest rowid
+            con.execute(u"""CREATE TABLE IF NOT EXISTS FileHashes
+                           (handle INTEGER,
+                            filename TEXT,
+                            size INTEGER,
+                            mtime FLOAT,
+                            hash TEXT,
+                            PRIMARY KEY (handle, filename));
                         """)
-            con.execute(u"""CREATE INDEX IF NOT EXISTS IdxNodeGraphNodeid
-                           ON NodeGraph (nodeid);""")
-            con.execute(u"""CREATE INDEX IF NOT EXISTS IdxNodeGraphParentid
-                           ON NodeGraph (parentid);""")
+
+            # init Tombstones of deleted nodes, which are complete from
+            # the time in TombstonesStart
+            con.execute(u"""CREATE TABLE IF NOT EXISTS Tombstones
+                           (nodeid TEXT PRIMARY KEY,
+                            mtime FLOAT);
+                        """)
+            con.execute(u"""CREATE TABLE IF NOT EXISTS TombstonesStart
+                           (mtime FLOAT);""")
+            if con.execute(u"SELECT COUNT(*) FROM TombstonesStart"
+                           ).fetchone()[0] == 0:
+                # whole seconds, like the modified_time of nodes
+                con.execute(u"INSERT INTO TombstonesStart VALUES (?)",
+                            (int(time.time()),))
 
             # init attribute indexes
             self.init_attrs(self.cur)
@@ -193,14 +292,118 @@ class NoteBookIndex (NodeIndex):
         return self._corrupt
 
     def check_index(self):
-        """Check filesystem to see if index is up to date"""
+        """
+        Check filesystem for nodes that changed since they were indexed
+
+        Node paths are rebuilt from the index in memory and each node
+        directory is checked with a single stat against its indexed mtime.
+        Payload files are never visited, since writing a file updates the
+        mtime of its node directory.
+
+        Returns a list of (nodeid, path) for nodes whose directory is newer
+        than the index or no longer exists.
+        """
         keepnote.log_message("checking index... ")
         start = time.time()
-        mtime_index = self.get_mtime()
-        mtime = keepnote.notebook.connection.fs.last_node_change(
-            self._nconn._get_node_path(self._nconn.get_rootid()))
+
+        rows = self.cur.execute(
+            u"""SELECT g.handle, g.parent, g.basename, g.mtime, n.nodeid
+                FROM NodeGraph AS g
+                JOIN NodeIds AS n ON n.handle = g.handle""").fetchall()
+        nodes = dict((row[0], row) for row in rows)
+        paths = {}
+
+        def get_path(handle):
+            # walk up to the nearest node with a known path
+            chain = []
+            while handle in nodes and handle not in paths:
+                chain.append(handle)
+                handle = nodes[handle][1]
+                if len(chain) > len(nodes):
+                    # parent loop
+                    return None
+            path = paths.get(handle, self._nconn._filename)
+            for handle in reversed(chain):
+                basename = nodes[handle][2]
+                if basename:
+                    path = os.path.join(path, basename)
+                paths[handle] = path
+            return path
+
+        stale = []
+        for handle, parent, basename, mtime, key in rows:
+            path = get_path(handle)
+            if path is None:
+                continue
+            try:
+                current = os.stat(path).st_mtime <= mtime
+            except OSError:
+                current = False
+            if not current:
+                stale.append((key_to_nodeid(key), path))
+
         keepnote.log_message("%f seconds\n" % (time.time() - start))
-        return (mtime > mtime_index)
+        return stale
+
+    def index_changes(self, stale=None):
+        """
+        Reindex only the nodes that changed on disk since they were indexed
+
+        Stale nodes are found with check_index().  Each is reindexed along
+        with its list of children: children that are new to the node are
+        indexed with their whole subtree, renamed children are updated and
+        children that disappeared are removed from the index.
+
+        This function returns an iterator which must be iterated to completion.
+        """
+        conn = self._nconn
+        if stale is None:
+            stale = self.check_index()
+
+        missing = []
+        for nodeid, path in stale:
+            if not os.path.exists(path):
+                # node may have been moved, decide once all parents are done
+                missing.append(nodeid)
+                continue
+
+            old_children = dict(self.list_children(nodeid))
+            try:
+                conn.read_node(nodeid, _force_index=True)
+                children = set(conn._list_children_nodeids(nodeid))
+            except Exception, e:
+                keepnote.log_error(e, sys.exc_info()[2])
+                continue
+            yield nodeid
+
+            for child in children:
+                if child not in old_children:
+                    # index subtrees of added children
+                    for nodeid2 in self.index_all(child):
+                        yield nodeid2
+                elif (conn._path_cache.get_basename(child) !=
+                      old_children[child]):
+                    # renamed child directories keep their old mtime
+                    conn.read_node(child, _force_index=True)
+                    yield child
+
+            # remove children that are no longer here, unless they have
+            # already been indexed under their new parent
+            for child in old_children:
+                if child not in children:
+                    node = self.get_node(child)
+                    if node and node["parentid"] == nodeid:
+                        self.remove_node(child)
+
+        # remove nodes that were not found at a new location
+        for nodeid in missing:
+            path_list = self.get_node_filepath(nodeid)
+            if path_list is not None and not os.path.exists(
+                    os.path.join(conn._filename, *path_list)):
+                self.remove_node(nodeid)
+
+        self._reindex.flush()
+        self.commit()
 
     def _on_corrupt(self, error, tracebk=None):
         """
@@ -216,11 +419,16 @@ class NoteBookIndex (NodeIndex):
         # TODO: reload database?
 
     def _drop_tables(self):
-        """drop NodeGraph tables"""
+        """drop NodeGraph tables
+
+        Tombstones are kept, since they cannot be rebuilt from the notebook.
+        """
         self.con.execute(u"DROP TABLE IF EXISTS NodeGraph")
         self.con.execute(u"DROP INDEX IF EXISTS IdxNodeGraphNodeid")
         self.con.execute(u"DROP INDEX IF EXISTS IdxNodeGraphParentid")
+        self.con.execute(u"DROP TABLE IF EXISTS FileHashes")
         self.drop_attrs(self.cur)
+        self.drop_handles(self.cur)
 
     def index_needed(self):
         """Returns True if indexing is needed"""
@@ -258,24 +466,145 @@ class NoteBookIndex (NodeIndex):
         # perform indexing
         # simply by walking through the tree, all nodes will index themselves
         for nodeid in preorder(conn, rootid):
+            # index changes found by the walk now rather than in the
+            # background
+            self._reindex.process()
             yield nodeid
+        self._reindex.flush()
 
         # record index complete
         self._need_index = False
 
+    def queue_node(self, nodeid, parentid, basename, attr, mtime, path):
+        """Queue a node changed outside of KeepNote for reindexing"""
+        if self.con is None:
+            return
+        self._reindex.add(nodeid, parentid, basename, attr, mtime, path)
+
+    def flush_queue(self):
+        """Index all queued nodes now"""
+        self._reindex.flush()
+
+    def check_changes(self):
+        """Reindex nodes changed on disk (see index_changes) in background"""
+        if self.con is None:
+            return
+        self._reindex.add_check()
+
     def compact(self):
         """
         Try to compact the index by reclaiming space
+
+        This rebuilds the whole index file and also switches indexes
+        created without incremental auto_vacuum over to it.
         """
         keepnote.log_message("compacting index '%s'\n" % self._index_file)
-        self.con.execute("VACUUM;")
-        self.con.comment()
+        with self._lock:
+            self.con.commit()
+            self.con.execute(u"PRAGMA auto_vacuum = INCREMENTAL;")
+            self.con.execute(u"VACUUM;")
+            self.con.commit()
+
+    def _get_pragma(self, name):
+        """Returns the value of a sqlite PRAGMA"""
+        return self.cur.execute(u"PRAGMA %s;" % name).fetchone()[0]
+
+    def get_stats(self):
+        """Returns a dict of index file statistics"""
+        stats = {}
+        for name in ("page_size", "page_count", "freelist_count",
+                     "auto_vacuum"):
+            stats[name] = self._get_pragma(name)
+        stats["size"] = stats["page_size"] * stats["page_count"]
+        return stats
+
+    def maintain(self, task=None, pages=MAINTENANCE_PAGES):
+        """
+        Perform index maintenance in small steps
+
+        Fulltext segments are merged, free pages are reclaimed with
+        incremental vacuum and the database is checked with quick_check,
+        a table at a time where sqlite supports it (3.33 or later).  Each
+        iteration performs one bounded step, so the caller can spread
+        the work over idle time.  Progress is reported to 'task' and its result
+        is set to the statistics of the index.
+
+        This function returns an iterator which must be iterated to completion.
+        """
+        if self.con is None:
+            return
+
+        stats = self.get_stats()
+        if task:
+            task.set_message(("text", "Maintaining index..."))
+
+        # merge fulltext segments
+        if task:
+            task.set_message(("detail", "merging fulltext index"))
+        while True:
+            with self._lock:
+                more = self.merge_fulltext(self.cur, pages)
+                self.con.commit()
+            yield "merge"
+            if not more:
+                break
+
+        # reclaim free pages, including those released by merging
+        nfree = self._get_pragma("freelist_count")
+        if stats["auto_vacuum"] == AUTO_VACUUM_INCREMENTAL:
+            if task:
+                task.set_message(("detail", "reclaiming free pages"))
+            free = nfree
+            while free > 0:
+                with self._lock:
+                    self.con.execute(
+                        u"PRAGMA incremental_vacuum(%d);" % pages).fetchall()
+                    self.con.commit()
+                free = self._get_pragma("freelist_count")
+                if task:
+                    task.set_percent((nfree - free) / float(nfree))
+                yield "vacuum"
+
+        # check integrity
+        if task:
+            task.set_message(("detail", "checking index"))
+        if sqlite.sqlite_version_info >= (3, 33, 0):
+            checks = [u"PRAGMA quick_check('%s');" % name.replace("'", "''")
+                      for (name,) in self.cur.execute(
+                          u"SELECT name FROM sqlite_master "
+                          u"WHERE type = 'table'").fetchall()]
+        else:
+            checks = [u"PRAGMA quick_check(%d);" % CHECK_MAX_ERRORS]
+        for check in checks:
+            try:
+                errors = [row[0] for row in
+                          self.cur.execute(check).fetchall()]
+            except sqlite.OperationalError:
+                # table was dropped since the check started
+                errors = ["ok"]
+            yield "check"
+            if errors != ["ok"]:
+                self._on_corrupt(Exception(
+                    "index check failed: %s" %
+                    "; ".join(errors[:CHECK_MAX_ERRORS])))
+                break
+
+        stats2 = self.get_stats()
+        stats2["reclaimed"] = stats["size"] - stats2["size"]
+        stats2["ok"] = not self._corrupt
+        if task:
+            task.set_percent(1.0)
+            task.set_result(stats2)
 
     def get_node_mtime(self, nodeid):
         """Get the last indexed mtime for a node"""
 
+        handle = self.get_handle(self.cur, nodeid)
+        if handle is None:
+            return 0.0
+
         self.cur.execute(u"""SELECT mtime FROM NodeGraph
-                             WHERE nodeid=?""", (nodeid,))
+                             WHERE handle=?""", (handle,))
         row = self.cur.fetchone()
         if row:
             return row[0]
@@ -287,63 +616,154 @@ class NoteBookIndex (NodeIndex):
         if mtime is None:
             mtime = time.time()
 
-        self.cur.execute(
-            """UPDATE NodeGraph SET mtime = ? WHERE nodeid = ?;""",
-            (mtime, nodeid))
-        if commit:
-            self.con.commit()
+        with self._lock:
+            handle = self.get_handle(self.cur, nodeid)
+            if handle is None:
+                return
+
+            self.cur.execute(
+                """UPDATE NodeGraph SET mtime = ? WHERE handle = ?;""",
+                (mtime, handle))
+            if commit:
+                self.con.commit()
 
     def get_mtime(self):
         """Get last modification time of the index"""
         return os.stat(self._index_file).st_mtime
 
-    def add_node(self, nodeid, parentid, basename, attr, mtime, commit=False):
-        """Add a node to the index"""
-        # TODO: remove single parent assumption
+    def get_file_hash(self, nodeid, filename, size, mtime):
+        """
+        Get the stored hash of a node file
 
+        Returns None unless a hash was stored for the same size and mtime.
+        """
         if self.con is None:
-            return
+            return None
 
-        try:
-            # get info
-            if parentid is None:
-                parentid = self._uniroot
-                basename = u""
-            symlink = False
+        handle = self.get_handle(self.cur, nodeid)
+        if handle is None:
+            return None
 
-            # update nodegraph
-            self.cur.execute(
-                u"""INSERT INTO NodeGraph VALUES (?, ?, ?, ?, ?)""",
-                (nodeid, parentid, basename, mtime, symlink))
+        self.cur.execute(u"""SELECT hash FROM FileHashes
+                             WHERE handle=? AND filename=? AND
+                                   size=? AND mtime=?""",
+                         (handle, filename, size, mtime))
+        row = self.cur.fetchone()
+        if row:
+            return row[0]
+        else:
+            return None
 
-            self.add_node_attr(self.cur, nodeid, attr)
+    def set_file_hash(self, nodeid, filename, size, mtime, digest):
+        """
+        Store the hash of a node file
 
-            if commit:
-                self.con.commit()
+        Only the newest FILE_HASH_LIMIT hashes are kept.
+        """
+        if self.con is None:
+            return
 
-        except Exception, e:
-            keepnote.log_error("error index node %s '%s'" %
-                               (nodeid, attr.get("title", "")))
-            self._on_corrupt(e, sys.exc_info()[2])
+        with self._lock:
+            try:
+                handle = self.get_handle(self.cur, nodeid)
+                if handle is None:
+                    return
+
+                # replaced rows get a new rowid
+                self.cur.execute(
+                    u"""INSERT OR REPLACE INTO FileHashes
+                        VALUES (?, ?, ?, ?, ?)""",
+                    (handle, filename, size, mtime, digest))
+                self.cur.execute(
+                    u"""DELETE FROM FileHashes WHERE rowid <=
+                        (SELECT MAX(rowid) FROM FileHashes) - ?""",
+                    (FILE_HASH_LIMIT,))
+
+            except sqlite.DatabaseError, e:
+                self.rollback()
+                self._on_corrupt(e, sys.exc_info()[2])
 
-    def remove_node(self, nodeid, commit=False):
-        """Remove node from index using nodeid"""
+    def add_node(self, nodeid, parentid, basename, attr, mtime, commit=False):
+        """Add a node to the index"""
+        # TODO: remove single parent assumption
 
         if self.con is None:
             return
 
-        try:
-            # delete node
-            self.cur.execute(
-                u"DELETE FROM NodeGraph WHERE nodeid=?", (nodeid,))
+        with self._lock:
+            try:
+                # get info
+                if parentid is None:
+                    parentid = self._uniroot
+                    basename = u""
+                symlink = False
+                handle = self.get_handle(self.cur, nodeid, create=True)
+                parent = self.get_handle(self.cur, parentid, create=True)
+                self.cur.execute(u"DELETE FROM Tombstones WHERE nodeid=?",
+                                 (nodeid_to_key(nodeid),))
+
+                # update nodegraph
+                self.cur.execute(
+                    u"""INSERT OR REPLACE INTO NodeGraph
+                        VALUES (?, ?, ?, ?, ?)""",
+                    (handle, parent, basename, mtime, symlink))
+
+                self.add_node_attr(self.cur, nodeid, attr)
+
+                if commit:
+                    self.con.commit()
+
+            except Exception, e:
+                keepnote.log_error("error index node %s '%s'" %
+                                   (nodeid, attr.get("title", "")))
+                self.rollback()
+                self._on_corrupt(e, sys.exc_info()[2])
 
-            self.remove_node_attr(self.cur, nodeid)
+    def remove_node(self, nodeid, commit=False):
+        """Remove node from index using nodeid"""
 
-            if commit:
-                self.con.commit()
+        if self.con is None:
+            return
 
-        except sqlite.DatabaseError, e:
-            self._on_corrupt(e, sys.exc_info()[2])
+        with self._lock:
+            try:
+                # nodes still indexed under the node are gone with it
+                nodes = [(nodeid, self.get_handle(self.cur, nodeid))]
+                seen = set([nodes[0][1]])
+                for nodeid2, handle2 in nodes:
+                    if handle2 is None:
+                        continue
+                    self.cur.execute(
+                        u"""SELECT n.nodeid, n.handle
+                            FROM NodeGraph AS g
+                            JOIN NodeIds AS n ON n.handle = g.handle
+                            WHERE g.parent=?""", (handle2,))
+                    for key, child in self.cur.fetchall():
+                        if child not in seen:
+                            seen.add(child)
+                            nodes.append((key_to_nodeid(key), child))
+
+                for nodeid2, handle2 in nodes:
+                    self.cur.execute(
+                        u"INSERT OR REPLACE INTO Tombstones VALUES (?, ?)",
+                        (nodeid_to_key(nodeid2), time.time()))
+                    if handle2 is None:
+                        continue
+                    self.cur.execute(
+                        u"DELETE FROM NodeGraph WHERE handle=?", (handle2,))
+                    self.remove_node_attr(self.cur, nodeid2)
+                    self.cur.execute(
+                        u"DELETE FROM FileHashes WHERE handle=?", (handle2,))
+                    self.cur.execute(
+                        u"DELETE FROM NodeIds WHERE handle=?", (handle2,))
+                    self._handles.pop(nodeid2, None)
+
+                if commit:
+                    self.con.commit()
+
+            except sqlite.DatabaseError, e:
+                self.rollback()
+                self._on_corrupt(e, sys.exc_info()[2])
 
     #-------------------------
     # queries
@@ -353,33 +773,40 @@ class NoteBookIndex (NodeIndex):
 
         # TODO: handle multiple parents
 
-        visit = set([nodeid])
         path = []
-        parentid = None
 
         try:
-            while parentid != self._uniroot:
-                # continue to walk up parent
-                path.append(nodeid)
+            handle = self.get_handle(self.cur, nodeid)
+            uniroot = self.get_handle(self.cur, self._uniroot)
+            if handle is None:
+                return None
+            visit = set([handle])
 
-                self.cur.execute(u"""SELECT nodeid, parentid, basename
-                                FROM NodeGraph
-                                WHERE nodeid=?""", (nodeid,))
+            while True:
+                # continue to walk up parent
+                self.cur.execute(u"""SELECT n.nodeid, g.parent
+                                FROM NodeGraph AS g
+                                JOIN NodeIds AS n ON n.handle = g.handle
+                                WHERE g.handle=?""", (handle,))
                 row = self.cur.fetchone()
 
                 # nodeid is not index
                 if row is None:
                     return None
 
-                nodeid, parentid, basename = row
+                key, parent = row
+                path.append(key_to_nodeid(key))
+                if parent == uniroot:
+                    break
 
                 # parent has unexpected loop
-                if parentid in visit:
+                if parent in visit:
                     self._on_corrupt(Exception("unexpect parent path loop"))
                     return None
+                visit.add(parent)
 
                 # walk up
-                nodeid = parentid
+                handle = parent
 
             path.reverse()
             return path
@@ -393,34 +820,40 @@ class NoteBookIndex (NodeIndex):
 
         # TODO: handle multiple parents
 
-        visit = set([nodeid])
         path = []
-        parentid = None
 
         try:
-            while parentid != self._uniroot:
-                # continue to walk up parent
+            handle = self.get_handle(self.cur, nodeid)
+            uniroot = self.get_handle(self.cur, self._uniroot)
+            if handle is None:
+                return None
+            visit = set([handle])
 
-                self.cur.execute(u"""SELECT nodeid, parentid, basename
+            while True:
+                # continue to walk up parent
+                self.cur.execute(u"""SELECT parent, basename
                                 FROM NodeGraph
-                                WHERE nodeid=?""", (nodeid,))
+                                WHERE handle=?""", (handle,))
                 row = self.cur.fetchone()
 
                 # nodeid is not index
                 if row is None:
                     return None
 
-                nodeid, parentid, basename = row
+                parent, basename = row
                 if basename != "":
                     path.append(basename)
+                if parent == uniroot:
+                    break
 
                 # parent has unexpected loop
-                if parentid in visit:
+                if parent in visit:
                     self._on_corrupt(Exception("unexpect parent path loop"))
                     return None
+                visit.add(parent)
 
                 # walk up
-                nodeid = parentid
+                handle = parent
 
             path.reverse()
             return path
@@ -435,19 +868,24 @@ class NoteBookIndex (NodeIndex):
         # TODO: handle multiple parents
 
         try:
-            self.cur.execute(u"""SELECT nodeid, parentid, basename, mtime
-                                FROM NodeGraph
-                                WHERE nodeid=?""", (nodeid,))
+            handle = self.get_handle(self.cur, nodeid)
+            if handle is None:
+                return None
+
+            self.cur.execute(u"""SELECT p.nodeid, g.basename, g.mtime
+                                FROM NodeGraph AS g
+                                LEFT JOIN NodeIds AS p ON p.handle = g.parent
+                                WHERE g.handle=?""", (handle,))
             row = self.cur.fetchone()
 
             # nodeid is not index
             if row is None:
                 return None
 
-            return {"nodeid": row[0],
-                    "parentid": row[1],
-                    "basename": row[2],
-                    "mtime": row[3]}
+            return {"nodeid": nodeid,
+                    "parentid": key_to_nodeid(row[0]),
+                    "basename": row[1],
+                    "mtime": row[2]}
 
         except sqlite.DatabaseError, e:
             self._on_corrupt(e, sys.exc_info()[2])
@@ -459,19 +897,27 @@ class NoteBookIndex (NodeIndex):
 
     def has_node(self, nodeid):
         """Returns True if index has node"""
-        self.cur.execute(u"""SELECT nodeid, parentid, basename, mtime
-                             FROM NodeGraph
-                             WHERE nodeid=?""", (nodeid,))
+        handle = self.get_handle(self.cur, nodeid)
+        if handle is None:
+            return False
+        self.cur.execute(u"""SELECT 1 FROM NodeGraph
+                             WHERE handle=?""", (handle,))
         return self.cur.fetchone() is not None
 
     def list_children(self, nodeid):
         """List children indexed for node"""
 
         try:
-            self.cur.execute(u"""SELECT nodeid, basename
-                                FROM NodeGraph
-                                WHERE parentid=?""", (nodeid,))
-            return list(self.cur.fetchall())
+            handle = self.get_handle(self.cur, nodeid)
+            if handle is None:
+                return []
+
+            self.cur.execute(u"""SELECT n.nodeid, g.basename
+                                FROM NodeGraph AS g
+                                JOIN NodeIds AS n ON n.handle = g.handle
+                                WHERE g.parent=?""", (handle,))
+            return [(key_to_nodeid(key), basename)
+                    for key, basename in self.cur.fetchall()]
 
         except sqlite.DatabaseError, e:
             self._on_corrupt(e, sys.exc_info()[2])
@@ -481,20 +927,64 @@ class NoteBookIndex (NodeIndex):
         """Returns True if node has children"""
 
         try:
-            self.cur.execute(u"""SELECT nodeid
+            handle = self.get_handle(self.cur, nodeid)
+            if handle is None:
+                return False
+
+            self.cur.execute(u"""SELECT 1
                                 FROM NodeGraph
-                                WHERE parentid=?""", (nodeid,))
+                                WHERE parent=?""", (handle,))
             return self.cur.fetchone() is not None
 
         except sqlite.DatabaseError, e:
             self._on_corrupt(e, sys.exc_info()[2])
             raise
 
-    def search_titles(self, title):
+    def search_titles(self, title, limit=None, offset=0):
         """Search node titles"""
 
         try:
-            return self.search_node_titles(self.cur, title)
+            return self.search_node_titles(self.cur, title, limit, offset)
+        except sqlite.DatabaseError, e:
+            self._on_corrupt(e, sys.exc_info()[2])
+            raise
+
+    def search_modified(self, mtime):
+        """
+        Search nodes modified at or after 'mtime'
+
+        Returns None while the index is not up to date.
+        """
+        if self._need_index or len(self._reindex) > 0:
+            return None
+
+        try:
+            return self.search_node_modified(self.cur, mtime)
+        except sqlite.DatabaseError, e:
+            self._on_corrupt(e, sys.exc_info()[2])
+            raise
+
+    def search_deleted(self, mtime):
+        """
+        Search nodes deleted at or after 'mtime'
+
+        Returns (nodeid, deleted_time) ordered by deleted_time, or None if
+        nodes deleted then may not have been recorded.  Every recorded
+        deletion is returned if 'mtime' is None.
+        """
+        if self.con is None or len(self._reindex) > 0:
+            return None
+
+        try:
+            start = self.cur.execute(
+                u"SELECT MIN(mtime) FROM TombstonesStart").fetchone()[0]
+            if start is None or (mtime is not None and mtime < start):
+                return None
+            self.cur.execute(u"""SELECT nodeid, mtime FROM Tombstones
+                                 WHERE mtime >= ? ORDER BY mtime""",
+                             (mtime or 0,))
+            return [(key_to_nodeid(key), deleted)
+                    for key, deleted in self.cur.fetchall()]
         except sqlite.DatabaseError, e:
             self._on_corrupt(e, sys.exc_info()[2])
             raise
@@ -506,7 +996,227 @@ class NoteBookIndex (NodeIndex):
         try:
             for res in self.search_node_contents(cur, text):
                 yield res
-        except:
+        except sqlite.Error:
             keepnote.log_error("SQLITE error while performing search")
         finally:
             cur.close()
+
+
+class LockedCursor (object):
+    """
+    sqlite cursor whose calls hold the lock of its connection
+
+    The index connection is shared by threads, and sqlite3 connections
+    are not safe to use from several threads at once.
+    """
+
+    def __init__(self, cur, lock):
+        self._cur = cur
+        self._lock = lock
+
+    def execute(self, *args):
+        with self._lock:
+            self._cur.execute(*args)
+        return self
+
+    def executemany(self, *args):
+        with self._lock:
+            self._cur.executemany(*args)
+        return self
+
+    def fetchone(self):
+        with self._lock:
+            return self._cur.fetchone()
+
+    def fetchmany(self, *args):
+        with self._lock:
+            return self._cur.fetchmany(*args)
+
+    def fetchall(self):
+        with self._lock:
+            return self._cur.fetchall()
+
+    def close(self):
+        with self._lock:
+            self._cur.close()
+
+    def __iter__(self):
+        while True:
+            row = self.fetchone()
+            if row is None:
+                break
+            yield row
+
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
+
+
+# queues whose workers are stopped before the interpreter exits
+_reindex_queues = weakref.WeakSet()
+
+
+@atexit.register
+def _stop_reindexing():
+    for queue in list(_reindex_queues):
+        queue.stop()
+
+
+class ReindexQueue (object):
+    """
+    Reindexes nodes changed outside of KeepNote in a background thread
+
+    Nodes are queued once per nodeid (the latest attr wins) and are indexed
+    in batches of 'batch_size', pausing 'delay' seconds between batches so
+    that a large external change does not hog the index.  A check of the
+    whole notebook for changed nodes (see NoteBookIndex.index_changes) can
+    also be queued, and is done before any queued nodes.
+    """
+
+    def __init__(self, index, batch_size=REINDEX_BATCH_SIZE,
+                 delay=REINDEX_DELAY):
+        self._index = index
+        self._batch_size = batch_size
+        self._delay = delay
+
+        self._queue = deque()
+        self._pending = {}
+        self._lock = threading.Lock()        # protects queue and thread
+        self._apply_lock = threading.Lock()  # one node indexed at a time
+        self._check_lock = threading.RLock()  # held while checking
+        self._check = False
+        self._thread = None
+        self._workers = []  # workers that may still be exiting
+        self._stopped = False
+        self._count = 0
+        _reindex_queues.add(self)
+
+    def __len__(self):
+        return len(self._queue)
+
+    def add(self, nodeid, parentid, basename, attr, mtime, path):
+        """Queue a node for reindexing"""
+        with self._lock:
+            if nodeid not in self._pending:
+                self._queue.append(nodeid)
+            self._pending[nodeid] = (parentid, basename, dict(attr),
+                                     mtime, path)
+            self._stopped = False
+            self._start()
+
+    def add_check(self):
+        """Queue a check for nodes changed since they were indexed"""
+        with self._lock:
+            self._check = True
+            self._stopped = False
+            self._start()
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.setDaemon(True)
+            self._thread.start()
+            self._workers = [thread for thread in self._workers
+                             if thread.isAlive()]
+            self._workers.append(self._thread)
+
+    def process(self, limit=None):
+        """
+        Index up to 'limit' queued nodes in the calling thread
+
+        A queued check is done first.  Returns the number of nodes
+        processed.
+        """
+        n = 0
+        if self._check:
+            n += self._check_changes()
+        while limit is None or n < limit:
+            with self._apply_lock:
+                with self._lock:
+                    if not self._queue or self._stopped:
+                        break
+                    nodeid = self._queue.popleft()
+                    item = self._pending.pop(nodeid)
+                self._index_node(nodeid, *item)
+            n += 1
+        return n
+
+    def flush(self):
+        """Index all queued nodes, including any the worker is holding"""
+        self.process()
+        with self._check_lock:
+            pass
+        with self._apply_lock:
+            pass
+
+    def _check_changes(self):
+        """Reindex the nodes changed on disk"""
+        with self._check_lock:
+            with self._lock:
+                check = self._check and not self._stopped
+                self._check = False
+            if not check:
+                return 0
+
+            n = 0
+            try:
+                for nodeid in self._index.index_changes():
+                    n += 1
+                    if self._stopped:
+                        break
+            except Exception, e:
+                keepnote.log_error(e, sys.exc_info()[2])
+            self._count += n
+            return n
+
+    def stop(self):
+        """Drop queued nodes and wait for the workers to finish"""
+        with self._lock:
+            self._stopped = True
+            self._check = False
+            self._queue.clear()
+            self._pending.clear()
+            workers = list(self._workers)
+        for thread in workers:
+            if thread is not threading.currentThread():
+                thread.join()
+
+    def _index_node(self, nodeid, parentid, basename, attr, mtime, path):
+        index = self._index
+
+        # skip nodes that were deleted or indexed again since queued
+        if not os.path.exists(path) or index.get_node_mtime(nodeid) >= mtime:
+            return
+        index.add_node(nodeid, parentid, basename, attr, mtime)
+        self._count += 1
+
+    def _run(self):
+        """Worker thread"""
+        try:
+            self._run_batches()
+        finally:
+            # workers come and go, so do not leave their cursors behind
+            self._index.release_cursor()
+
+    def _run_batches(self):
+        while True:
+            self.process(self._batch_size)
+
+            with self._lock:
+                done = (not self._queue and not self._check) or self._stopped
+                if done:
+                    self._thread = None
+                npending = len(self._queue)
+
+            try:
+                self._index.commit()
+            except Exception, e:
+                keepnote.log_error(e, sys.exc_info()[2])
+
+            if self._count:
+                keepnote.log_message(
+                    u"Reindexed %d unmanaged changes, %d pending\n" %
+                    (self._count, npending))
+                self._count = 0
+            if done:
+                break
+            time.sleep(self._delay)
@@ -35,6 +35,7 @@ import uuid
 # keepnote imports
 from keepnote import sqlitedict
 from keepnote import trans
+from keepnote.notebook.connection import limit_results
 from keepnote.notebook.connection import NodeExists
 from keepnote.notebook.connection import NoteBookConnection
 from keepnote.notebook.connection import UnknownNode
@@ -432,7 +433,7 @@ class NoteBookConnectionFSRaw (NoteBookConnection):
 
         # built-in queries
         # ["index_attr", key, (index_value)]
-        # ["search", "title", text]
+        # ["search", "title", text, (limit, (offset))]
         # ["search_fulltext", text]
         # ["has_fulltext"]
         # ["node_path", nodeid]
@@ -444,12 +445,12 @@ class NoteBookConnectionFSRaw (NoteBookConnection):
         elif query[0] == "search":
             assert query[1] == "title"
 
-            return [
+            return limit_results([
                 (nodeid, node["title"])
                 for nodeid, node in (
                     (nodeid, self.read_node(nodeid))
                     for nodeid in self._nodefs.iter_nodeids())
-                if query[2] in node.get("title", "")]
+                if query[2] in node.get("title", "")], *query[3:])
 
         elif query[0] == "search_fulltext":
             # TODO: could implement brute-force backup
@@ -26,23 +26,75 @@
 #
 
 # python imports
+import base64
 from collections import defaultdict
+from collections import OrderedDict
 import contextlib
+from cStringIO import StringIO
+import functools
+import hashlib
 import httplib
 import json
+import os
+import socket
+import StringIO as pystringio
+import threading
+import time
 import urllib
 import urlparse
+import zlib
 
 # keepnote imports
+import keepnote
 from keepnote import plist
 import keepnote.notebook.connection as connlib
 from keepnote.notebook.connection import NoteBookConnection
+from keepnote.notebook.connection.http_cache import HttpCache
+from keepnote.notebook.connection.http_journal import WriteJournal
+from keepnote.notebook.connection.http_journal import get_entry_key
 
 
 XML_HEADER = u"""\
 <?xml version="1.0" encoding="UTF-8"?>
 """
 
+# Maximum number of operations sent in one batch request.
+BATCH_SIZE = 500
+
+# Size of chunks used to stream file uploads.
+FILE_CHUNK_SIZE = 64 * 1024
+
+# Levels of descendants fetched along with a node that is read.
+PREFETCH_DEPTH = 1
+
+# Maximum number of prefetched node attrs kept.
+PREFETCH_LIMIT = 10000
+
+# Seconds a prefetched node attr can be used for.
+PREFETCH_TTL = 30
+
+# Minimum seconds between polls of the server's changes that invalidate
+# prefetched attrs.
+CHANGES_INTERVAL = 1
+
+# Maximum size of node files kept in the local cache.
+CACHE_FILE_LIMIT = 1024 * 1024
+
+# Maximum number of concurrent requests of a connection.
+POOL_SIZE = 4
+
+# Content codings accepted in responses.
+ACCEPT_ENCODING = 'gzip, deflate'
+
+# Number of search results requested at once.
+SEARCH_PAGE_SIZE = 100
+
+# Seconds between attempts to reconnect while offline.
+RETRY_INTERVAL = 30
+
+# Errors raised when the server cannot be reached.
+NETWORK_ERRORS = (socket.error, httplib.HTTPException)
+
 
 #=============================================================================
 # Node URL scheme
@@ -96,17 +148,687 @@ def format_node_url(host, prefix, nodeid, filename=None, port=80):
                                format_node_path(prefix, nodeid, filename))
 
 
+def iter_lines(stream, size=16384):
+    """Iterate through the lines of a stream that only supports read()"""
+    rest = ""
+    while True:
+        data = stream.read(size)
+        if not data:
+            break
+        lines = (rest + data).split("\n")
+        rest = lines.pop()
+        for line in lines:
+            yield line
+    if rest:
+        yield rest
+
+
 #=============================================================================
 # NoteBook HTTP client
 
+
+class DecodedResponse (object):
+    """Response whose gzip or deflate encoded body is decoded as it is read"""
+
+    def __init__(self, response, chunk_size=FILE_CHUNK_SIZE):
+        self._response = response
+        self._chunk_size = chunk_size
+        # accept both zlib and gzip headers
+        self._decompressor = zlib.decompressobj(zlib.MAX_WBITS | 32)
+        self._buffer = ""
+        self.status = response.status
+        self.reason = response.reason
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    def getheaders(self):
+        return self._response.getheaders()
+
+    def read(self, size=-1):
+        if size is None:
+            size = -1
+        while size < 0 or len(self._buffer) < size:
+            data = self._response.read(self._chunk_size)
+            if not data:
+                self._buffer += self._decompressor.flush()
+                break
+            try:
+                self._buffer += self._decompressor.decompress(data)
+            except zlib.error:
+                raise httplib.IncompleteRead(self._buffer)
+
+        if size < 0:
+            data, self._buffer = self._buffer, ""
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def isclosed(self):
+        return self._response.isclosed()
+
+    def close(self):
+        self._response.close()
+
+
+def decode_response(response):
+    """Returns a response whose body is decoded from its Content-Encoding"""
+    coding = (response.getheader('Content-Encoding') or '').lower()
+    if coding in ('gzip', 'x-gzip', 'deflate'):
+        return DecodedResponse(response)
+    return response
+
+
+class HttpResponse (object):
+    """A response whose body has been completely read"""
+
+    def __init__(self, response):
+        self.status = response.status
+        self.reason = response.reason
+        self._headers = dict(response.getheaders())
+        self._body = StringIO(response.read())
+
+    def getheader(self, name, default=None):
+        return self._headers.get(name.lower(), default)
+
+    def read(self, size=-1):
+        return self._body.read(size)
+
+
+class HttpConnectionPool (object):
+    """
+    Bounded pool of persistent HTTP connections to one server
+
+    Each request holds a connection until its response is read.  At most
+    'size' requests are made at once; other threads wait for a free
+    connection.  A request that fails on a reused connection, whose socket
+    may have been closed by the server, is retried once on a new one.
+    """
+
+    def __init__(self, netloc, size=POOL_SIZE):
+        self.netloc = netloc
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def acquire(self):
+        """
+        Check out a connection, waiting for a free one
+
+        Returns (conn, reused), where reused is True for a connection that
+        was used before.  The connection must be given back with release().
+        """
+        self._slots.acquire()
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        return self.new_connection(), False
+
+    def new_connection(self):
+        return httplib.HTTPConnection(self.netloc)
+
+    def release(self, conn, keep):
+        """Give back a connection, keeping it open for reuse if 'keep'"""
+        if keep:
+            with self._lock:
+                self._idle.append(conn)
+        else:
+            conn.close()
+        self._slots.release()
+
+    def close(self):
+        """Close idle connections"""
+        with self._lock:
+            for conn in self._idle:
+                conn.close()
+            self._idle = []
+
+    @contextlib.contextmanager
+    def urlopen(self, method, url, body=None, headers={}):
+        """
+        Make a request and stream its response
+
+        The connection returns to the pool when the context exits, and is
+        only reused if the response was completely read.  Compressed
+        responses are decoded.
+        """
+        if 'Accept-Encoding' not in headers:
+            headers = dict(headers)
+            headers['Accept-Encoding'] = ACCEPT_ENCODING
+        conn, reused = self.acquire()
+        response = None
+        try:
+            try:
+                conn.request(method, url, body, headers)
+                response = conn.getresponse()
+            except (socket.error, httplib.HTTPException):
+                conn.close()
+                if not reused:
+                    raise
+                conn = self.new_connection()
+                conn.request(method, url, body, headers)
+                response = conn.getresponse()
+            yield decode_response(response)
+        finally:
+            self.release(conn, response is not None and response.isclosed())
+
+    def request(self, method, url, body=None, headers={}):
+        """Make a request and return its completely read response"""
+        with self.urlopen(method, url, body, headers) as response:
+            return HttpResponse(response)
+
+
+class HttpFileWriter (object):
+    """
+    Streaming writer for a node file
+
+    Written data is sent as it accumulates, using chunked transfer
+    encoding.  Files smaller than one chunk are sent as a plain request on
+    close.  The writer holds a connection of the pool from its first
+    request until it is closed.
+
+    If 'fallback' is given, written data is also kept, and when the
+    server cannot be reached the data is written to the file stream
+    returned by fallback() instead.  The server discards a partly sent
+    file, so nothing is written twice.
+    """
+
+    def __init__(self, pool, url, codec=None,
+                 chunk_size=FILE_CHUNK_SIZE, cache=None, fallback=None):
+        self._pool = pool
+        # urls are quoted, and a unicode url would decode binary bodies
+        self._url = str(url)
+        self._codec = codec
+        self._cache = cache
+        self._chunk_size = chunk_size
+        self._fallback = fallback
+        self._written = [] if fallback else None
+        self._stream = None
+        self._conn = None
+        self._buffer = []
+        self._buffer_size = 0
+        self.closed = False
+
+    def write(self, data):
+        if self._codec:
+            data = data.encode(self._codec)
+        if self._stream:
+            self._stream.write(data)
+            return
+        if self._written is not None:
+            self._written.append(data)
+        self._buffer.append(data)
+        self._buffer_size += len(data)
+        if self._buffer_size >= self._chunk_size:
+            self._send_chunk()
+
+    def _send_chunk(self):
+        data = "".join(self._buffer)
+        self._buffer = []
+        self._buffer_size = 0
+
+        try:
+            if self._conn is None:
+                self._connect(self._start_chunked)
+            self._conn.send("%x\r\n%s\r\n" % (len(data), data))
+        except NETWORK_ERRORS, e:
+            if self._fallback:
+                self._fall_back()
+                return
+            self._abort()
+            raise connlib.FileError("cannot write file '%s'" % self._url, e)
+
+    def _fall_back(self):
+        """Write everything to the fallback stream from now on"""
+        self._release()
+        self._stream = self._fallback()
+        for data in self._written:
+            self._stream.write(data)
+        self._written = None
+        self._buffer = []
+        self._buffer_size = 0
+
+    def _start_chunked(self, conn):
+        conn.putrequest('POST', self._url)
+        conn.putheader('Transfer-Encoding', 'chunked')
+        conn.endheaders()
+
+    def _connect(self, start):
+        """
+        Check out a connection and start the request on it
+
+        A reused connection may have been closed by the server, so the
+        request is started again once on a new connection.
+        """
+        self._conn, reused = self._pool.acquire()
+        try:
+            start(self._conn)
+        except (socket.error, httplib.HTTPException):
+            self._conn.close()
+            if not reused:
+                raise
+            self._conn = self._pool.new_connection()
+            start(self._conn)
+
+    def _release(self, keep=False):
+        if self._conn:
+            self._pool.release(self._conn, keep)
+            self._conn = None
+
+    def _abort(self):
+        self._release()
+        self.closed = True
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self._cache:
+            self._cache.remove("http://%s%s" % (
+                self._pool.netloc, self._url.split("?", 1)[0]))
+        if self._stream is None:
+            self._send()
+        if self._stream:
+            self._stream.close()
+
+    def _send(self):
+        """Finish sending the file"""
+        response = None
+        try:
+            if self._conn is None:
+                # small file, send in one request
+                body = "".join(self._buffer)
+                self._connect(
+                    lambda conn: conn.request('POST', self._url, body))
+            else:
+                if self._buffer_size:
+                    self._send_chunk()
+                    if self._stream:
+                        return
+                self._conn.send("0\r\n\r\n")
+            response = self._conn.getresponse()
+            response.read()
+        except NETWORK_ERRORS, e:
+            if self._fallback:
+                self._fall_back()
+                return
+            raise connlib.FileError("cannot write file '%s'" % self._url, e)
+        finally:
+            self._buffer = []
+            self._release(response is not None and response.isclosed())
+
+        if response.status != httplib.OK:
+            raise connlib.FileError("cannot write file '%s'" % self._url)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+
+class HttpFileReader (object):
+    """
+    Streaming reader for a node file
+
+    The file is read from the response as it arrives.  Seeking makes a
+    new request for the rest of the file with a Range header.  The reader
+    holds a connection of the pool while a response is being read, and
+    gives it back for reuse once the response is read to its end.
+
+    If a cache is given, small files are kept in it and revalidated with
+    their ETag when they are read again.  Reads from the start of the file
+    accept a compressed response.
+    """
+
+    def __init__(self, pool, url, cache=None):
+        self._pool = pool
+        self._url = url
+        self._cache = cache
+        self._cache_key = "http://%s%s" % (pool.netloc, url)
+        self._capture = None
+        self._conn = None
+        self._response = None
+        self._pos = 0
+        self._size = None
+        self._open(0)
+
+    def _open(self, offset):
+        """Request the file starting at 'offset'"""
+        self._close_response()
+        self._capture = None
+        headers = {}
+        cached = None
+        if offset:
+            headers['Range'] = 'bytes=%d-' % offset
+        else:
+            headers['Accept-Encoding'] = ACCEPT_ENCODING
+            if self._cache:
+                cached = self._cache.get(self._cache_key)
+                if cached:
+                    headers['If-None-Match'] = cached[0]
+
+        self._conn, reused = self._pool.acquire()
+        try:
+            try:
+                self._conn.request('GET', self._url, None, headers)
+                response = self._conn.getresponse()
+            except (socket.error, httplib.HTTPException):
+                # the server may have closed a reused connection
+                self._conn.close()
+                if not reused:
+                    raise
+                self._conn = self._pool.new_connection()
+                self._conn.request('GET', self._url, None, headers)
+                response = self._conn.getresponse()
+        except:
+            self._release(False)
+            raise
+
+        if response.status == httplib.NOT_MODIFIED and cached:
+            # read the cached copy
+            response.read()
+            self._release(True)
+            self._response = StringIO(cached[1])
+            self._size = len(cached[1])
+            self._pos = 0
+            return
+        elif response.status == httplib.REQUESTED_RANGE_NOT_SATISFIABLE:
+            # reading past the end of the file
+            response.read()
+            self._release(True)
+            self._pos = offset
+            return
+        elif response.status not in (httplib.OK, httplib.PARTIAL_CONTENT):
+            response.read()
+            self._release(True)
+            raise connlib.FileError("cannot read file '%s'" % self._url)
+
+        self._response = decode_response(response)
+        length = response.getheader('Content-Length')
+        if self._response is not response:
+            # length of the encoded body
+            length = None
+        if response.status == httplib.PARTIAL_CONTENT:
+            content_range = response.getheader('Content-Range', '')
+            self._size = int(content_range.rsplit('/', 1)[-1])
+            self._pos = offset
+        else:
+            if length is not None:
+                self._size = int(length)
+            etag = response.getheader('ETag')
+            if (self._cache and etag and offset == 0 and
+                    (self._size is None or self._size <= CACHE_FILE_LIMIT)):
+                self._capture = (etag, [], [0])
+            # server does not support ranges, skip to offset
+            self._pos = 0
+            while self._pos < offset:
+                if not self.read(min(offset - self._pos, 65536)):
+                    break
+
+    def _release(self, keep):
+        if self._conn:
+            self._pool.release(self._conn, keep)
+            self._conn = None
+
+    def _close_response(self):
+        if self._response:
+            # only a completely read response leaves the connection usable
+            keep = (self._conn is not None and
+                    self._response.isclosed())
+            self._response.close()
+            self._response = None
+            self._release(keep)
+
+    def read(self, size=-1):
+        if self._response is None:
+            return ""
+        if size is None or size < 0:
+            data = self._response.read()
+        else:
+            data = self._response.read(size)
+        self._pos += len(data)
+        if self._conn and self._response.isclosed():
+            # give back the connection as soon as the file is read
+            self._release(True)
+
+        if self._capture:
+            # keep the file once it is completely read
+            etag, chunks, total = self._capture
+            chunks.append(data)
+            total[0] += len(data)
+            if self._pos == self._size or (not data and self._size is None):
+                self._cache.set(self._cache_key, etag, "".join(chunks))
+                self._capture = None
+            elif not data or total[0] > CACHE_FILE_LIMIT:
+                self._capture = None
+        return data
+
+    def _request_size(self):
+        """Request the size of the file"""
+        headers = {'Range': 'bytes=0-0', 'Accept-Encoding': 'identity'}
+        if self._conn is None:
+            response = self._pool.request('GET', self._url, None, headers)
+        else:
+            # This reader already holds one of the pool's connections.
+            # Waiting for another could deadlock if every reader did.
+            conn = self._pool.new_connection()
+            try:
+                conn.request('GET', self._url, None, headers)
+                response = conn.getresponse()
+                response.read()
+            finally:
+                conn.close()
+        if response.status == httplib.PARTIAL_CONTENT:
+            return int(response.getheader('Content-Range', '').rsplit(
+                '/', 1)[-1])
+        elif response.status == httplib.REQUESTED_RANGE_NOT_SATISFIABLE:
+            # empty file
+            return 0
+        elif response.status == httplib.OK:
+            length = response.getheader('Content-Length')
+            if length is not None:
+                return int(length)
+        raise IOError("file size is unknown")
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += self.size
+        if offset < 0:
+            raise IOError("invalid offset")
+        if offset != self._pos:
+            self._open(offset)
+
+    def tell(self):
+        return self._pos
+
+    def _get_size(self):
+        if self._size is None:
+            self._size = self._request_size()
+        return self._size
+    size = property(_get_size)
+
+    def close(self):
+        self._close_response()
+
+    def __del__(self):
+        # a reader that is dropped unclosed must not keep its connection
+        self._close_response()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+
+class OfflineFile (pystringio.StringIO):
+    """
+    Node file kept in memory while offline
+
+    If on_close is given, the file is opened for writing at its end and
+    on_close(data) is called with the whole file when it is closed.
+    """
+
+    def __init__(self, data="", codec=None, on_close=None):
+        pystringio.StringIO.__init__(self, data)
+        self._codec = codec
+        self._on_close = on_close
+        if on_close:
+            self.seek(0, 2)
+
+    def write(self, data):
+        if self._codec:
+            data = data.encode(self._codec)
+        pystringio.StringIO.write(self, data)
+
+    def close(self):
+        if not self.closed and self._on_close:
+            self._on_close(self.getvalue())
+        pystringio.StringIO.close(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+
+class PrefetchCache (object):
+    """
+    Node attrs fetched ahead of being read
+
+    Attrs are used at most once, though get() can look at them before.
+    The oldest attrs are evicted once there are 'limit' of them, and attrs
+    older than 'ttl' seconds are not used.
+    """
+
+    def __init__(self, limit=PREFETCH_LIMIT, ttl=PREFETCH_TTL):
+        self._limit = limit
+        self._ttl = ttl
+        self._attrs = OrderedDict()
+        self._children = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._attrs)
+
+    def set(self, nodeid, attr):
+        with self._lock:
+            self._remove(nodeid)
+            self._attrs[nodeid] = (time.time(), attr)
+            for parentid in attr.get("parentids", ()):
+                self._children[parentid].add(nodeid)
+            while len(self._attrs) > self._limit:
+                self._remove(next(iter(self._attrs)))
+
+    def _remove(self, nodeid):
+        entry = self._attrs.pop(nodeid, None)
+        if entry is not None:
+            for parentid in entry[1].get("parentids", ()):
+                children = self._children.get(parentid)
+                if children is not None:
+                    children.discard(nodeid)
+                    if not children:
+                        del self._children[parentid]
+        return entry
+
+    def pop(self, nodeid, default=None):
+        """Returns and removes the attr of a node if it is still fresh"""
+        with self._lock:
+            entry = self._remove(nodeid)
+        if entry is None or time.time() - entry[0] > self._ttl:
+            return default
+        return entry[1]
+
+    def get(self, nodeid, default=None):
+        """Returns the attr of a node if it is still fresh"""
+        with self._lock:
+            entry = self._attrs.get(nodeid)
+        if entry is None or time.time() - entry[0] > self._ttl:
+            return default
+        return entry[1]
+
+    def has_children(self, nodeid):
+        """Returns True if fresh attrs of children of a node are kept"""
+        now = time.time()
+        with self._lock:
+            return any(now - self._attrs[childid][0] <= self._ttl
+                       for childid in self._children.get(nodeid, ()))
+
+    def clear(self):
+        with self._lock:
+            self._attrs.clear()
+            self._children.clear()
+
+
+def offline_fallback(offline_method):
+    """
+    Decorator for methods that fall back to 'offline_method' when the
+    connection is offline or the server cannot be reached
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kargs):
+            if self._online():
+                try:
+                    return func(self, *args, **kargs)
+                except NETWORK_ERRORS:
+                    if not self._go_offline():
+                        raise
+            return getattr(self, offline_method)(*args, **kargs)
+        return wrapper
+    return decorator
+
+
 class NoteBookConnectionHttp (NoteBookConnection):
+    """
+    Connection to a notebook served over HTTP
+
+    cache_file -- file of an on-disk cache of node attrs, directory
+                  listings and small files (None for no cache).  Cached
+                  responses are revalidated with their ETag before use.
+    cache      -- cache object to use instead of a cache file, with the
+                  interface of HttpCache
+    journal_dir -- directory of journals of writes made while offline
+                  (None for no offline mode).  Each notebook URL has its
+                  own journal file.
+    journal    -- journal object to use instead of a journal_dir, with the
+                  interface of WriteJournal
+    changes_interval -- minimum seconds between polls of the server's
+                  changes, which invalidate prefetched attrs.  Cached
+                  attrs revalidated within this time are also used by
+                  index queries without revalidating them again.
+
+    With a journal, the connection goes offline when the server cannot be
+    reached.  Reads are then served from the cache, and node creates and
+    updates and file writes are journaled until they can be replayed.
+    """
 
-    def __init__(self, version=2):
+    def __init__(self, version=2, prefetch_depth=PREFETCH_DEPTH,
+                 cache_file=None, cache=None, journal_dir=None, journal=None,
+                 changes_interval=CHANGES_INTERVAL):
         self._netloc = ""
         self._prefix = "/"
-        self._conn = None
+        self._pool = None
         self._title_cache = NodeTitleCache()
         self._version = version
+        self._prefetch_depth = prefetch_depth
+        self._prefetched = PrefetchCache()
+        # ETags of cached responses recently revalidated
+        self._validated = PrefetchCache(ttl=changes_interval or 0)
+        self._cache_file = cache_file
+        self._cache = cache
+        self._changes_seq = None
+        self._changes_interval = changes_interval
+        self._changes_time = 0
+        self._journal_dir = journal_dir
+        self._journal = journal
+        self._offline = False
+        self._retry_time = 0
+        self._replay_lock = threading.Lock()
 
     def connect(self, url):
         parts = urlparse.urlsplit(url)
@@ -114,28 +836,73 @@ class NoteBookConnectionHttp (NoteBookConnection):
         self._netloc = parts.netloc
         self._prefix = parts.path + 'nodes/'
         self._notebook_prefix = parts.path
-        self._conn = httplib.HTTPConnection(self._netloc)
+        self._pool = HttpConnectionPool(self._netloc)
         self._title_cache.clear()
-        #self._conn.set_debuglevel(1)
+        self._prefetched.clear()
+        self._validated.clear()
+        self._changes_seq = None
+        self._changes_time = 0
+
+        if self._cache_file and not self._cache:
+            try:
+                self._cache = HttpCache(self._cache_file)
+            except Exception:
+                # the notebook can still be used without a cache
+                keepnote.log_error()
+
+        if self._journal_dir and not self._journal:
+            name = hashlib.md5(url.encode("utf8")).hexdigest() + u".log"
+            self._journal = WriteJournal(os.path.join(self._journal_dir, name))
+        if self._journal and self._journal.has_entries():
+            # Replay earlier writes before anything else.
+            self._offline = True
+            self._retry_time = 0
 
     def close(self):
-        self._conn.close()
+        self._pool.close()
+        if self._cache and self._cache_file:
+            self._cache.close()
+            self._cache = None
 
     def save(self):
         # POST http://host/prefix/?save
 
         self._request(
             'POST', format_node_path(self._notebook_prefix) + "?save")
-        self._conn.getresponse()
-        pass
+
+    def is_thread_safe(self):
+        # requests are made with a pool of HTTP connections
+        return True
 
     def _request(self, action, url, body=None, headers={}):
-        try:
-            return self._conn.request(action, url, body, headers)
-        except httplib.ImproperConnectionState:
-            # restart connection
-            self._conn = httplib.HTTPConnection(self._netloc)
-            return self._request(action, url, body, headers)
+        return self._pool.request(action, url, body, headers)
+
+    def _cache_key(self, url):
+        return "http://%s%s" % (self._netloc, url)
+
+    def _get_cached(self, url):
+        """
+        GET a url, revalidating a cached copy of the response
+
+        Returns (status, body).
+        """
+        key = self._cache_key(url)
+        cached = self._cache.get(key) if self._cache else None
+        headers = {}
+        if cached:
+            headers['If-None-Match'] = cached[0]
+
+        result = self._request('GET', url, None, headers)
+        body = result.read()
+        if result.status == httplib.NOT_MODIFIED and cached:
+            self._validated.set(key, {'etag': cached[0]})
+            return httplib.OK, cached[1]
+
+        etag = result.getheader('ETag')
+        if self._cache and etag and result.status == httplib.OK:
+            self._cache.set(key, etag, body)
+            self._validated.set(key, {'etag': etag})
+        return result.status, body
 
     def load_data(self, stream):
         if self._version == 2:
@@ -157,12 +924,14 @@ class NoteBookConnectionHttp (NoteBookConnection):
 
     #===========================================
 
+    @offline_fallback('_create_node_offline')
     def create_node(self, nodeid, attr):
+        self._post_node(nodeid, attr)
 
+    def _post_node(self, nodeid, attr):
         body_content = self.dumps_data(attr).encode("utf8")
-        self._request('POST', format_node_path(self._prefix, nodeid),
-                      body_content)
-        result = self._conn.getresponse()
+        result = self._request(
+            'POST', format_node_path(self._prefix, nodeid), body_content)
         if result.status == httplib.FORBIDDEN:
             raise connlib.NodeExists()
         elif result.status != httplib.OK:
@@ -170,13 +939,32 @@ class NoteBookConnectionHttp (NoteBookConnection):
 
         self._title_cache.update_attr(attr)
 
+    @offline_fallback('_read_node_offline')
     def read_node(self, nodeid):
 
-        self._request('GET', format_node_path(self._prefix, nodeid))
-        result = self._conn.getresponse()
-        if result.status == httplib.OK:
+        # Prefetched attrs are only used once.
+        self._check_changes()
+        attr = self._prefetched.pop(nodeid, None)
+        if attr is not None:
+            return attr
+
+        url = format_node_path(self._prefix, nodeid)
+        if self._prefetch_depth and not (
+                self._cache and self._cache.get_etag(self._cache_key(url))) \
+                and not self._prefetched.has_children(nodeid):
+            # Fetch the node together with its descendants.  Cached nodes
+            # are only revalidated, since their children are too, and
+            # nodes whose children were prefetched are read alone.
+            self.prefetch(nodeid, self._prefetch_depth)
+            attr = self._prefetched.pop(nodeid, None)
+            if attr is None:
+                raise connlib.UnknownNode(nodeid)
+            return attr
+
+        status, body = self._get_cached(url)
+        if status == httplib.OK:
             try:
-                attr = self.load_data(result)
+                attr = self.loads_data(body)
                 self._title_cache.update_attr(attr)
                 return attr
             except Exception, e:
@@ -185,41 +973,59 @@ class NoteBookConnectionHttp (NoteBookConnection):
         else:
             raise connlib.UnknownNode(nodeid)
 
+    @offline_fallback('_update_node_offline')
     def update_node(self, nodeid, attr):
 
-        body_content = self.dumps_data(attr).encode("utf8")
-        self._request('PUT', format_node_path(self._prefix, nodeid),
-                      body_content)
-        result = self._conn.getresponse()
+        result = self._put_node(nodeid, attr)
         if result.status == httplib.NOT_FOUND:
             raise connlib.UnknownNode()
         elif result.status != httplib.OK:
             raise connlib.ConnectionError()
+        self._node_updated(nodeid, attr)
+
+    def _put_node(self, nodeid, attr, headers={}):
+        body_content = self.dumps_data(attr).encode("utf8")
+        return self._request(
+            'PUT', format_node_path(self._prefix, nodeid), body_content,
+            headers)
+
+    def _node_updated(self, nodeid, attr):
         self._title_cache.update_attr(attr)
+        self._prefetched.pop(nodeid, None)
+        if self._cache:
+            self._cache.remove(self._cache_key(
+                format_node_path(self._prefix, nodeid)))
 
+    @offline_fallback('_unavailable_offline')
     def delete_node(self, nodeid):
 
-        self._request('DELETE', format_node_path(self._prefix, nodeid))
-        result = self._conn.getresponse()
+        result = self._request(
+            'DELETE', format_node_path(self._prefix, nodeid))
         if result.status == httplib.NOT_FOUND:
             raise connlib.UnknownNode()
         elif result.status != httplib.OK:
             raise connlib.ConnectionError()
         self._title_cache.remove(nodeid)
+        self._prefetched.pop(nodeid, None)
+        if self._cache:
+            self._cache.remove(self._cache_key(
+                format_node_path(self._prefix, nodeid)))
 
+    @offline_fallback('_has_node_offline')
     def has_node(self, nodeid):
         """Returns True if node exists"""
 
         # HEAD nodeid/filename
-        self._request('HEAD', format_node_path(self._prefix, nodeid))
-        result = self._conn.getresponse()
+        result = self._request(
+            'HEAD', format_node_path(self._prefix, nodeid))
         return result.status == httplib.OK
 
+    @offline_fallback('_get_rootid_offline')
     def get_rootid(self):
         """Returns nodeid of notebook root node"""
         # GET /
-        self._request('GET', format_node_path(self._prefix))
-        result = self._conn.getresponse()
+        url = format_node_path(self._prefix)
+        result = self._request('GET', url)
 
         if result.status == httplib.NOT_FOUND:
             raise connlib.UnknownNode()
@@ -227,13 +1033,239 @@ class NoteBookConnectionHttp (NoteBookConnection):
             raise connlib.ConnectionError()
 
         # Currently only the first rootid is returned.
-        data = self.load_data(result)
+        body = result.read()
+        if self._cache and self._journal:
+            # keep the rootid for offline use
+            self._cache.set(self._cache_key(url), None, body)
+        data = self.loads_data(body)
         rootid = data['rootids'][0]
         return rootid
 
+    @offline_fallback('_read_nodes_offline')
+    def read_nodes(self, nodeids):
+        """
+        Read the attr of several nodes, using prefetched attrs first
+
+        Cached attrs are revalidated with their ETag in the same request.
+        """
+        self._check_changes()
+        attrs = [self._prefetched.pop(nodeid, None) for nodeid in nodeids]
+        missing = [i for i, attr in enumerate(attrs) if attr is None]
+        if missing:
+            ops = []
+            for i in missing:
+                etag = self._cache.get_etag(self._cache_key(format_node_path(
+                    self._prefix, nodeids[i]))) if self._cache else None
+                ops.append(("read_node", nodeids[i], etag) if etag
+                           else ("read_node", nodeids[i]))
+            results = self.batch(ops)
+            for i, attr in zip(missing, results):
+                if not isinstance(attr, Exception):
+                    attrs[i] = attr
+        return attrs
+
+    def read_tree(self, nodeid, depth=None, attrs=None):
+        """
+        Iterate through a node and its descendants in pre-order
+
+        Yields (nodeid, attr) for each node.
+        depth -- number of levels of descendants to fetch (None for all)
+        attrs -- list of attr keys to fetch (None for all)
+
+        The whole subtree is fetched with one request, which holds one of
+        the connection's HTTP connections until the iterator is exhausted
+        or closed.
+        """
+        # GET nodeid?tree&depth=N&attrs=key1,key2
+        query = "?tree"
+        if depth is not None:
+            query += "&depth=%d" % depth
+        if attrs:
+            query += "&attrs=" + urllib.quote(",".join(attrs))
+        url = format_node_path(self._prefix, nodeid) + query
+        with self._pool.urlopen('GET', url) as result:
+            if result.status == httplib.NOT_FOUND:
+                result.read()
+                raise connlib.UnknownNode(nodeid)
+            elif result.status != httplib.OK:
+                result.read()
+                raise connlib.ConnectionError("cannot read node tree")
+
+            for line in iter_lines(result):
+                if line:
+                    data = self.loads_data(line)
+                    self._title_cache.update_attr(data['attr'])
+                    if self._cache and not attrs and 'etag' in data:
+                        self._cache.set(self._cache_key(format_node_path(
+                            self._prefix, data['nodeid'])), data['etag'],
+                            self.dumps_data(data['attr']))
+                    yield data['nodeid'], data['attr']
+
+    def prefetch(self, nodeid, depth=PREFETCH_DEPTH):
+        """
+        Fetch the attr of a node and its descendants in one request
+
+        The next read_node() or read_nodes() of these nodes does not make
+        another request, unless the server reports a change to them.
+        """
+        # later changes must be reported
+        self._check_changes()
+        for nodeid2, attr in self.read_tree(nodeid, depth):
+            self._prefetched.set(nodeid2, attr)
+
+    def batch(self, ops):
+        """Perform several node operations with as few requests as possible"""
+        results = []
+        for i in xrange(0, len(ops), BATCH_SIZE):
+            results.extend(self._batch(ops[i:i+BATCH_SIZE]))
+        return results
+
+    def _batch(self, ops):
+
+        # POST nodes?batch
+        body_content = self.dumps_data([list(op) for op in ops]).encode("utf8")
+        result = self._request(
+            'POST', format_node_path(self._prefix[:-1]) + "?batch",
+            body_content)
+        if result.status != httplib.OK:
+            result.read()
+            raise connlib.ConnectionError("batch request failed")
+        try:
+            data = self.load_data(result)
+        except Exception, e:
+            raise connlib.ConnectionError(
+                "unexpected response '%s'" % str(e), e)
+
+        results = []
+        for op, item in zip(ops, data):
+            if op[0] in ('update_node', 'delete_node'):
+                self._prefetched.pop(op[1], None)
+            if 'error' in item:
+                error = connlib.BATCH_ERRORS.get(
+                    item['error'], connlib.ConnectionError)
+                results.append(error(item.get('message', '')))
+            elif op[0] == 'read_node':
+                results.append(self._batch_read_result(op, item))
+            else:
+                if op[0] == 'update_node':
+                    self._title_cache.update_attr(op[2])
+                    if self._cache:
+                        self._cache.remove(self._cache_key(
+                            format_node_path(self._prefix, op[1])))
+                results.append(item['result'])
+        return results
+
+    def _batch_read_result(self, op, item):
+        """Returns the attr of a batch read_node result"""
+        key = self._cache_key(format_node_path(self._prefix, op[1]))
+        if item.get('not_modified'):
+            cached = self._cache.get(key) if self._cache else None
+            if cached is None:
+                return connlib.ConnectionError(
+                    "cached node '%s' is missing" % op[1])
+            attr = self.loads_data(cached[1])
+        else:
+            attr = item['result']
+            if self._cache and 'etag' in item:
+                self._cache.set(key, item['etag'], self.dumps_data(attr))
+        self._title_cache.update_attr(attr)
+        return attr
+
+    #===============
+    # changes
+
+    def get_changes(self, since=None, wait=0):
+        """
+        Returns (seq, changes, complete) for changes made on the server
+
+        since -- seq number of the last change seen (None for none)
+        wait  -- seconds to wait for a change if there are none yet
+
+        Each change is a dict with keys 'seq', 'nodeid', 'kind' and, for
+        file changes, 'filename'.  If complete is False, changes were
+        missed and everything should be considered changed.
+        """
+        # GET changes?since=N&wait=T
+        query = "?wait=%d" % wait
+        if since is not None:
+            query += "&since=%d" % since
+        result = self._request(
+            'GET', format_node_path(self._notebook_prefix + "changes") + query)
+        if result.status != httplib.OK:
+            raise connlib.ConnectionError("cannot read changes")
+        try:
+            data = self.load_data(result)
+            return data['seq'], data['changes'], data['complete']
+        except Exception, e:
+            raise connlib.ConnectionError(
+                "unexpected response '%s'" % str(e), e)
+
+    def _check_changes(self):
+        """
+        Poll the server's changes if changes_interval has passed since the
+        last poll
+
+        Servers that do not log changes are not polled again.
+        """
+        if (self._changes_interval is None or
+                time.time() - self._changes_time < self._changes_interval):
+            return
+        self._changes_time = time.time()
+        try:
+            self.poll_changes()
+        except connlib.ConnectionError:
+            # server does not log changes
+            self._changes_interval = None
+
+    def poll_changes(self, wait=0):
+        """
+        Invalidate cached data changed on the server since the last poll
+
+        Returns the list of changes.  The first poll only records the
+        server's current seq number.
+        """
+        if self._changes_seq is None:
+            self._changes_seq, changes, complete = self.get_changes()
+            return []
+
+        seq, changes, complete = self.get_changes(self._changes_seq, wait)
+        self._changes_seq = seq
+        if not complete:
+            # Cached responses are still revalidated before use.
+            self._prefetched.clear()
+            self._title_cache.clear()
+            return changes
+
+        updated = []
+        for change in changes:
+            nodeid = change['nodeid']
+            self._prefetched.pop(nodeid, None)
+            if self._cache:
+                self._uncache(nodeid, change.get('filename'))
+            if change['kind'] == 'delete':
+                self._title_cache.remove(nodeid)
+            elif change['kind'] in ('create', 'update'):
+                updated.append(nodeid)
+
+        # Keep titles up to date.
+        if updated and self._title_cache.is_complete():
+            self.read_nodes(list(set(updated)))
+
+        return changes
+
+    def _uncache(self, nodeid, filename=None):
+        """Remove a node or file, and its directory listing, from the cache"""
+        self._cache.remove(self._cache_key(
+            format_node_path(self._prefix, nodeid, filename)))
+        if filename is not None:
+            dirname = filename[:filename.rstrip("/").rfind("/") + 1] or "/"
+            self._cache.remove(self._cache_key(
+                format_node_path(self._prefix, nodeid, dirname)))
+
     #===============
     # file API
 
+    @offline_fallback('_open_file_offline')
     def open_file(self, nodeid, filename, mode="r", codec=None):
         """Open a file contained within a node"""
 
@@ -241,78 +1273,50 @@ class NoteBookConnectionHttp (NoteBookConnection):
         # write: POST nodeid/file
         # append: POST nodeid/file?mode=a
 
-        class HttpFile (object):
-            def __init__(self, codec=None):
-                self.data = []
-                self.codec = codec
-
-            def write(self, data):
-                if codec:
-                    data = data.encode(codec)
-                self.data.append(data)
-
-            def close(self):
-                pass
-
-            def __enter__(self):
-                return self
-
-            def __exit__(self, type, value, tb):
-                self.close()
-
         # Cannot open directories.
         if filename.endswith("/"):
             raise connlib.FileError()
 
         if mode == "r":
-            self._request(
-                'GET', format_node_path(self._prefix, nodeid, filename))
-            result = self._conn.getresponse()
-            if result.status == httplib.OK:
-                stream = contextlib.closing(result)
-                stream.read = result.read
-                stream.close = result.close
-                return stream
-            else:
-                raise connlib.FileError()
-
-        elif mode == "w":
-            stream = HttpFile(codec)
-
-            def on_close():
-                body_content = "".join(stream.data)
-                self._request(
-                    'POST', format_node_path(self._prefix, nodeid, filename),
-                    body_content)
-                self._conn.getresponse()
-            stream.close = on_close
-            return stream
+            return HttpFileReader(
+                self._pool, format_node_path(self._prefix, nodeid, filename),
+                cache=self._cache)
+
+        fallback = None
+        if self._journal:
+            # Writers only reach the server once data is written, so they
+            # journal the file themselves if the server is down.
+            def fallback():
+                self._go_offline()
+                return self._open_file_offline(nodeid, filename, mode)
+
+        if mode == "w":
+            return HttpFileWriter(
+                self._pool, format_node_path(self._prefix, nodeid, filename),
+                codec, cache=self._cache, fallback=fallback)
 
         elif mode == "a":
-            stream = HttpFile(codec)
-
-            def on_close():
-                body_content = "".join(stream.data)
-                self._request(
-                    'POST', format_node_path(self._prefix, nodeid, filename) +
-                    "?mode=a", body_content)
-                self._conn.getresponse()
-            stream.close = on_close
-            return stream
+            return HttpFileWriter(
+                self._pool,
+                format_node_path(self._prefix, nodeid, filename) + "?mode=a",
+                codec, cache=self._cache, fallback=fallback)
 
         else:
             raise connlib.FileError("unknown mode '%s'" % mode)
 
+    @offline_fallback('_unavailable_offline')
     def delete_file(self, nodeid, filename):
         """Open a file contained within a node"""
 
         # DELETE nodeid/file
-        self._request(
-            'DELETE', format_node_path(self._prefix, nodeid, filename))
-        result = self._conn.getresponse()
+        url = format_node_path(self._prefix, nodeid, filename)
+        if self._cache:
+            self._cache.remove(self._cache_key(url))
+        result = self._request('DELETE', url)
         if result.status != httplib.OK:
             raise connlib.FileError()
 
+    @offline_fallback('_unavailable_offline')
     def create_dir(self, nodeid, filename):
 
         # Directories must end with "/"
@@ -320,12 +1324,12 @@ class NoteBookConnectionHttp (NoteBookConnection):
             raise connlib.FileError()
 
         # PUT nodeid/dir/
-        self._request(
+        result = self._request(
             'PUT', format_node_path(self._prefix, nodeid, filename))
-        result = self._conn.getresponse()
         if result.status != httplib.OK:
             raise connlib.FileError()
 
+    @offline_fallback('_list_dir_offline')
     def list_dir(self, nodeid, filename="/"):
         """
         List data files in node
@@ -335,15 +1339,14 @@ class NoteBookConnectionHttp (NoteBookConnection):
             raise connlib.FileError()
 
         # GET nodeid/dir/
-        self._request(
-            'GET', format_node_path(self._prefix, nodeid, filename))
-        result = self._conn.getresponse()
-        if result.status == httplib.OK:
+        status, body = self._get_cached(
+            format_node_path(self._prefix, nodeid, filename))
+        if status == httplib.OK:
             try:
                 if self._version == 1:
-                    return self.load_data(result)
+                    return self.loads_data(body)
                 else:
-                    data = self.load_data(result)
+                    data = self.loads_data(body)
                     return data['files']
             except Exception, e:
                 raise connlib.ConnectionError(
@@ -351,14 +1354,284 @@ class NoteBookConnectionHttp (NoteBookConnection):
         else:
             raise connlib.FileError("cannot list node")
 
+    @offline_fallback('_has_file_offline')
     def has_file(self, nodeid, filename):
 
         # HEAD nodeid/filename
-        self._request(
+        result = self._request(
             'HEAD', format_node_path(self._prefix, nodeid, filename))
-        result = self._conn.getresponse()
         return result.status == httplib.OK
 
+    #===============
+    # offline mode
+
+    def is_offline(self):
+        """Returns True if writes are being journaled"""
+        return self._offline
+
+    def set_offline(self):
+        """Work offline until the journal can be replayed"""
+        if self._journal is None:
+            raise connlib.ConnectionError("offline mode needs a journal")
+        self._go_offline()
+
+    def _online(self):
+        """Returns True if requests should be sent to the server"""
+        if self._offline and time.time() >= self._retry_time:
+            try:
+                self.replay()
+            except connlib.ConnectionError:
+                pass
+        return not self._offline
+
+    def _go_offline(self):
+        """Go offline if writes can be journaled, returning True if so"""
+        if self._journal is None:
+            return False
+        if not self._offline:
+            keepnote.log_message("cannot reach '%s', working offline\n" %
+                                 self._netloc)
+        self._offline = True
+        self._retry_time = time.time() + RETRY_INTERVAL
+        return True
+
+    def get_conflicts(self):
+        """Returns the journaled writes that conflicted on replay"""
+        return self._journal.get_conflicts() if self._journal else []
+
+    def replay(self):
+        """
+        Send the writes journaled while offline to the server
+
+        Writes are sent in order.  Every create is sent, but only the last
+        update of each node and the last write of each file.  A write
+        conflicts if the server's copy changed since the copy the write was
+        based on, or if a created node already exists, in which case the
+        later writes to that node conflict too.  Conflicting writes are not
+        applied, but kept in the journal's conflicts.  Returns the list of
+        conflicting writes.
+
+        Once all writes are sent, the connection is online again.  Raises
+        ConnectionError if the server cannot be reached.
+        """
+        if self._journal is None:
+            return []
+
+        with self._replay_lock:
+            entries = self._journal.get_entries()
+            last = dict((get_entry_key(entry), i)
+                        for i, entry in enumerate(entries))
+            conflicts = []
+            existing = set()
+            removed = 0
+            try:
+                for i, entry in enumerate(entries):
+                    if last[get_entry_key(entry)] != i:
+                        # superseded by a later write
+                        continue
+                    if (entry['nodeid'] in existing or
+                            not self._replay_entry(entry)):
+                        if entry['op'] == 'create_node':
+                            # the writes that follow were meant for our node
+                            existing.add(entry['nodeid'])
+                        self._journal.add_conflict(entry)
+                        conflicts.append(entry)
+                    self._journal.skip(i + 1 - removed)
+                    removed = i + 1
+            except NETWORK_ERRORS, e:
+                self._journal.compact()
+                self._go_offline()
+                raise connlib.ConnectionError("cannot reach server", e)
+
+            # also rewrites the journal without skip markers
+            self._journal.remove(len(entries) - removed)
+            self._offline = False
+
+        for entry in conflicts:
+            keepnote.log_message("write of %s conflicts with the server\n" %
+                                 repr(get_entry_key(entry)))
+        return conflicts
+
+    def _replay_entry(self, entry):
+        """Send a journaled write, returning False if it conflicts"""
+        nodeid = entry['nodeid']
+        headers = {'If-Match': entry['etag']} if entry.get('etag') else {}
+        conflicts = (httplib.PRECONDITION_FAILED, httplib.NOT_FOUND)
+
+        if entry['op'] == 'create_node':
+            try:
+                self._post_node(nodeid, entry['attr'])
+            except connlib.NodeExists:
+                return False
+
+        elif entry['op'] == 'update_node':
+            result = self._put_node(nodeid, entry['attr'], headers)
+            if result.status in conflicts:
+                return False
+            elif result.status != httplib.OK:
+                raise connlib.ConnectionError(
+                    "cannot update node '%s'" % nodeid)
+            self._node_updated(nodeid, entry['attr'])
+
+        elif entry['op'] == 'write_file':
+            url = format_node_path(self._prefix, nodeid, entry['filename'])
+            result = self._request(
+                'POST', url, base64.b64decode(entry['data']), headers)
+            if result.status in conflicts:
+                return False
+            elif result.status != httplib.OK:
+                raise connlib.FileError(
+                    "cannot write file '%s'" % entry['filename'])
+            if self._cache:
+                self._uncache(nodeid, entry['filename'])
+
+        return True
+
+    def _unavailable_offline(self, *args, **kargs):
+        raise connlib.ConnectionError("not available offline")
+
+    def _get_cached_body(self, url):
+        """Returns a cached response body without revalidating it"""
+        if self._cache:
+            cached = self._cache.get(self._cache_key(url))
+            if cached:
+                return cached[1]
+        return None
+
+    def _is_created_offline(self, nodeid):
+        return any(attr.get("nodeid") == nodeid
+                   for attr in self._journal.get_created_nodes())
+
+    def _create_node_offline(self, nodeid, attr):
+        if (self._journal.get_attr(nodeid) is not None or
+                self._get_cached_body(format_node_path(self._prefix, nodeid))):
+            raise connlib.NodeExists()
+        self._journal.append('create_node', nodeid, attr=attr)
+        self._title_cache.update_attr(attr)
+
+    def _update_node_offline(self, nodeid, attr):
+        url = format_node_path(self._prefix, nodeid)
+        if self._is_created_offline(nodeid):
+            etag = None
+        elif self._journal.get_attr(nodeid) is None and \
+                not self._get_cached_body(url):
+            raise connlib.ConnectionError(
+                "node '%s' is not available offline" % nodeid)
+        elif self._cache:
+            etag = self._cache.get_etag(self._cache_key(url))
+        else:
+            etag = None
+        self._journal.append('update_node', nodeid, attr=attr, etag=etag)
+        self._title_cache.update_attr(attr)
+        self._prefetched.pop(nodeid, None)
+
+    def _read_node_offline(self, nodeid):
+        attr = self._journal.get_attr(nodeid)
+        if attr is None:
+            body = self._get_cached_body(
+                format_node_path(self._prefix, nodeid))
+            if body is None:
+                raise connlib.ConnectionError(
+                    "node '%s' is not available offline" % nodeid)
+            attr = self.loads_data(body)
+
+        # Add the children created offline.
+        childids = [child["nodeid"] for child in
+                    self._journal.get_created_nodes()
+                    if nodeid in child.get("parentids", ())]
+        if childids:
+            attr = dict(attr)
+            attr["childrenids"] = list(attr.get("childrenids", [])) + [
+                childid for childid in childids
+                if childid not in attr.get("childrenids", [])]
+        return attr
+
+    def _read_nodes_offline(self, nodeids):
+        attrs = []
+        for nodeid in nodeids:
+            try:
+                attrs.append(self._read_node_offline(nodeid))
+            except connlib.ConnectionError:
+                attrs.append(None)
+        return attrs
+
+    def _has_node_offline(self, nodeid):
+        return (self._journal.get_attr(nodeid) is not None or
+                self._get_cached_body(
+                    format_node_path(self._prefix, nodeid)) is not None)
+
+    def _get_rootid_offline(self):
+        body = self._get_cached_body(format_node_path(self._prefix))
+        if body is None:
+            raise connlib.ConnectionError("rootid is not available offline")
+        return self.loads_data(body)['rootids'][0]
+
+    def _read_file_offline(self, nodeid, filename):
+        """Returns the contents of a node file, or None if unavailable"""
+        data = self._journal.get_file(nodeid, filename)
+        if data is None:
+            data = self._get_cached_body(
+                format_node_path(self._prefix, nodeid, filename))
+        return data
+
+    def _open_file_offline(self, nodeid, filename, mode="r", codec=None):
+        if filename.endswith("/"):
+            raise connlib.FileError()
+
+        def write(data):
+            etag = None
+            if self._cache and not self._is_created_offline(nodeid):
+                etag = self._cache.get_etag(self._cache_key(
+                    format_node_path(self._prefix, nodeid, filename)))
+            self._journal.append('write_file', nodeid, filename=filename,
+                                 data=data, etag=etag)
+
+        if mode == "w":
+            return OfflineFile("", codec, on_close=write)
+        elif mode not in ("r", "a"):
+            raise connlib.FileError("unknown mode '%s'" % mode)
+
+        data = self._read_file_offline(nodeid, filename)
+        if data is None:
+            raise connlib.FileError(
+                "file '%s' is not available offline" % filename)
+        if mode == "r":
+            return OfflineFile(data)
+        else:
+            return OfflineFile(data, codec, on_close=write)
+
+    def _list_dir_offline(self, nodeid, filename="/"):
+        if not filename.endswith("/"):
+            raise connlib.FileError()
+        body = self._get_cached_body(
+            format_node_path(self._prefix, nodeid, filename))
+        if body is None:
+            files = []
+        elif self._version == 1:
+            files = self.loads_data(body)
+        else:
+            files = self.loads_data(body)['files']
+
+        # Add the files written offline.
+        dirname = filename.lstrip("/")
+        for filename2 in self._journal.get_filenames(nodeid):
+            if filename2.startswith(dirname):
+                name = filename2[len(dirname):]
+                if "/" not in name and name not in files:
+                    files.append(name)
+        if body is None and not files:
+            raise connlib.FileError("cannot list node offline")
+        return files
+
+    def _has_file_offline(self, nodeid, filename):
+        if filename.endswith("/"):
+            try:
+                self._list_dir_offline(nodeid, filename)
+                return True
+            except connlib.FileError:
+                return False
+        return self._read_file_offline(nodeid, filename) is not None
+
     #---------------------------------
     # indexing/querying
 
@@ -366,10 +1639,9 @@ class NoteBookConnectionHttp (NoteBookConnection):
         # POST /?index
         # query plist encoded
         body_content = self.dumps_data(query).encode("utf8")
-        self._request(
+        result = self._request(
             'POST', format_node_path(self._notebook_prefix) + "?index",
             body_content)
-        result = self._conn.getresponse()
         if result.status == httplib.OK:
             try:
                 return self.load_data(result)
@@ -377,24 +1649,197 @@ class NoteBookConnectionHttp (NoteBookConnection):
                 raise connlib.ConnectionError(
                     "unexpected response '%s'" % str(e), e)
 
+    def search_titles(self, text, offset=0, limit=SEARCH_PAGE_SIZE):
+        """
+        Search node titles on the server
+
+        Returns (results, more) where results is a list of (nodeid, title)
+        for one page of ranked results, and more is True if there are
+        more results after it.
+        """
+        return self._search("titles", text, offset, limit)
+
+    def search_contents(self, text, offset=0, limit=SEARCH_PAGE_SIZE):
+        """
+        Search node contents on the server
+
+        Returns (results, more) like search_titles().
+        """
+        return self._search("search", text, offset, limit)
+
+    def _search(self, path, text, offset, limit):
+
+        # GET path?q=text&offset=N&limit=N
+        query = urllib.urlencode({
+            'q': text.encode("utf8"),
+            'offset': offset,
+            'limit': limit,
+        })
+        result = self._request(
+            'GET',
+            format_node_path(self._notebook_prefix + path) + "?" + query)
+        if result.status == httplib.NOT_FOUND:
+            raise NotImplementedError(path)
+        elif result.status != httplib.OK:
+            raise connlib.ConnectionError("search failed")
+        try:
+            data = self.load_data(result)
+            return ([tuple(item) for item in data['results']],
+                    data['more'])
+        except Exception, e:
+            raise connlib.ConnectionError(
+                "unexpected response '%s'" % str(e), e)
+
+    def _search_all(self, path, text, limit=None, offset=0):
+        """
+        Returns the results of a search, fetched a page at a time
+
+        Only the pages needed for 'limit' results after 'offset' are
+        fetched.
+        """
+        results = []
+        more = True
+        while more and (limit is None or len(results) < limit):
+            size = SEARCH_PAGE_SIZE
+            if limit is not None:
+                size = min(size, limit - len(results))
+            page, more = self._search(path, text, offset + len(results),
+                                      size)
+            results.extend(page)
+            if not page:
+                break
+        return results
+
+    def _search_title_cache(self, text):
+        """Search titles with a local copy of all titles"""
+        try:
+            self.poll_changes()
+        except connlib.ConnectionError:
+            # server does not log changes
+            pass
+        if not self._title_cache.is_complete():
+            result = self.index_raw(["search", "title", "%"])
+            for nodeid, title in result:
+                self._title_cache.add(nodeid, title)
+            self._title_cache.set_complete()
+
+        return list(self._title_cache.get(text))
+
     def index(self, query):
 
         if len(query) > 2 and query[:2] == ["search", "title"]:
-            if not self._title_cache.is_complete():
-                result = self.index_raw(["search", "title", "%"])
-                for nodeid, title in result:
-                    self._title_cache.add(nodeid, title)
-                self._title_cache.set_complete()
-
-            return list(self._title_cache.get(query[2]))
+            try:
+                return self._search_all("titles", *query[2:])
+            except NotImplementedError:
+                # older servers cannot search titles
+                return connlib.limit_results(
+                    self._search_title_cache(query[2]), *query[3:])
 
-        elif len(query) == 3 and query[0] == "get_attr" and query[2] == "icon":
-            # HACK: fetching icons is too slow right now
-            return None
+        elif len(query) == 2 and query[0] == "search_fulltext":
+            try:
+                return [nodeid for nodeid, title in
+                        self._search_all("search", query[1])]
+            except NotImplementedError:
+                return self.index_raw(query)
+
+        elif len(query) == 3 and query[0] == "get_attr":
+            attr = self._get_local_attr(query[1])
+            if attr is not None:
+                return attr.get(query[2])
+            return self.index_raw(query)
 
         else:
             return self.index_raw(query)
 
+    def get_file_hash(self, nodeid, filename):
+        """
+        Returns the SHA-1 hex digest of a node file's contents
+
+        The server hashes the file.  Older servers cannot, and the file is
+        downloaded to hash it, unless the cache has its hash from when
+        the file had the same ETag, which servers make from its size and
+        mtime.
+        """
+        digest = self.index(["file_hash", nodeid, filename])
+        if digest is not None:
+            return digest
+
+        url = format_node_path(self._prefix, nodeid, filename)
+        result = self._request(
+            'GET', url, None,
+            {'Range': 'bytes=0-0', 'Accept-Encoding': 'identity'})
+        if result.status == httplib.REQUESTED_RANGE_NOT_SATISFIABLE:
+            # empty file
+            return hashlib.sha1().hexdigest()
+        elif result.status not in (httplib.OK, httplib.PARTIAL_CONTENT):
+            raise connlib.UnknownFile("cannot hash file '%s'" % filename)
+        etag = result.getheader('ETag')
+        if self._cache and etag:
+            digest = self._cache.get_file_hash(self._cache_key(url), etag)
+            if digest is not None:
+                return digest
+
+        digest = NoteBookConnection.get_file_hash(self, nodeid, filename)
+        if self._cache and etag:
+            self._cache.set_file_hash(self._cache_key(url), etag, digest)
+        return digest
+
+    def get_file_signature(self, nodeid, filename,
+                           block_size=connlib.DELTA_BLOCK_SIZE):
+        """
+        Returns the block signature of a node file
+
+        Returns None if the server cannot patch files.
+        """
+        return self.index(["file_signature", nodeid, filename, block_size])
+
+    def patch_file(self, nodeid, filename, delta):
+        """
+        Write a node file from a delta of its current contents
+
+        The delta is applied by the server, so it must be made against a
+        signature from get_file_signature().
+        """
+        # POST nodeid/file?delta
+        stream = HttpFileWriter(
+            self._pool,
+            format_node_path(self._prefix, nodeid, filename) + "?delta",
+            cache=self._cache)
+        while True:
+            data = delta.read(FILE_CHUNK_SIZE)
+            if len(data) == 0:
+                break
+            stream.write(data)
+        stream.close()
+
+    def _get_local_attr(self, nodeid):
+        """
+        Returns the prefetched or cached attr of a node, or None
+
+        Prefetched attrs are left for the next read.  Cached attrs are
+        revalidated with their ETag, unless they were revalidated less
+        than changes_interval seconds ago.
+        """
+        self._check_changes()
+        attr = self._prefetched.get(nodeid)
+        if attr is not None or not self._cache:
+            return attr
+
+        key = self._cache_key(format_node_path(self._prefix, nodeid))
+        cached = self._cache.get(key)
+        if not cached:
+            return None
+        validated = self._validated.get(key)
+        if validated and validated['etag'] == cached[0]:
+            try:
+                return self.loads_data(cached[1])
+            except Exception:
+                pass
+        try:
+            return self.read_node(nodeid)
+        except connlib.UnknownNode:
+            return None
+
     def get_node_path(self, nodeid):
         return format_node_url(self._netloc, self._prefix, nodeid)
 
@@ -407,6 +1852,7 @@ class NodeTitleCache (object):
         self._titles = defaultdict(lambda: set())
         self._nodeids = {}
         self._complete = False
+        self._lock = threading.RLock()
 
     def is_complete(self):
         return self._complete
@@ -422,14 +1868,15 @@ class NodeTitleCache (object):
         if nodeid is None:
             return
 
-        # if nodeid is in cache, remove it
-        self.remove(nodeid)
+        with self._lock:
+            # if nodeid is in cache, remove it
+            self.remove(nodeid)
 
-        # if title is not present, do not cache anything
-        if title is None:
-            return
+            # if title is not present, do not cache anything
+            if title is None:
+                return
 
-        self.add(nodeid, title)
+            self.add(nodeid, title)
 
     def remove_attr(self, attr):
         nodeid = attr.get("nodeid", None)
@@ -441,27 +1888,32 @@ class NodeTitleCache (object):
         self.remove(nodeid)
 
     def add(self, nodeid, title):
-        self._titles[title.lower()].add(nodeid)
-        self._nodeids[nodeid] = title
+        with self._lock:
+            self._titles[title.lower()].add(nodeid)
+            self._nodeids[nodeid] = title
 
     def remove(self, nodeid):
-        # if nodeid is in cache, remove it
-        if nodeid in self._nodeids:
-            try:
-                old_title = self._nodeids[nodeid]
-                self._titles[old_title.lower()].remove(nodeid)
-                del self._nodeids[nodeid]
-            except:
-                pass
+        with self._lock:
+            # if nodeid is in cache, remove it
+            if nodeid in self._nodeids:
+                try:
+                    old_title = self._nodeids[nodeid]
+                    self._titles[old_title.lower()].remove(nodeid)
+                    del self._nodeids[nodeid]
+                except:
+                    pass
 
     def get(self, query):
         query = query.lower()
-        for title in self._titles.iterkeys():
-            if query in title:
-                for nodeid in self._titles[title]:
-                    yield (nodeid, self._nodeids[nodeid])
+        with self._lock:
+            results = [(nodeid, self._nodeids[nodeid])
+                       for title, nodeids in self._titles.iteritems()
+                       if query in title
+                       for nodeid in nodeids]
+        return iter(results)
 
     def clear(self):
-        self._titles.clear()
-        self._nodeids.clear()
-        self._complete = False
+        with self._lock:
+            self._titles.clear()
+            self._nodeids.clear()
+            self._complete = False
@@ -0,0 +1,206 @@
+"""
+
+    KeepNote
+
+    Local cache of responses for remote notebooks
+
+"""
+
+#
+#  KeepNote
+#  Copyright (c) 2008-2011 Matt Rasmussen
+#  Author: Matt Rasmussen <rasmus@alum.mit.edu>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+
+# python imports
+import os
+import sys
+import threading
+import time
+
+# import sqlite
+try:
+    import pysqlite2.dbapi2 as sqlite
+except Exception, e:
+    import sqlite3 as sqlite
+
+# keepnote imports
+import keepnote
+
+
+# Default maximum total size of cached bodies.
+CACHE_SIZE = 50 * 1024 * 1024
+
+# Version of the cache file schema.
+CACHE_VERSION = 3
+
+
+class HttpCache (object):
+    """
+    On-disk cache of HTTP response bodies and their ETags
+
+    Entries are keyed by URL and are revalidated with If-None-Match before
+    they are used.  When the bodies exceed max_size bytes, the least
+    recently used entries are evicted.
+
+    The cache also keeps the hashes of files, with the ETag of the file
+    that was hashed.
+    """
+
+    def __init__(self, filename, max_size=CACHE_SIZE):
+        self._filename = filename
+        self._max_size = max_size
+        self._size = 0
+        self._lock = threading.Lock()
+        self.con = None
+        self.open()
+
+    def open(self):
+        """Open the cache file, starting a new one if it is unreadable"""
+        dirname = os.path.dirname(self._filename)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        try:
+            self._connect()
+        except sqlite.DatabaseError, e:
+            # the cache only holds copies, so a corrupt file is discarded
+            keepnote.log_error(e, sys.exc_info()[2])
+            if self.con:
+                self.con.close()
+            os.remove(self._filename)
+            self._connect()
+
+    def _connect(self):
+        self.con = sqlite.connect(self._filename, check_same_thread=False)
+
+        # Losing the latest entries in a crash is harmless.
+        self.con.execute(u"PRAGMA synchronous=OFF;")
+
+        # Entries of older versions are simply dropped.
+        version = self.con.execute(u"PRAGMA user_version;").fetchone()[0]
+        if version != CACHE_VERSION:
+            self.con.execute(u"DROP TABLE IF EXISTS Responses;")
+            self.con.execute(u"DROP TABLE IF EXISTS FileHashes;")
+            self.con.execute(u"PRAGMA user_version=%d;" % CACHE_VERSION)
+        self.con.execute(u"""CREATE TABLE IF NOT EXISTS Responses
+                             (url TEXT PRIMARY KEY,
+                              etag TEXT,
+                              body BLOB,
+                              size INTEGER,
+                              atime REAL);""")
+        self.con.execute(u"""CREATE INDEX IF NOT EXISTS IdxResponsesAtime
+                             ON Responses (atime);""")
+        self.con.execute(u"""CREATE TABLE IF NOT EXISTS FileHashes
+                             (url TEXT PRIMARY KEY,
+                              etag TEXT,
+                              hash TEXT);""")
+        self.con.commit()
+        self._size = self.con.execute(
+            u"SELECT SUM(size) FROM Responses").fetchone()[0] or 0
+
+    def close(self):
+        with self._lock:
+            if self.con is not None:
+                self.con.close()
+                self.con = None
+
+    def get(self, url):
+        """Returns (etag, body) for a cached url or None"""
+        with self._lock:
+            row = self.con.execute(
+                u"SELECT etag, body FROM Responses WHERE url=?",
+                (url,)).fetchone()
+            if row is None:
+                return None
+            self.con.execute(u"UPDATE Responses SET atime=? WHERE url=?",
+                             (time.time(), url))
+            self.con.commit()
+        return row[0], str(row[1])
+
+    def get_etag(self, url):
+        """Returns the ETag of a cached url or None"""
+        with self._lock:
+            row = self.con.execute(
+                u"SELECT etag FROM Responses WHERE url=?", (url,)).fetchone()
+        return row[0] if row else None
+
+    def get_file_hash(self, url, etag):
+        """Returns the hash of a file if it was hashed at 'etag', or None"""
+        with self._lock:
+            row = self.con.execute(
+                u"SELECT hash FROM FileHashes WHERE url=? AND etag=?",
+                (url, etag)).fetchone()
+        return row[0] if row else None
+
+    def set_file_hash(self, url, etag, digest):
+        """Keep the hash of a file at 'etag'"""
+        with self._lock:
+            self.con.execute(u"INSERT OR REPLACE INTO FileHashes "
+                             u"VALUES (?, ?, ?)", (url, etag, digest))
+            self.con.commit()
+
+    def get_size(self):
+        """Returns the total size of cached bodies"""
+        return self._size
+
+    def set(self, url, etag, body):
+        """Cache the body of a url"""
+        if len(body) > self._max_size:
+            self.remove(url)
+            return
+        with self._lock:
+            self._remove(url)
+            self.con.execute(
+                u"INSERT INTO Responses VALUES (?, ?, ?, ?, ?)",
+                (url, etag, sqlite.Binary(body), len(body), time.time()))
+            self._size += len(body)
+            if self._size > self._max_size:
+                self._evict()
+            self.con.commit()
+
+    def _evict(self):
+        """Remove least recently used entries until the cache fits"""
+        rows = self.con.execute(
+            u"SELECT url, size FROM Responses ORDER BY atime")
+        urls = []
+        for url, size in rows:
+            if self._size <= self._max_size:
+                break
+            urls.append((url,))
+            self._size -= size
+        self.con.executemany(u"DELETE FROM Responses WHERE url=?", urls)
+
+    def _remove(self, url):
+        row = self.con.execute(
+            u"SELECT size FROM Responses WHERE url=?", (url,)).fetchone()
+        if row:
+            self.con.execute(u"DELETE FROM Responses WHERE url=?", (url,))
+            self._size -= row[0]
+
+    def remove(self, url):
+        """Remove a url from the cache"""
+        with self._lock:
+            self._remove(url)
+            self.con.commit()
+
+    def clear(self):
+        """Remove all entries"""
+        with self._lock:
+            self.con.execute(u"DELETE FROM Responses")
+            self.con.execute(u"DELETE FROM FileHashes")
+            self.con.commit()
+            self._size = 0
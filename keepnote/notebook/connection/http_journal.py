@@ -0,0 +1,207 @@
+"""
+
+    KeepNote
+
+    Journal of writes made to remote notebooks while offline
+
+"""
+
+#
+#  KeepNote
+#  Copyright (c) 2008-2011 Matt Rasmussen
+#  Author: Matt Rasmussen <rasmus@alum.mit.edu>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+
+# python imports
+import base64
+import json
+import os
+import threading
+
+# keepnote imports
+import keepnote
+
+
+# Suffix of the file keeping conflicting writes.
+CONFLICTS_SUFFIX = u".conflicts"
+
+
+def get_entry_key(entry):
+    """
+    Returns what a journal entry writes: ('create', nodeid) for creates,
+    ('node', nodeid) for updates and ('file', nodeid, filename) for file
+    writes
+
+    Creates have their own key, so that a later update does not supersede
+    the create of its node.
+    """
+    if entry['op'] == 'write_file':
+        return ('file', entry['nodeid'], entry['filename'])
+    elif entry['op'] == 'create_node':
+        return ('create', entry['nodeid'])
+    return ('node', entry['nodeid'])
+
+
+def read_entries(filename):
+    """
+    Read the entries of a journal file
+
+    A last line that was not completely written is ignored.  Skip markers
+    (see WriteJournal.skip()) drop the entries before them.
+    """
+    entries = []
+    if not os.path.exists(filename):
+        return entries
+    with open(filename, 'rb') as infile:
+        for line in infile:
+            if not line.endswith('\n'):
+                break
+            try:
+                entry = json.loads(line)
+            except ValueError, e:
+                keepnote.log_error(e)
+                break
+            if entry['op'] == 'skip':
+                entries = entries[entry['count']:]
+            else:
+                entries.append(entry)
+    return entries
+
+
+class WriteJournal (object):
+    """
+    Append-only log of notebook writes
+
+    Each entry is a dict with the 'op', which is 'create_node',
+    'update_node' or 'write_file', and the 'nodeid'.  Node writes have the
+    node 'attr' and file writes the 'filename' and the whole file 'data'.
+    'etag' is the ETag of the server's copy that the write was based on,
+    or None.  Entries are written to disk before append() returns.
+
+    Writes that conflict with the server's copy are moved to a second
+    file, so that they are not lost.
+    """
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._lock = threading.Lock()
+
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self._entries = read_entries(filename)
+        # Drop any partially written line.
+        self._rewrite()
+
+    def _write(self, filename, entries, mode):
+        with open(filename, mode) as out:
+            for entry in entries:
+                out.write(json.dumps(entry) + '\n')
+            out.flush()
+            os.fsync(out.fileno())
+
+    def _rewrite(self):
+        tmpfile = self._filename + u".tmp"
+        self._write(tmpfile, self._entries, 'wb')
+        if os.path.exists(self._filename) and os.name == 'nt':
+            os.remove(self._filename)
+        os.rename(tmpfile, self._filename)
+
+    def append(self, op, nodeid, attr=None, filename=None, data=None,
+               etag=None):
+        """Add a write to the journal"""
+        entry = {'op': op, 'nodeid': nodeid, 'etag': etag}
+        if attr is not None:
+            entry['attr'] = attr
+        if filename is not None:
+            entry['filename'] = filename
+            entry['data'] = base64.b64encode(data)
+        with self._lock:
+            self._write(self._filename, [entry], 'ab')
+            self._entries.append(entry)
+
+    def has_entries(self):
+        return bool(self._entries)
+
+    def get_entries(self):
+        """Returns the journal entries in the order they were written"""
+        with self._lock:
+            return list(self._entries)
+
+    def remove(self, count):
+        """Remove the first 'count' entries"""
+        with self._lock:
+            self._entries = self._entries[count:]
+            self._rewrite()
+
+    def skip(self, count):
+        """
+        Remove the first 'count' entries by appending a skip marker
+
+        Unlike remove(), the journal is not rewritten, so removing the
+        entries one at a time is cheap.  compact() drops the markers.
+        """
+        with self._lock:
+            self._write(self._filename, [{'op': 'skip', 'count': count}],
+                        'ab')
+            self._entries = self._entries[count:]
+
+    def compact(self):
+        """Rewrite the journal without skip markers"""
+        with self._lock:
+            self._rewrite()
+
+    def get_attr(self, nodeid):
+        """Returns the last attr written for a node, or None"""
+        with self._lock:
+            for entry in reversed(self._entries):
+                if entry['op'] != 'write_file' and entry['nodeid'] == nodeid:
+                    return entry['attr']
+        return None
+
+    def get_file(self, nodeid, filename):
+        """Returns the last data written to a node file, or None"""
+        with self._lock:
+            for entry in reversed(self._entries):
+                if (entry['op'] == 'write_file' and
+                        entry['nodeid'] == nodeid and
+                        entry['filename'] == filename):
+                    return base64.b64decode(entry['data'])
+        return None
+
+    def get_filenames(self, nodeid):
+        """Returns the names of files written to a node"""
+        with self._lock:
+            return sorted(set(entry['filename'] for entry in self._entries
+                              if entry['op'] == 'write_file' and
+                              entry['nodeid'] == nodeid))
+
+    def get_created_nodes(self):
+        """Returns the attrs of the nodes created in the journal"""
+        with self._lock:
+            nodeids = [entry['nodeid'] for entry in self._entries
+                       if entry['op'] == 'create_node']
+        return [self.get_attr(nodeid) for nodeid in nodeids]
+
+    def add_conflict(self, entry):
+        """Keep a write that conflicted with the server's copy"""
+        with self._lock:
+            self._write(self._filename + CONFLICTS_SUFFIX, [entry], 'ab')
+
+    def get_conflicts(self):
+        """Returns the writes that conflicted with the server's copy"""
+        with self._lock:
+            return read_entries(self._filename + CONFLICTS_SUFFIX)
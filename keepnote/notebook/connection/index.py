@@ -27,11 +27,12 @@
 
 # python imports
 from itertools import chain
+import uuid
 
-#try:
-#    import pysqlite2.dbapi2 as sqlite
-#except ImportError:
-#    pass
+try:
+    import pysqlite2.dbapi2 as sqlite
+except ImportError:
+    import sqlite3 as sqlite
 #sqlite.enable_shared_cache(True)
 #sqlite.threadsafety = 0
 
@@ -42,6 +43,9 @@ import keepnote.notebook
 
 NULL = object()
 
+# number of pages merged per fulltext maintenance step
+MERGE_PAGES = 16
+
 #=============================================================================
 
 
@@ -76,6 +80,31 @@ def read_data_as_plain_text(conn, nodeid):
         pass
 
 
+def nodeid_to_key(nodeid):
+    """
+    Returns the compact database key for a nodeid
+
+    Canonical UUID nodeids are stored as 16-byte BLOBs.  Any other nodeid
+    is stored unchanged as TEXT, which never compares equal to a BLOB.
+    """
+    try:
+        key = uuid.UUID(nodeid)
+    except (ValueError, TypeError, AttributeError):
+        return nodeid
+
+    if unicode(key) != nodeid:
+        # only canonical form can be restored by key_to_nodeid()
+        return nodeid
+    return sqlite.Binary(key.bytes)
+
+
+def key_to_nodeid(key):
+    """Returns the nodeid for a database key made by nodeid_to_key()"""
+    if isinstance(key, buffer):
+        return unicode(uuid.UUID(bytes=str(key)))
+    return key
+
+
 def test_fts3(cur, tmpname="fts3test"):
     """
     Returns True if fts3 extension is available
@@ -93,6 +122,20 @@ def test_fts3(cur, tmpname="fts3test"):
         return False
 
 
+def test_fts4(cur, tmpname="fts4test"):
+    """
+    Returns True if fts4 extension is available
+    """
+    try:
+        cur.execute(u"DROP TABLE IF EXISTS %s;" % tmpname)
+        cur.execute(
+            "CREATE VIRTUAL TABLE %s USING fts4(col TEXT);" % tmpname)
+        cur.execute("DROP TABLE %s;" % tmpname)
+        return True
+    except Exception:
+        return False
+
+
 #=============================================================================
 
 class AttrIndex (object):
@@ -102,7 +145,6 @@ class AttrIndex (object):
         self._name = name
         self._type = type
         self._table_name = "Attr_" + name
-        self._index_name = "IdxAttr_" + name + "_nodeid"
         self._index_value = index_value
         self._index_value_name = "IdxAttr_" + name + "_value"
 
@@ -115,14 +157,11 @@ class AttrIndex (object):
     def init(self, cur):
         """Initialize attribute index for database"""
 
+        # rows are keyed by node handle (see NodeIndex.get_handle)
         cur.execute(u"""CREATE TABLE IF NOT EXISTS %s
-                           (nodeid TEXT,
-                            value %s,
-                            UNIQUE(nodeid) ON CONFLICT REPLACE);
+                           (handle INTEGER PRIMARY KEY,
+                            value %s);
                         """ % (self._table_name, self._type))
-        cur.execute(u"""CREATE INDEX IF NOT EXISTS %s
-                           ON %s (nodeid);""" % (self._index_name,
-                                                 self._table_name))
 
         if self._index_value:
             cur.execute(u"""CREATE INDEX IF NOT EXISTS %s
@@ -132,20 +171,20 @@ class AttrIndex (object):
     def drop(self, cur):
         cur.execute(u"DROP TABLE IF EXISTS %s" % self._table_name)
 
-    def add_node(self, cur, nodeid, attr):
+    def add_node(self, cur, handle, attr):
         val = attr.get(self._name, NULL)
         if val is not NULL:
-            self.set(cur, nodeid, val)
+            self.set(cur, handle, val)
 
-    def remove_node(self, cur, nodeid):
+    def remove_node(self, cur, handle):
         """Remove node from index"""
-        cur.execute(u"DELETE FROM %s WHERE nodeid=?" % self._table_name,
-                    (nodeid,))
+        cur.execute(u"DELETE FROM %s WHERE handle=?" % self._table_name,
+                    (handle,))
 
-    def get(self, cur, nodeid):
+    def get(self, cur, handle):
         """Get information for a node from the index"""
-        cur.execute(u"""SELECT value FROM %s WHERE nodeid = ?""" %
-                    self._table_name, (nodeid,))
+        cur.execute(u"""SELECT value FROM %s WHERE handle = ?""" %
+                    self._table_name, (handle,))
         values = [row[0] for row in cur.fetchall()]
 
         # return value
@@ -154,12 +193,12 @@ class AttrIndex (object):
         else:
             return values[0]
 
-    def set(self, cur, nodeid, value):
+    def set(self, cur, handle, value):
         """Set the information for a node in the index"""
 
         # insert new row
-        cur.execute(u"""INSERT INTO %s VALUES (?, ?)""" % self._table_name,
-                    (nodeid, value))
+        cur.execute(u"""INSERT OR REPLACE INTO %s VALUES (?, ?)""" %
+                    self._table_name, (handle, value))
 
 
 class NodeIndex (object):
@@ -170,7 +209,9 @@ class NodeIndex (object):
     def __init__(self, conn):
         self._nconn = conn  # notebook connection
         self._attrs = {}    # attr indexes
+        self._handles = {}  # nodeid -> handle cache
         self._has_fulltext = False
+        self._fulltext_module = None
         self._use_fulltext = True
         self._open_node_fulltext = \
             lambda nodeid: read_data_as_plain_text(self._nconn, nodeid)
@@ -209,22 +250,76 @@ class NodeIndex (object):
     def has_attr(self, name):
         return name in self._attrs
 
+    #===============================
+    # node handles
+
+    def init_handles(self, cur):
+        """
+        Initialize the table mapping nodeids to integer handles
+
+        All other tables are keyed by handle, so each nodeid is stored
+        only once.
+        """
+        cur.execute(u"""CREATE TABLE IF NOT EXISTS NodeIds
+                       (handle INTEGER PRIMARY KEY,
+                        nodeid BLOB UNIQUE);""")
+
+    def drop_handles(self, cur):
+        cur.execute(u"DROP TABLE IF EXISTS NodeIds;")
+        self.clear_handles()
+
+    def clear_handles(self):
+        """Clear the in-memory handle cache"""
+        self._handles.clear()
+
+    def get_handle(self, cur, nodeid, create=False):
+        """
+        Returns the integer handle of a nodeid
+
+        Returns None if the nodeid has no handle and 'create' is False.
+        """
+        handle = self._handles.get(nodeid)
+        if handle is not None:
+            return handle
+
+        key = nodeid_to_key(nodeid)
+        cur.execute(u"SELECT handle FROM NodeIds WHERE nodeid=?", (key,))
+        row = cur.fetchone()
+        if row:
+            handle = row[0]
+        elif create:
+            cur.execute(u"INSERT INTO NodeIds (nodeid) VALUES (?)", (key,))
+            handle = cur.lastrowid
+        else:
+            return None
+
+        self._handles[nodeid] = handle
+        return handle
+
     #=============================
     # setup/drop attr tables
 
     def init_attrs(self, cur):
 
         # full text table
-        if test_fts3(cur):
-            # create fulltext table if it does not already exist
-            if not list(cur.execute(u"""SELECT 1 FROM sqlite_master
-                               WHERE name == 'fulltext';""")):
-                cur.execute(u"""CREATE VIRTUAL TABLE
-                            fulltext USING
-                            fts3(nodeid TEXT, content TEXT,
-                                 tokenize=porter);""")
+        # fts4 is preferred since it supports incremental merging
+        row = cur.execute(u"""SELECT sql FROM sqlite_master
+                              WHERE name == 'fulltext';""").fetchone()
+        if row:
+            self._fulltext_module = (
+                "fts4" if "fts4" in row[0].lower() else "fts3")
+            self._has_fulltext = True
+        elif test_fts3(cur):
+            # create fulltext table since it does not already exist
+            # docid is the node handle
+            self._fulltext_module = "fts4" if test_fts4(cur) else "fts3"
+            cur.execute(u"""CREATE VIRTUAL TABLE
+                        fulltext USING
+                        %s(content TEXT, tokenize=porter);""" %
+                        self._fulltext_module)
             self._has_fulltext = True
         else:
+            self._fulltext_module = None
             self._has_fulltext = False
 
         # TODO: make an Attr table
@@ -255,28 +350,37 @@ class NodeIndex (object):
 
     def add_node_attr(self, cur, nodeid, attr, fulltext=True):
 
+        handle = self.get_handle(cur, nodeid, create=True)
+
         # update attrs
         for attrindex in self._attrs.itervalues():
-            attrindex.add_node(cur, nodeid, attr)
+            attrindex.add_node(cur, handle, attr)
 
         # update fulltext
         if fulltext:
             infile = self._open_node_fulltext(nodeid)
-            self._index_node_text(cur, nodeid, attr, infile)
+            self._index_node_text(cur, handle, attr, infile)
 
     def remove_node_attr(self, cur, nodeid):
 
+        handle = self.get_handle(cur, nodeid)
+        if handle is None:
+            return
+
         # update attrs
         for attr in self._attrs.itervalues():
-            attr.remove_node(cur, nodeid)
+            attr.remove_node(cur, handle)
 
-        self._remove_text(cur, nodeid)
+        self._remove_text(cur, handle)
 
     def get_node_attr(self, cur, nodeid, key):
         """Query indexed attribute for a node"""
         attr = self._attrs.get(key, None)
         if attr:
-            return attr.get(cur, nodeid)
+            handle = self.get_handle(cur, nodeid)
+            if handle is None:
+                return None
+            return attr.get(cur, handle)
         else:
             return None
 
@@ -294,10 +398,15 @@ class NodeIndex (object):
             words = [x.lower() for x in text.strip().split()]
             return self.search_node_contents_manual(cur, words)
 
-        # search db with fts3
-        res = cur.execute("""SELECT nodeid FROM fulltext
-                             WHERE content MATCH ?;""", (text,))
-        return (row[0] for row in res)
+        # search db with fts3, ranking nodes by their number of hits
+        # (offsets() gives four numbers per hit)
+        res = cur.execute("""SELECT NodeIds.nodeid FROM fulltext
+                             JOIN NodeIds ON NodeIds.handle = fulltext.docid
+                             WHERE fulltext.content MATCH ?
+                             ORDER BY length(offsets(fulltext)) -
+                                 length(replace(offsets(fulltext), ' ', ''))
+                                 DESC, fulltext.docid;""", (text,))
+        return (key_to_nodeid(row[0]) for row in res)
 
     def search_node_contents_manual(self, cur, words):
         """Recursively search nodes under node for occurrence of words"""
@@ -323,8 +432,13 @@ class NodeIndex (object):
             children = self._nconn._list_children_nodeids(nodeid)
             stack.extend(children)
 
-    def search_node_titles(self, cur, query):
-        """Return nodeids of nodes with matching titles"""
+    def search_node_titles(self, cur, query, limit=None, offset=0):
+        """
+        Return (nodeid, title) of nodes with matching titles
+
+        At most 'limit' results are returned, after skipping the first
+        'offset'.
+        """
 
         # TODO: can this be generalized?
         # similar to get_node_attr(nodeid, attr)
@@ -332,39 +446,87 @@ class NodeIndex (object):
         if not self.has_attr("title"):
             return []
 
-        # order titles by exact matches and then alphabetically
+        # order titles by exact matches, prefix matches and then
+        # alphabetically
         cur.execute(
-            u"""SELECT nodeid, value FROM %s WHERE value LIKE ?
-                           ORDER BY value != ?, value """ %
+            u"""SELECT n.nodeid, t.value
+                FROM %s AS t JOIN NodeIds AS n ON n.handle = t.handle
+                WHERE t.value LIKE ?
+                ORDER BY t.value != ?, t.value NOT LIKE ?,
+                         t.value COLLATE NOCASE
+                LIMIT ? OFFSET ?""" %
             self.get_attr_index("title").get_table_name(),
-            (u"%" + query + u"%", query))
+            (u"%" + query + u"%", query, query + u"%",
+             -1 if limit is None else limit, offset))
+
+        return [(key_to_nodeid(key), title)
+                for key, title in cur.fetchall()]
+
+    def search_node_modified(self, cur, mtime):
+        """
+        Return (nodeid, modified_time) of nodes modified at or after 'mtime'
+
+        Nodes are ordered by modified_time.  Returns None if modified_time
+        is not indexed.
+        """
+        if not self.has_attr("modified_time"):
+            return None
+
+        cur.execute(
+            u"""SELECT n.nodeid, t.value
+                FROM %s AS t JOIN NodeIds AS n ON n.handle = t.handle
+                WHERE t.value >= ?
+                ORDER BY t.value""" %
+            self.get_attr_index("modified_time").get_table_name(),
+            (mtime,))
+
+        return [(key_to_nodeid(key), value)
+                for key, value in cur.fetchall()]
+
+    def merge_fulltext(self, cur, pages=MERGE_PAGES):
+        """
+        Perform one bounded merge step on the fulltext index
+
+        Returns True if more merging remains to be done.  fts3 tables
+        cannot merge incrementally and are optimized in a single step.
+        """
+        if not self._has_fulltext:
+            return False
+
+        if self._fulltext_module != "fts4":
+            cur.execute(u"INSERT INTO fulltext(fulltext) VALUES('optimize');")
+            return False
 
-        return list(cur.fetchall())
+        # a merge that changes fewer than two rows did no work
+        changes = cur.connection.total_changes
+        cur.execute(u"INSERT INTO fulltext(fulltext) VALUES(?);",
+                    (u"merge=%d,2" % pages,))
+        return cur.connection.total_changes - changes >= 2
 
     #=================================
     # helper functions
 
-    def _index_node_text(self, cur, nodeid, attr, infile):
+    def _index_node_text(self, cur, handle, attr, infile):
 
         text = attr.get("title", "") + "\n" + "".join(infile)
-        self._insert_text(cur, nodeid, text)
+        self._insert_text(cur, handle, text)
 
-    def _insert_text(self, cur, nodeid, text):
+    def _insert_text(self, cur, handle, text):
 
         if not self._has_fulltext:
             return
 
-        if list(cur.execute(u"SELECT 1 FROM fulltext WHERE nodeid = ?",
-                            (nodeid,))):
-            cur.execute(u"UPDATE fulltext SET content = ? WHERE nodeid = ?;",
-                        (text, nodeid))
+        if list(cur.execute(u"SELECT 1 FROM fulltext WHERE docid = ?",
+                            (handle,))):
+            cur.execute(u"UPDATE fulltext SET content = ? WHERE docid = ?;",
+                        (text, handle))
         else:
-            cur.execute(u"INSERT INTO fulltext VALUES (?, ?);",
-                        (nodeid, text))
+            cur.execute(u"INSERT INTO fulltext (docid, content) "
+                        u"VALUES (?, ?);", (handle, text))
 
-    def _remove_text(self, cur, nodeid):
+    def _remove_text(self, cur, handle):
 
         if not self._has_fulltext:
             return
 
-        cur.execute(u"DELETE FROM fulltext WHERE nodeid = ?", (nodeid,))
+        cur.execute(u"DELETE FROM fulltext WHERE docid = ?", (handle,))
@@ -206,20 +206,23 @@ class NoteBookConnectionMem (NoteBookConnection):
 
         # built-in queries
         # ["index_attr", key, (index_value)]
-        # ["search", "title", text]
+        # ["search", "title", text, (limit, (offset))]
         # ["search_fulltext", text]
         # ["has_fulltext"]
         # ["node_path", nodeid]
         # ["get_attr", nodeid, key]
+        # ["file_hash", nodeid, filename]
+        # ["file_signature", nodeid, filename, (block_size)]
 
         if query[0] == "index_attr":
             return
 
         elif query[0] == "search":
             assert query[1] == "title"
-            return [(nodeid, node.attr["title"])
-                    for nodeid, node in self._nodes.iteritems()
-                    if query[2] in node.attr.get("title", "")]
+            return connlib.limit_results(
+                [(nodeid, node.attr["title"])
+                 for nodeid, node in self._nodes.iteritems()
+                 if query[2] in node.attr.get("title", "")], *query[3:])
 
         elif query[0] == "search_fulltext":
             # TODO: could implement brute-force backup
@@ -245,6 +248,9 @@ class NoteBookConnectionMem (NoteBookConnection):
         elif query[0] == "get_attr":
             return self._nodes[query[1]][query[2]]
 
+        elif query[0] in ("file_hash", "file_signature"):
+            return NoteBookConnection.index(self, query)
+
         # FS-specific
         elif query[0] == "init":
             return
@@ -25,10 +25,44 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA.
 #
 
+# python imports
+from collections import defaultdict
+from collections import deque
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import types
 
+# keepnote imports
+import keepnote
+from keepnote.notebook.connection import FileError
 from keepnote.notebook.connection import NodeExists
 from keepnote.notebook.connection import path_join
 from keepnote.notebook.connection import UnknownNode
+from keepnote.notebook.connection.delta import \
+    DeltaTooLarge, read_delta_hash, write_delta
+from keepnote.notebook.connection.http_journal import read_entries
+
+
+# number of nodes read at once while looking for changes
+SYNC_BATCH_SIZE = 100
+
+# parallel syncing
+SYNC_WORKERS = 4                     # nodes synced at once
+SYNC_MAX_BYTES = 16 * 1024 * 1024    # bytes of files being copied at once
+
+# seconds between fsyncs of a sync checkpoint
+SYNC_CHECKPOINT_INTERVAL = 1.0
+
+# smallest file sent as a delta of the other side's copy
+SYNC_DELTA_MIN_SIZE = 1024 * 1024
+
+# largest fraction of a file sent as literal data in a delta
+SYNC_DELTA_MAX_LITERAL = 0.5
 
 
 #=============================================================================
@@ -83,8 +117,35 @@ def sync_node(nodeid, conn1, conn2, attr=None,
         on_conflict(nodeid, conn1, conn2, attr)
 
 
+def resume_node(nodeid, conn1, conn2, attr=None,
+                on_conflict=on_conflict_newer):
+    """
+    Sync a node whose earlier sync was interrupted
+
+    If 'conn2' already has the node as it is in 'conn1', its files may be
+    incomplete and are synced.  Otherwise the node is synced as usual.
+    """
+    if attr is None:
+        attr = conn1.read_node(nodeid)
+
+    try:
+        attr2 = conn2.read_node(nodeid)
+    except UnknownNode:
+        attr2 = None
+    if (attr2 is not None and
+            attr2.get("modified_time") == attr.get("modified_time")):
+        sync_files(conn1, nodeid, conn2, nodeid)
+    else:
+        sync_node(nodeid, conn1, conn2, attr, on_conflict)
+
+
 def sync_files(conn1, nodeid1, conn2, nodeid2, path1="/", path2="/"):
-    """Sync files from conn1.nodeid1 to conn2.nodeid2"""
+    """
+    Sync files from conn1.nodeid1 to conn2.nodeid2
+
+    Files whose contents already match, by SHA-1 hash, are not copied.
+    Large files that node2 already has are sent as deltas.
+    """
     files = list(conn1.list_dir(nodeid1, path1))
 
     # ensure target path exists
@@ -100,18 +161,35 @@ def sync_files(conn1, nodeid1, conn2, nodeid2, path1="/", path2="/"):
     # copy files from node1 to node2
     for f in files:
         file1 = f
-        file2 = path_join(path2, f[len(path1):])
+        # names listed in the root dir may lack the leading '/'
+        file2 = path_join(path2, f[len(path1):] if f.startswith(path1)
+                          else f)
 
         if f.endswith("/"):
             # recurse into directories
             sync_files(conn1, nodeid1, conn2, nodeid2, file1, file2)
             continue
 
-        copy_file(conn1, nodeid1, file1, conn2, nodeid2, file2)
+        # skip files that are already identical
+        exists = conn2.has_file(nodeid2, file2)
+        if (exists and conn1.get_file_hash(nodeid1, file1) ==
+                conn2.get_file_hash(nodeid2, file2)):
+            continue
 
+        copy_file(conn1, nodeid1, file1, conn2, nodeid2, file2,
+                  delta=exists)
 
-def copy_file(conn1, nodeid1, file1, conn2, nodeid2, file2):
-    """Copy a file from conn1.nodeid1.file1 to conn2.nodeid2.file2"""
+
+def copy_file(conn1, nodeid1, file1, conn2, nodeid2, file2, delta=False):
+    """
+    Copy a file from conn1.nodeid1.file1 to conn2.nodeid2.file2
+
+    With 'delta', a file of at least SYNC_DELTA_MIN_SIZE bytes is sent as
+    a delta of conn2's copy, if conn2 can patch files.
+    """
+    if delta and copy_file_delta(conn1, nodeid1, file1,
+                                 conn2, nodeid2, file2):
+        return
 
     stream1 = conn1.open_file(nodeid1, file1, "r")
     stream2 = conn2.open_file(nodeid2, file2, "w")
@@ -124,3 +202,595 @@ def copy_file(conn1, nodeid1, file1, conn2, nodeid2, file2):
 
     stream1.close()
     stream2.close()
+
+
+def copy_file_delta(conn1, nodeid1, file1, conn2, nodeid2, file2):
+    """
+    Copy a file as a delta of conn2's copy
+
+    Returns False if the file is too small, conn2 cannot patch it, or
+    more than SYNC_DELTA_MAX_LITERAL of it differs from conn2's copy.
+    """
+    stream1 = conn1.open_file(nodeid1, file1, "r")
+    try:
+        size = get_stream_size(stream1)
+        if size is not None and size < SYNC_DELTA_MIN_SIZE:
+            return False
+        signature = conn2.get_file_signature(nodeid2, file2)
+        if signature is None or signature["size"] < SYNC_DELTA_MIN_SIZE:
+            return False
+
+        if size is None:
+            size = signature["size"]
+        delta = tempfile.TemporaryFile()
+        try:
+            write_delta(delta, signature, stream1,
+                        max_literal=int(size * SYNC_DELTA_MAX_LITERAL))
+            delta.seek(0)
+            conn2.patch_file(nodeid2, file2, delta)
+        finally:
+            delta.close()
+    except DeltaTooLarge:
+        # most of the file changed; copying it is cheaper
+        return False
+    except FileError, e:
+        # e.g. conn2's copy changed; copy the whole file instead
+        keepnote.log_error(e)
+        return False
+    finally:
+        stream1.close()
+
+    return True
+
+
+#=============================================================================
+# tree syncing
+
+
+class SyncWatermarks (object):
+    """
+    Watermarks of the last sync from each peer
+
+    A watermark is the largest modified_time synced from a peer.  They are
+    kept in a JSON file, keyed by peer (e.g. its url) and, if given, by the
+    destination synced to.
+    """
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._watermarks = {}
+        if os.path.exists(filename):
+            with open(filename, 'rb') as infile:
+                self._watermarks = json.load(infile)
+
+    def _get_key(self, peer, dest):
+        if dest is None:
+            return peer
+        return u"%s\n%s" % (peer, dest)
+
+    def get(self, peer, dest=None):
+        """Returns the watermark of a peer, or None if never synced"""
+        return self._watermarks.get(self._get_key(peer, dest))
+
+    def get_checkpoint(self, peer, dest=None):
+        """
+        Returns the SyncCheckpoint of an unfinished sync from a peer
+
+        Syncs from the same peer to different destinations ('dest') have
+        their own checkpoints.
+        """
+        key = self._get_key(peer, dest)
+        return SyncCheckpoint(u"%s-%s.checkpoint" % (
+            self._filename, hashlib.md5(key.encode("utf8")).hexdigest()))
+
+    def set(self, peer, watermark, dest=None):
+        """Record the watermark of a peer"""
+        self._watermarks[self._get_key(peer, dest)] = watermark
+        self.save()
+
+    def save(self):
+        tmpfile = self._filename + u".tmp"
+        with open(tmpfile, 'wb') as out:
+            json.dump(self._watermarks, out)
+        if os.path.exists(self._filename) and os.name == 'nt':
+            os.remove(self._filename)
+        os.rename(tmpfile, self._filename)
+
+
+class SyncCheckpoint (object):
+    """
+    Journal of the progress of an unfinished sync
+
+    Nodes are recorded when their sync starts and when it is done, with
+    their modified_time.  Files are recorded with their hash once they are
+    written to the destination.  Entries are appended to a file of JSON
+    lines, which is fsynced at most every SYNC_CHECKPOINT_INTERVAL seconds,
+    so a crash loses at most the last entries.
+    """
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._lock = threading.Lock()
+        self._started = set()
+        self._nodes = {}   # nodeid -> modified_time
+        self._files = {}   # (nodeid, filename) -> hash
+        self._out = None
+        self._sync_time = 0
+
+        for entry in read_entries(filename):
+            self._add(entry)
+
+    def _add(self, entry):
+        if entry["op"] == "start":
+            self._started.add(entry["nodeid"])
+        elif entry["op"] == "node":
+            self._nodes[entry["nodeid"]] = entry["modified_time"]
+        elif entry["op"] == "file":
+            self._files[(entry["nodeid"], entry["filename"])] = entry["hash"]
+
+    def _append(self, entry):
+        with self._lock:
+            if self._out is None:
+                self._out = open(self._filename, 'ab')
+            self._out.write(json.dumps(entry) + '\n')
+            self._out.flush()
+            if time.time() - self._sync_time > SYNC_CHECKPOINT_INTERVAL:
+                os.fsync(self._out.fileno())
+                self._sync_time = time.time()
+            self._add(entry)
+
+    def has_entries(self):
+        return bool(self._started or self._nodes or self._files)
+
+    def start_node(self, nodeid):
+        self._append({"op": "start", "nodeid": nodeid})
+
+    def add_node(self, nodeid, modified_time):
+        self._append({"op": "node", "nodeid": nodeid,
+                      "modified_time": modified_time})
+
+    def add_file(self, nodeid, filename, digest):
+        self._append({"op": "file", "nodeid": nodeid, "filename": filename,
+                      "hash": digest})
+
+    def is_started(self, nodeid):
+        """Returns True if the sync of a node was started"""
+        return nodeid in self._started
+
+    def is_done(self, attr):
+        """Returns True if a node was synced and is unchanged since"""
+        mtime = self._nodes.get(attr["nodeid"], ())
+        return mtime == attr.get("modified_time")
+
+    def get_file_hash(self, nodeid, filename):
+        """Returns the hash of a file written by the sync, or None"""
+        return self._files.get((nodeid, filename))
+
+    def clear(self):
+        """Remove the checkpoint once the sync is finished"""
+        with self._lock:
+            self.close()
+            if os.path.exists(self._filename):
+                os.remove(self._filename)
+            self._started.clear()
+            self._nodes.clear()
+            self._files.clear()
+
+    def close(self):
+        if self._out:
+            self._out.close()
+            self._out = None
+
+
+def iter_tree_attrs(conn, batch_size=SYNC_BATCH_SIZE):
+    """Iterate the attrs of all nodes in 'conn', parents before children"""
+    queue = deque([conn.get_rootid()])
+    while queue:
+        nodeids = [queue.popleft()
+                   for i in xrange(min(batch_size, len(queue)))]
+        for attr in conn.read_nodes(nodeids):
+            if attr is None:
+                continue
+            yield attr
+            queue.extend(attr.get("childrenids", []))
+
+
+def order_parents_first(attrs):
+    """Order node attrs so that parents come before their children"""
+    nodes = dict((attr["nodeid"], attr) for attr in attrs)
+    seen = set()
+    ordered = []
+    for attr in attrs:
+        # collect the ancestors that are not yet ordered
+        chain = []
+        while attr is not None and attr["nodeid"] not in seen:
+            seen.add(attr["nodeid"])
+            chain.append(attr)
+            parentids = attr.get("parentids")
+            attr = nodes.get(parentids[0]) if parentids else None
+        ordered.extend(reversed(chain))
+    return ordered
+
+
+def get_changed_attrs(conn, since=None, batch_size=SYNC_BATCH_SIZE):
+    """
+    Returns the attrs of the nodes in 'conn' modified at or after 'since'
+
+    All nodes are returned if 'since' is None.  Parents come before their
+    children.  The index is used when it can answer the query, otherwise
+    every node is read.
+    """
+    changed = None
+    if since is not None:
+        changed = conn.index(["modified_since", since])
+
+    if changed is None:
+        return [attr for attr in iter_tree_attrs(conn, batch_size)
+                if since is None or attr.get("modified_time", 0) >= since]
+
+    nodeids = [nodeid for nodeid, mtime in changed]
+    attrs = []
+    for i in xrange(0, len(nodeids), batch_size):
+        attrs.extend(attr for attr in
+                     conn.read_nodes(nodeids[i:i+batch_size])
+                     if attr is not None)
+    return order_parents_first(attrs)
+
+
+class ByteBudget (object):
+    """
+    Limits the bytes of the files being copied at once
+
+    A file larger than the limit is only copied when no other file is.
+    """
+
+    def __init__(self, limit):
+        self._limit = limit
+        self._used = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, size):
+        """Wait until 'size' bytes are available and take them"""
+        size = min(size, self._limit)
+        with self._cond:
+            while self._used and self._used + size > self._limit:
+                self._cond.wait()
+            self._used += size
+        return size
+
+    def release(self, size):
+        with self._cond:
+            self._used -= size
+            self._cond.notify_all()
+
+    def get_used(self):
+        return self._used
+
+
+def get_stream_size(stream):
+    """Returns the size of a file stream, or None if it is not known"""
+    size = getattr(stream, "size", None)
+    if size is None:
+        try:
+            size = os.fstat(stream.fileno()).st_size
+        except Exception:
+            pass
+    return size
+
+
+class BudgetFile (object):
+    """File stream that holds its size in a ByteBudget until closed"""
+
+    def __init__(self, stream, budget, size):
+        self._stream = stream
+        self._budget = budget
+        self._size = size
+
+    def read(self, *args):
+        return self._stream.read(*args)
+
+    def close(self):
+        self._stream.close()
+        if self._budget:
+            self._budget.release(self._size)
+            self._budget = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+class CheckpointFile (object):
+    """File stream that records its hash in a SyncCheckpoint once written"""
+
+    def __init__(self, stream, checkpoint, nodeid, filename):
+        self._stream = stream
+        self._checkpoint = checkpoint
+        self._nodeid = nodeid
+        self._filename = filename
+        self._digest = hashlib.sha1()
+
+    def write(self, data):
+        self._digest.update(data)
+        self._stream.write(data)
+
+    def close(self):
+        self._stream.close()
+        if self._checkpoint:
+            self._checkpoint.add_file(self._nodeid, self._filename,
+                                      self._digest.hexdigest())
+            self._checkpoint = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+class SyncConnection (object):
+    """
+    Connection proxy shared by the workers of a sync
+
+    Calls are serialized unless the connection is thread safe.  Files
+    opened for reading hold their size in 'budget' until they are closed.
+    Files written or patched are recorded in 'checkpoint' (SyncCheckpoint),
+    and their recorded hashes are used instead of hashing them again.
+    """
+
+    def __init__(self, conn, budget=None, checkpoint=None):
+        self._conn = conn
+        self._budget = budget
+        self._checkpoint = checkpoint
+        self._lock = (None if conn.is_thread_safe()
+                      else threading.RLock())
+
+    def _call(self, func, *args, **kargs):
+        if self._lock is None:
+            return func(*args, **kargs)
+        with self._lock:
+            result = func(*args, **kargs)
+            if isinstance(result, types.GeneratorType):
+                # iterate generators while locked
+                result = list(result)
+            return result
+
+    def open_file(self, nodeid, filename, mode="r", codec=None):
+        stream = self._call(self._conn.open_file, nodeid, filename,
+                            mode, codec)
+        if mode == "w" and self._checkpoint:
+            return CheckpointFile(stream, self._checkpoint, nodeid, filename)
+        if mode != "r" or not self._budget:
+            return stream
+        size = get_stream_size(stream)
+        if size is None:
+            size = self._budget._limit
+        return BudgetFile(stream, self._budget, self._budget.acquire(size))
+
+    def patch_file(self, nodeid, filename, delta):
+        self._call(self._conn.patch_file, nodeid, filename, delta)
+        if self._checkpoint:
+            self._checkpoint.add_file(nodeid, filename,
+                                      read_delta_hash(delta))
+
+    def get_file_hash(self, nodeid, filename):
+        digest = None
+        if self._checkpoint:
+            digest = self._checkpoint.get_file_hash(nodeid, filename)
+        if digest is None:
+            digest = self._call(self._conn.get_file_hash, nodeid, filename)
+        return digest
+
+    def __getattr__(self, name):
+        attr = getattr(self._conn, name)
+        if not callable(attr):
+            return attr
+        return lambda *args, **kargs: self._call(attr, *args, **kargs)
+
+
+def sync_parallel(attrs, func, workers=SYNC_WORKERS, task=None):
+    """
+    Call func(attr) for each node attr with a pool of worker threads
+
+    A node is started only after its parent, if it is also in 'attrs', is
+    done.  No new nodes are started once 'task' is stopped or 'func'
+    raises an error, which is raised again once the workers finish.
+    Returns True if every node was done.
+    """
+    nodeids = set(attr["nodeid"] for attr in attrs)
+    children = defaultdict(list)
+    ready = deque()
+    for attr in attrs:
+        parentids = attr.get("parentids")
+        if parentids and parentids[0] in nodeids:
+            children[parentids[0]].append(attr)
+        else:
+            ready.append(attr)
+
+    cond = threading.Condition()
+    state = {"running": 0, "done": 0, "error": None}
+
+    def is_stopped():
+        return state["error"] is not None or (task and task.aborted())
+
+    def worker():
+        while True:
+            with cond:
+                while not ready and state["running"] and not is_stopped():
+                    cond.wait()
+                if not ready or is_stopped():
+                    cond.notify_all()
+                    return
+                attr = ready.popleft()
+                state["running"] += 1
+            if task:
+                task.set_message(("detail", attr.get("title", "")))
+
+            try:
+                func(attr)
+                error = None
+            except Exception:
+                error = sys.exc_info()
+
+            with cond:
+                state["running"] -= 1
+                if error:
+                    if state["error"] is None:
+                        state["error"] = error
+                else:
+                    state["done"] += 1
+                    ready.extend(children.pop(attr["nodeid"], []))
+                cond.notify_all()
+                done = state["done"]
+            if task:
+                task.set_percent(done / float(len(attrs)))
+
+    # the calling thread is one of the workers
+    threads = [threading.Thread(target=worker)
+               for i in xrange(max(workers, 1) - 1)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    worker()
+    for thread in threads:
+        thread.join()
+
+    error = state["error"]
+    if error:
+        raise error[0], error[1], error[2]
+    return state["done"] == len(attrs)
+
+
+def sync_deleted(deleted, conn2, task=None):
+    """
+    Delete the nodes of 'conn2' that were deleted in the other notebook
+
+    'deleted' is a list of (nodeid, deleted_time).  A node is kept if it
+    was modified after it was deleted, or has children that were not
+    deleted.  Returns the nodeids of the nodes kept.
+    """
+    nodeids = set(nodeid for nodeid, mtime in deleted)
+    kept = []
+    for nodeid, mtime in deleted:
+        try:
+            attr = conn2.read_node(nodeid)
+        except UnknownNode:
+            # never synced, or already deleted along with its parent
+            continue
+
+        if (attr.get("modified_time", 0) > mtime or
+                not nodeids.issuperset(attr.get("childrenids", []))):
+            kept.append(nodeid)
+            if task:
+                task.set_message(("detail", "kept changed note '%s'" %
+                                  attr.get("title", "")))
+            continue
+
+        if task:
+            task.set_message(("detail", "deleting '%s'" %
+                              attr.get("title", "")))
+        try:
+            conn2.delete_node(nodeid)
+        except UnknownNode:
+            pass
+    return kept
+
+
+def sync_tree(conn1, conn2, watermarks=None, peer=None,
+              on_conflict=on_conflict_newer, task=None,
+              workers=SYNC_WORKERS, max_bytes=SYNC_MAX_BYTES,
+              dest=None):
+    """
+    Sync the nodes of 'conn1' changed since the last sync to 'conn2'
+
+    'conn2' should hold a copy of the notebook in 'conn1'.  If 'watermarks'
+    (SyncWatermarks) is given, only nodes modified at or after the
+    watermark of 'peer' are synced and the watermark is advanced once the
+    sync completes.  Otherwise every node is synced.  Conflicts are
+    resolved by 'on_conflict' and progress is reported to 'task'.  If
+    'watermarks' is shared by syncs to several notebooks, 'dest' names
+    'conn2' (e.g. its url) and is part of the watermark's key.
+
+    Up to 'workers' nodes, with their files, are synced at once, and at
+    most 'max_bytes' of files are copied at once.  If 'task' is stopped,
+    nodes already started are finished and the watermark is not advanced.
+
+    With 'watermarks', progress is kept in the SyncCheckpoint of 'peer'
+    and 'dest' until the sync finishes.  A sync that was interrupted
+    resumes from it: nodes that were done and are unchanged are skipped,
+    and the files of nodes that were started are synced again, skipping
+    files already copied.
+
+    Nodes deleted from 'conn1' are then deleted from 'conn2' (see
+    sync_deleted()), if the index of 'conn1' records deletions.  Otherwise
+    deletions are not synced, which is reported to 'task' and the log.
+    Returns the new watermark.
+    """
+    since = watermarks.get(peer, dest) if watermarks else None
+
+    if task:
+        task.set_message(("text", "Finding changed notes..."))
+    attrs = get_changed_attrs(conn1, since)
+
+    if task:
+        task.set_message(("text", "Syncing %d notes..." % len(attrs)))
+    checkpoint = (watermarks.get_checkpoint(peer, dest)
+                  if watermarks else None)
+    if checkpoint:
+        todo = [attr for attr in attrs if not checkpoint.is_done(attr)]
+    else:
+        todo = attrs
+
+    budget = ByteBudget(max_bytes)
+    conn1 = SyncConnection(conn1, budget)
+    conn2 = SyncConnection(conn2, checkpoint=checkpoint)
+
+    def sync(attr):
+        nodeid = attr["nodeid"]
+        if checkpoint:
+            if checkpoint.is_started(nodeid):
+                resume_node(nodeid, conn1, conn2, attr, on_conflict)
+            else:
+                checkpoint.start_node(nodeid)
+                sync_node(nodeid, conn1, conn2, attr, on_conflict)
+            checkpoint.add_node(nodeid, attr.get("modified_time"))
+        else:
+            sync_node(nodeid, conn1, conn2, attr, on_conflict)
+
+    try:
+        if not sync_parallel(todo, sync, workers, task):
+            return since
+    finally:
+        if checkpoint:
+            checkpoint.close()
+
+    deleted = conn1.index(["deleted_since", since])
+    if deleted is None:
+        message = "deleted notes were not synced"
+        keepnote.log_message(message + "\n")
+        if task:
+            task.set_message(("text", message))
+    elif deleted:
+        if task:
+            task.set_message(("text", "Deleting %d notes..." % len(deleted)))
+        sync_deleted(deleted, conn2, task)
+
+    watermark = since
+    for attr in attrs:
+        mtime = attr.get("modified_time")
+        if mtime is not None and (watermark is None or mtime > watermark):
+            watermark = mtime
+
+    if watermarks is not None and watermark is not None:
+        watermarks.set(peer, watermark, dest)
+    if checkpoint:
+        checkpoint.clear()
+    return watermark
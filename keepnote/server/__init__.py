@@ -26,14 +26,35 @@
 #
 
 # python imports
+from collections import OrderedDict
+from collections import deque
 from cStringIO import StringIO
+from itertools import islice
 from httplib import BAD_REQUEST
 from httplib import FORBIDDEN
 from httplib import NOT_FOUND
+from httplib import NOT_MODIFIED
+from httplib import PARTIAL_CONTENT
+from httplib import PRECONDITION_FAILED
+from httplib import REQUESTED_RANGE_NOT_SATISFIABLE
+import bisect
+import contextlib
+import hashlib
 import json
 import mimetypes
 import os
+import Queue
+import re
+import select
+import socket
+import tempfile
+import threading
+import time
 import urllib
+from wsgiref.simple_server import ServerHandler
+from wsgiref.simple_server import WSGIRequestHandler
+from wsgiref.simple_server import WSGIServer
+import zlib
 
 # bottle imports
 from . import bottle
@@ -46,14 +67,77 @@ from .bottle import template
 
 # keepnote imports
 import keepnote
+from keepnote.notebook import PREF_FILE
 from keepnote.notebook import new_nodeid
 import keepnote.notebook.connection as connlib
+from keepnote.notebook.connection.fs import NoteBookConnectionFS
+from keepnote.notebook.connection.fs.paths import NODE_META_FILE
 
 # Server directories.
 BASE_DIR = os.path.dirname(__file__)
 STATIC_DIR = os.path.join(BASE_DIR, 'static')
 TEMPLATES_DIR = os.path.join(BASE_DIR, 'templates')
 
+# Maximum number of operations in one batch request.
+MAX_BATCH_SIZE = 1000
+
+# Minimum and maximum number of arguments of each batch operation.
+# read_node may also be given the ETag of a cached copy.
+BATCH_ARGS = {
+    'read_node': (1, 2),
+    'update_node': (2, 2),
+    'has_node': (1, 1),
+    'list_dir': (1, 2),
+    'has_file': (2, 2),
+}
+
+# Batch operations that change the notebook.
+BATCH_WRITES = set(['update_node'])
+
+# Default and maximum number of results in a page of search results.
+SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 1000
+
+# Size of chunks used to stream node files.
+FILE_CHUNK_SIZE = 64 * 1024
+
+# Default number of threads serving requests.
+WORKERS = 4
+
+# Time in seconds an idle HTTP/1.1 connection is kept open, and how often
+# it checks whether its worker is needed for other requests.
+KEEP_ALIVE_TIMEOUT = 5
+KEEP_ALIVE_POLL = 0.1
+
+# Number of recent changes kept in the change log.
+MAX_CHANGES = 10000
+
+# Maximum time in seconds a change request waits for new changes.
+MAX_CHANGES_WAIT = 30
+
+# Default maximum size in bytes of cached node responses.
+READ_CACHE_SIZE = 16 * 1024 * 1024
+
+# Default maximum number of hosted notebooks kept open.
+MAX_OPEN_NOTEBOOKS = 32
+
+# Smallest response body that is compressed.
+COMPRESS_MIN_SIZE = 1024
+
+# Content types that are already compressed.
+COMPRESSED_TYPES = (
+    'image/', 'audio/', 'video/',
+    'application/zip', 'application/gzip', 'application/x-gzip',
+    'application/x-bzip2', 'application/x-xz', 'application/x-rar',
+    'application/x-7z-compressed', 'application/pdf')
+
+# Upper bounds in seconds of the latency histogram buckets.
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+# Connection calls that are timed when metrics are enabled.
+METRICS_CALLS = ('read_node', 'open_file', 'index')
+
 
 #=============================================================================
 # Node URL scheme
@@ -80,11 +164,18 @@ def format_node_url(host, prefix, nodeid, filename=None, port=80):
 # Notebook HTTP Server
 
 
-def write_node_tree(out, conn, nodeid=None):
+def write_node_tree(out, conn, nodeid=None, nodeids=None):
+    """
+    Write a node and its descendants as nested HTML lists
+
+    nodeids -- if given, a list to which written nodeids are appended
+    """
     if not nodeid:
         nodeid = conn.get_rootid()
 
     attr = conn.read_node(nodeid)
+    if nodeids is not None:
+        nodeids.append(nodeid)
 
     # TODO: needs escape
     if attr.get("content_type", "") == "text/xhtml+xml":
@@ -101,70 +192,1203 @@ def write_node_tree(out, conn, nodeid=None):
 
     for childid in attr.get("childrenids", ()):
         out.write("<li>")
-        write_node_tree(out, conn, childid)
+        write_node_tree(out, conn, childid, nodeids)
         out.write("</li>")
 
     out.write("</ul>")
 
 
-class BaseNoteBookHttpServer(object):
+def get_stream_size(stream):
+    """Returns the size of a file stream, or None if it is unknown"""
+    try:
+        return os.fstat(stream.fileno()).st_size
+    except Exception:
+        pass
+    try:
+        pos = stream.tell()
+        stream.seek(0, 2)
+        size = stream.tell()
+        stream.seek(pos)
+        return size
+    except Exception:
+        return None
+
+
+def iter_stream(stream, offset=0, length=None, chunk_size=FILE_CHUNK_SIZE):
+    """
+    Iterate through chunks of a file stream and close it at the end
+
+    offset -- position of first byte
+    length -- number of bytes (None for the rest of the stream)
+    """
+    try:
+        if offset:
+            try:
+                stream.seek(offset)
+            except Exception:
+                # skip over unseekable streams
+                while offset > 0:
+                    data = stream.read(min(offset, chunk_size))
+                    if not data:
+                        return
+                    offset -= len(data)
+
+        while length is None or length > 0:
+            data = stream.read(chunk_size if length is None
+                               else min(length, chunk_size))
+            if not data:
+                break
+            if length is not None:
+                length -= len(data)
+            yield data
+    finally:
+        stream.close()
+
+
+def iter_request_body(chunk_size=FILE_CHUNK_SIZE):
+    """
+    Iterate through the request body in chunks without buffering it
+
+    Both Content-Length and chunked transfer encoded bodies are supported.
+    """
+    read = request.environ['wsgi.input'].read
+    if request.chunked:
+        return request._iter_chunked(read, chunk_size)
+    else:
+        return request._iter_body(read, chunk_size)
+
+
+def spool_request_body():
+    """
+    Returns the request body in a temporary file
+
+    Views spool the body before they lock the connection, so that a slow
+    client does not hold the lock while its body arrives.
+    """
+    body = tempfile.TemporaryFile()
+    try:
+        for data in iter_request_body():
+            body.write(data)
+        body.seek(0)
+    except:
+        body.close()
+        raise
+    return body
+
+
+def copy_body(body, stream):
+    """
+    Copy a spooled request body into a writable file stream and close it
+
+    If the copy fails, written data is discarded when possible.
+    """
+    try:
+        while True:
+            data = body.read(FILE_CHUNK_SIZE)
+            if not data:
+                break
+            stream.write(data)
+    except:
+        connlib.discard_stream(stream)
+        raise
+    stream.close()
+
+
+def get_node_etag(attr):
+    """
+    Returns an ETag for node attr
+
+    The tag is a hash of the whole attr, since not every change to a node
+    updates its modified_time.
+    """
+    return '"%s"' % hashlib.md5(
+        json.dumps(attr, sort_keys=True)).hexdigest()
+
+
+def get_served_node_etag(attr):
+    """Returns the ETag of node attr as it is served by read_node"""
+    if attr.get("parentids") == [None]:
+        attr = dict(attr)
+        del attr["parentids"]
+    return get_node_etag(attr)
+
+
+def get_data_etag(data):
+    """Returns an ETag for a response body"""
+    return '"%s"' % hashlib.md5(data).hexdigest()
+
+
+def get_stream_etag(stream):
+    """
+    Returns an ETag for a file stream from its mtime and size, or None
+    if the stream is not a plain file
+    """
+    try:
+        stat = os.fstat(stream.fileno())
+    except Exception:
+        return None
+    return '"%x-%x"' % (int(stat.st_mtime * 1e6), stat.st_size)
+
+
+def match_etag(etag):
+    """
+    Set the ETag of the response and return True if the request's
+    If-None-Match header matches it
+    """
+    response.headers['ETag'] = etag
+    header = request.environ.get('HTTP_IF_NONE_MATCH')
+    if not header:
+        return False
+    tags = [tag.strip() for tag in header.split(',')]
+    return etag in tags or '*' in tags
+
+
+def check_if_match(get_etag):
+    """
+    Abort with 412 Precondition Failed if the request has an If-Match
+    header that does not match the current ETag
+
+    get_etag -- function returning the current ETag, or None if the
+                resource does not exist
+    """
+    header = request.environ.get('HTTP_IF_MATCH')
+    if not header:
+        return
+    etag = get_etag()
+    tags = [tag.strip() for tag in header.split(',')]
+    if etag is None or (etag not in tags and '*' not in tags):
+        abort(PRECONDITION_FAILED, 'resource has changed')
+
+
+def not_modified():
+    """Return an empty 304 Not Modified response"""
+    response.status = NOT_MODIFIED
+    return ""
+
+
+def get_moved_parentids(parentids, attr):
+    """
+    Returns the old and new parentids of a node updated with attr, or
+    None if the node did not move
+    """
+    if 'parentids' in attr and attr['parentids'] != parentids:
+        return (parentids or []) + (attr['parentids'] or [])
+    return None
+
+
+def get_node_stamp(conn, nodeid):
+    """
+    Returns a stamp of a node's files, which changes when the node is
+    modified outside of the server
+
+    The stamp is None for connections without node paths, and False if
+    the files cannot be read.
+    """
+    get_node_path = getattr(conn, 'get_node_path', None)
+    if get_node_path is None:
+        return None
+    try:
+        path = get_node_path(nodeid)
+        # The directory changes with children, the meta file with attr.
+        dirstat = os.stat(path)
+        stat = os.stat(os.path.join(path, NODE_META_FILE))
+    except Exception:
+        return False
+    return (dirstat.st_mtime, stat.st_mtime, stat.st_size)
+
+
+class ReadCache (object):
+    """
+    Size bounded LRU cache of node responses
+
+    Keys are (kind, nodeid) tuples.  Each value is stored with the stamps
+    of the nodes it was built from, so that it can be checked against
+    changes made outside of the server.
+    """
+
+    def __init__(self, max_size=READ_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns (value, stamps) for a key or None"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            self._entries[key] = entry
+            return entry[0], entry[1]
+
+    def get_size(self):
+        """Returns the total size of cached values"""
+        return self._size
+
+    def set(self, key, value, size, stamps):
+        """
+        Cache a value of a given size built from nodes with 'stamps',
+        a dict of nodeid to stamp
+        """
+        with self._lock:
+            self._remove(key)
+            if size > self.max_size:
+                return
+            self._entries[key] = (value, stamps, size)
+            self._size += size
+            while self._size > self.max_size:
+                key, entry = self._entries.popitem(last=False)
+                self._size -= entry[2]
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry[2]
+
+    def remove(self, key):
+        """Remove a key from the cache"""
+        with self._lock:
+            self._remove(key)
+
+    def clear(self, kind=None):
+        """Remove all keys, or all keys of a kind"""
+        with self._lock:
+            if kind is None:
+                self._entries.clear()
+                self._size = 0
+            else:
+                for key in [key for key in self._entries if key[0] == kind]:
+                    self._remove(key)
+
+
+def iter_node_tree(conn, nodeid=None, depth=None):
+    """
+    Iterate through a node and its descendants in pre-order
+
+    Yields (nodeid, level, attr) for each node.
+    depth -- number of levels of descendants to include (None for all)
+    """
+    if not nodeid:
+        nodeid = conn.get_rootid()
+
+    stack = [(nodeid, 0, conn.read_node(nodeid))]
+    while stack:
+        nodeid, level, attr = stack.pop()
+        yield nodeid, level, attr
+
+        if depth is None or level < depth:
+            childids = attr.get("childrenids", [])
+            children = [(childid, level + 1, child) for childid, child in
+                        zip(childids, conn.read_nodes(childids))
+                        if child is not None]
+            children.reverse()
+            stack.extend(children)
+
+
+class ReadWriteLock (object):
+    """
+    Lock that is shared by readers and exclusive for writers
+
+    Waiting writers are served before new readers.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    @contextlib.contextmanager
+    def reading(self):
+        with self._cond:
+            while self._writer or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def writing(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+class ChangeLog (object):
+    """
+    Log of recent changes to notebook nodes
+
+    Each change is a dict with a 'seq' number, which increases by one
+    with every change, the 'nodeid', the 'kind' of change ('create',
+    'update', 'delete' or 'file') and, for file changes, the 'filename'.
+    Only the last 'size' changes are kept.
+
+    Unless a 'seq' is given, a new log starts from the current time in
+    milliseconds.  A log made after a server restart then starts past the
+    seq numbers of the old one, and its clients see that they missed
+    changes instead of mistaking the new seq numbers for ones they know.
+    """
+
+    def __init__(self, size=MAX_CHANGES, seq=None):
+        self._changes = deque(maxlen=size)
+        self._seq = int(time.time() * 1000) if seq is None else seq
+        self._cond = threading.Condition(threading.Lock())
+
+    def get_seq(self):
+        """Returns the seq number of the last change"""
+        return self._seq
+
+    def add(self, nodeid, kind, filename=None):
+        """Record a change"""
+        with self._cond:
+            self._seq += 1
+            change = {'seq': self._seq, 'nodeid': nodeid, 'kind': kind}
+            if filename is not None:
+                change['filename'] = filename
+            self._changes.append(change)
+            self._cond.notify_all()
+
+    def get_changes(self, since, timeout=0):
+        """
+        Returns (seq, changes, complete) for the changes after 'since'
+
+        If there are none, wait up to 'timeout' seconds for a change.
+        complete is False if some of the changes are no longer in the log,
+        or if 'since' is not from this log.
+        """
+        with self._cond:
+            end = time.time() + timeout
+            while since == self._seq and timeout > 0:
+                remaining = end - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            if since > self._seq:
+                return self._seq, [], False
+            changes = [change for change in self._changes
+                       if change['seq'] > since]
+            first = changes[0]['seq'] if changes else self._seq + 1
+            return self._seq, changes, first == since + 1
+
+
+class ThreadPoolWSGIServer (WSGIServer):
+    """
+    WSGI server that handles requests with a fixed pool of threads
+
+    Accepted requests are queued until a worker is free.
+    """
+
+    workers = WORKERS
+
+    def __init__(self, *args, **kargs):
+        WSGIServer.__init__(self, *args, **kargs)
+        self._requests = Queue.Queue()
+        self._threads = []
+        for i in xrange(self.workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def process_request(self, request, client_address):
+        self._requests.put((request, client_address))
+
+    def is_busy(self):
+        """Returns True if requests are waiting for a free worker"""
+        return not self._requests.empty()
+
+    def _work(self):
+        while True:
+            item = self._requests.get()
+            if item is None:
+                break
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def serve_forever(self, poll_interval=0.5):
+        try:
+            WSGIServer.serve_forever(self, poll_interval)
+        finally:
+            for thread in self._threads:
+                self._requests.put(None)
+            self.server_close()
+
+    def shutdown(self):
+        """Stop the server and wait for requests in progress"""
+        WSGIServer.shutdown(self)
+        for thread in self._threads:
+            thread.join()
+
+
+class LimitedInput (object):
+    """Request input stream that stops at the end of the request body"""
+
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.stream.read(size) if size else ''
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.stream.readline(size) if size else ''
+        self.remaining -= len(data)
+        return data
+
+    def readlines(self, hint=None):
+        return list(self)
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+
+class KeepAliveServerHandler (ServerHandler):
+    """WSGI handler that answers in HTTP/1.1"""
+
+    http_version = '1.1'
+
+    def cleanup_headers(self):
+        ServerHandler.cleanup_headers(self)
+        if not self.request_handler.keep_alive(self.headers):
+            self.headers['Connection'] = 'close'
+
+
+class KeepAliveRequestHandler (WSGIRequestHandler):
+    """
+    WSGI request handler that keeps HTTP/1.1 connections open
+
+    A connection stays open after a response of known length to a request
+    whose body was read completely, and waits up to idle_timeout seconds
+    for the next request.  Other responses close the connection as in
+    HTTP/1.0.  Since an open connection holds a worker of the server, an
+    idle connection is closed as soon as other requests wait for a worker.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    idle_timeout = KEEP_ALIVE_TIMEOUT
+    quiet = False
+
+    def address_string(self):
+        # skip the reverse DNS lookup
+        return self.client_address[0]
+
+    def log_request(self, *args, **kargs):
+        if not self.quiet:
+            WSGIRequestHandler.log_request(self, *args, **kargs)
+
+    def handle(self):
+        self.close_connection = 1
+        self.handle_one_request()
+        while not self.close_connection and self.wait_for_request():
+            self.handle_one_request()
+
+    def handle_one_request(self):
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except socket.error:
+            # the client reset its connection
+            self.raw_requestline = ''
+        if not self.raw_requestline:
+            self.close_connection = 1
+            return
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            self.close_connection = 1
+            return
+        if not self.parse_request():
+            self.close_connection = 1
+            return
+
+        # The next request can only be read once this request's body has
+        # been.  Chunked bodies are not tracked.
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            length = 0
+            self.close_connection = 1
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            self.input = self.rfile
+            self.close_connection = 1
+        else:
+            self.input = LimitedInput(self.rfile, length)
+
+        handler = KeepAliveServerHandler(
+            self.input, self.wfile, self.get_stderr(), self.get_environ())
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+        if getattr(self.input, 'remaining', 0):
+            self.close_connection = 1
+
+    def keep_alive(self, headers):
+        """
+        Returns True if the connection stays open after a response with
+        the given headers
+        """
+        if ('Content-Length' not in headers or
+                getattr(self.input, 'remaining', 0)):
+            self.close_connection = 1
+        return not self.close_connection
+
+    def wait_for_request(self):
+        """
+        Wait for the next request on the connection
+
+        Returns False if the connection should be closed instead.
+        """
+        end = time.time() + self.idle_timeout
+        while not self.server.is_busy():
+            timeout = min(end - time.time(), KEEP_ALIVE_POLL)
+            if timeout <= 0:
+                break
+            try:
+                if select.select([self.connection], [], [], timeout)[0]:
+                    return True
+            except (select.error, socket.error):
+                break
+        return False
+
+
+def strip_etag_coding(etag):
+    """Remove the content coding suffix that compression adds to an ETag"""
+    return re.sub(r'-(gzip|deflate)"', '"', etag)
+
+
+def parse_accept_encoding(header):
+    """
+    Returns the preferred content coding of an Accept-Encoding header
+    among gzip and deflate, or None
+    """
+    codings = {}
+    for part in header.split(','):
+        params = part.strip().split(';')
+        coding = params[0].strip().lower()
+        quality = 1.0
+        for param in params[1:]:
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        codings[coding] = quality
+
+    best = None
+    for coding in ('gzip', 'deflate'):
+        quality = codings.get(coding, codings.get('*', 0.0))
+        if quality > 0 and (best is None or quality > best[1]):
+            best = (coding, quality)
+    return best[0] if best else None
+
+
+def iter_compressed(body, coding):
+    """Iterate through the compressed chunks of a response body"""
+    wbits = zlib.MAX_WBITS + 16 if coding == 'gzip' else zlib.MAX_WBITS
+    compressor = zlib.compressobj(6, zlib.DEFLATED, wbits)
+    try:
+        for data in body:
+            data = compressor.compress(data)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+
+
+class CompressionMiddleware (object):
+    """
+    WSGI middleware that compresses responses with gzip or deflate
+
+    The coding is chosen from the request's Accept-Encoding.  Responses
+    smaller than min_size, partial responses and already compressed
+    content types are sent as they are.  ETags of compressed responses get
+    a suffix for the coding, which is removed from If-None-Match.
+    """
+
+    def __init__(self, app, min_size=COMPRESS_MIN_SIZE):
+        self.app = app
+        self.min_size = min_size
+
+    def __call__(self, environ, start_response):
+        coding = parse_accept_encoding(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        if not coding or environ['REQUEST_METHOD'] == 'HEAD':
+            return self.app(environ, start_response)
+
+        for key in ('HTTP_IF_NONE_MATCH', 'HTTP_IF_MATCH'):
+            if key in environ:
+                environ[key] = strip_etag_coding(environ[key])
+
+        compress = []
+
+        def tag_etag(headers):
+            return [(key, value[:-1] + '-' + coding + '"'
+                     if key.lower() == 'etag' and value.endswith('"')
+                     else value)
+                    for key, value in headers]
+
+        def start_response2(status, headers, exc_info=None):
+            if self.should_compress(status, headers):
+                compress.append(True)
+                headers = tag_etag([(key, value) for key, value in headers
+                                    if key.lower() != 'content-length'])
+                headers.append(('Content-Encoding', coding))
+                headers.append(('Vary', 'Accept-Encoding'))
+            return start_response(status, headers, exc_info)
+
+        body = self.app(environ, start_response2)
+        if compress:
+            return iter_compressed(body, coding)
+        return body
+
+    def should_compress(self, status, headers):
+        if not status.startswith('200'):
+            return False
+        headers = dict((key.lower(), value) for key, value in headers)
+        if 'content-encoding' in headers:
+            return False
+        content_type = headers.get('content-type', '').lower()
+        if content_type.startswith(COMPRESSED_TYPES):
+            return False
+        length = headers.get('content-length')
+        if length is not None and int(length) < self.min_size:
+            return False
+        return True
+
+
+def format_metric_labels(labels):
+    """Returns the Prometheus label string of a list of (name, value)"""
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, unicode(value).replace('\\', '\\\\')
+                     .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels)
+
+
+class ServerMetrics (object):
+    """
+    Request and connection call statistics of a server
+
+    The statistics are written in the Prometheus text format by format().
+    """
+
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._requests = {}
+        self._durations = {}
+        self._bytes_in = {}
+        self._bytes_out = {}
+        self._calls = {}
+
+    def start_request(self):
+        """Record the start of a request"""
+        with self._lock:
+            self._in_flight += 1
+
+    def end_request(self, method, route, status, duration,
+                    bytes_in, bytes_out):
+        """Record the end of a request"""
+        key = (method, route)
+        with self._lock:
+            self._in_flight -= 1
+            self._requests[key + (status,)] = \
+                self._requests.get(key + (status,), 0) + 1
+            self._bytes_in[key] = self._bytes_in.get(key, 0) + bytes_in
+            self._bytes_out[key] = self._bytes_out.get(key, 0) + bytes_out
+            self._observe(self._durations, key, duration)
+
+    def add_call(self, name, duration):
+        """Record the duration of a connection call"""
+        with self._lock:
+            self._observe(self._calls, (name,), duration)
+
+    def _observe(self, histograms, key, value):
+        hist = histograms.get(key)
+        if hist is None:
+            # counts of each bucket and +Inf, then the sum
+            hist = histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        hist[bisect.bisect_left(self.buckets, value)] += 1
+        hist[-1] += value
+
+    def format(self):
+        """Returns the metrics in the Prometheus text format"""
+        lines = []
+
+        def write_metric(name, kind, text, values):
+            lines.append('# HELP %s %s' % (name, text))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, value in values:
+                lines.append('%s%s %d' % (
+                    name, format_metric_labels(labels), value))
+
+        def write_histogram(name, text, labelnames, histograms):
+            lines.append('# HELP %s %s' % (name, text))
+            lines.append('# TYPE %s histogram' % name)
+            bounds = [repr(bound) for bound in self.buckets] + ['+Inf']
+            for key, hist in sorted(histograms.items()):
+                labels = zip(labelnames, key)
+                count = 0
+                for bound, n in zip(bounds, hist):
+                    count += n
+                    lines.append('%s_bucket%s %d' % (
+                        name, format_metric_labels(labels + [('le', bound)]),
+                        count))
+                labels = format_metric_labels(labels)
+                lines.append('%s_sum%s %r' % (name, labels, hist[-1]))
+                lines.append('%s_count%s %d' % (name, labels, count))
+
+        with self._lock:
+            write_metric(
+                'keepnote_http_requests_in_flight', 'gauge',
+                'Number of requests being served.',
+                [([], self._in_flight)])
+            write_metric(
+                'keepnote_http_requests_total', 'counter',
+                'Number of finished requests.',
+                [(zip(('method', 'route', 'status'), key), value)
+                 for key, value in sorted(self._requests.items())])
+            write_histogram(
+                'keepnote_http_request_duration_seconds',
+                'Time to serve a request, including its body.',
+                ('method', 'route'), self._durations)
+            write_metric(
+                'keepnote_http_request_bytes_total', 'counter',
+                'Size of request bodies.',
+                [(zip(('method', 'route'), key), value)
+                 for key, value in sorted(self._bytes_in.items())])
+            write_metric(
+                'keepnote_http_response_bytes_total', 'counter',
+                'Size of response bodies as sent.',
+                [(zip(('method', 'route'), key), value)
+                 for key, value in sorted(self._bytes_out.items())])
+            write_histogram(
+                'keepnote_connection_call_duration_seconds',
+                'Time of notebook connection calls.',
+                ('call',), self._calls)
+
+        return '\n'.join(lines).encode('utf8') + '\n'
+
+
+class CountingInput (object):
+    """Request input stream that counts the bytes read from it"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.count = 0
+
+    def read(self, *args):
+        data = self.stream.read(*args)
+        self.count += len(data)
+        return data
+
+    def readline(self, *args):
+        data = self.stream.readline(*args)
+        self.count += len(data)
+        return data
+
+    def readlines(self, *args):
+        lines = self.stream.readlines(*args)
+        self.count += sum(len(line) for line in lines)
+        return lines
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+
+class MetricsMiddleware (object):
+    """
+    WSGI middleware that records request statistics in a ServerMetrics
+
+    Requests are labeled with the rule of their bottle route.  A request
+    ends once its whole response body has been sent.
+    """
+
+    def __init__(self, app, metrics):
+        self.app = app
+        self.metrics = metrics
+
+    def __call__(self, environ, start_response):
+        start = time.time()
+        self.metrics.start_request()
+        stream = environ['wsgi.input'] = CountingInput(environ['wsgi.input'])
+        status = ['500']
+
+        def start_response2(status_line, headers, exc_info=None):
+            status[0] = status_line.split(' ', 1)[0]
+            return start_response(status_line, headers, exc_info)
+
+        def end_request(bytes_out):
+            route = environ.get('bottle.route')
+            self.metrics.end_request(
+                environ['REQUEST_METHOD'],
+                route.rule if route else 'unmatched', status[0],
+                time.time() - start, stream.count, bytes_out)
+
+        try:
+            body = self.app(environ, start_response2)
+        except:
+            end_request(0)
+            raise
+        return self.iter_body(body, end_request)
+
+    def iter_body(self, body, end_request):
+        bytes_out = 0
+        try:
+            for data in body:
+                bytes_out += len(data)
+                yield data
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+            end_request(bytes_out)
+
+
+class MeteredConnection (object):
+    """
+    Notebook connection proxy that times some calls of a connection
+
+    Other attributes are those of the connection.
+    """
+
+    def __init__(self, conn, metrics, calls=METRICS_CALLS):
+        self._conn = conn
+        for name in calls:
+            setattr(self, name, self._time_call(
+                metrics, name, getattr(conn, name)))
 
-    def __init__(self, conn, host="", port=8000):
+    def _time_call(self, metrics, name, func):
+        def wrapper(*args, **kargs):
+            start = time.time()
+            try:
+                return func(*args, **kargs)
+            finally:
+                metrics.add_call(name, time.time() - start)
+        return wrapper
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class UnknownNoteBook (connlib.ConnectionError):
+    pass
+
+
+class HostedNoteBook (object):
+    """
+    A notebook connection with the server state kept for it
+
+    Each notebook has its own connection lock, change log and read cache.
+    """
+
+    def __init__(self, conn, cache_size=READ_CACHE_SIZE, seq=None):
         self.conn = conn
+        self.lock = ReadWriteLock()
+        self.changes = ChangeLog(seq=seq)
+        self.cache = ReadCache(cache_size) if cache_size else None
+        self.users = 0
+
+
+class NoteBookPool (object):
+    """
+    Notebooks of a directory, which are opened on first use
+
+    Each notebook is opened once and its connection, including its index,
+    is shared by all requests.  When more than max_open notebooks are
+    open, the least recently used notebooks that are not in use are
+    closed.  The seq numbers of their change logs are kept, so that
+    clients of a reopened notebook detect missed changes.
+    """
+
+    def __init__(self, path, open_conn, max_open=MAX_OPEN_NOTEBOOKS,
+                 cache_size=READ_CACHE_SIZE):
+        self.path = path
+        self.max_open = max_open
+        self._open_conn = open_conn
+        self._cache_size = cache_size
+        self._notebooks = OrderedDict()
+        self._opening = {}
+        self._seqs = {}
+        self._lock = threading.Lock()
+
+    def get_names(self):
+        """Returns the names of the notebooks in the directory"""
+        return sorted(name for name in os.listdir(self.path)
+                      if self._is_notebook(name))
+
+    def _is_notebook(self, name):
+        return (not name.startswith('.') and '/' not in name and
+                os.sep not in name and
+                os.path.isfile(os.path.join(self.path, name, PREF_FILE)))
+
+    def get_open_names(self):
+        """Returns the names of open notebooks, least recently used first"""
+        with self._lock:
+            return list(self._notebooks)
+
+    def acquire(self, name):
+        """
+        Returns an open notebook, which must be given back with release()
+
+        Raises UnknownNoteBook if there is no such notebook.  A notebook is
+        opened without holding the pool's lock, so that other notebooks
+        can be used meanwhile.  Requests for a notebook that is being
+        opened wait for it.
+        """
+        while True:
+            with self._lock:
+                notebook = self._notebooks.pop(name, None)
+                if notebook is not None:
+                    return self._use(name, notebook)
+                opening = self._opening.get(name)
+                if opening is None:
+                    if not self._is_notebook(name):
+                        raise UnknownNoteBook(name)
+                    opening = self._opening[name] = threading.Event()
+                    break
+            opening.wait()
+
+        try:
+            conn = self._open_conn(os.path.join(self.path, name))
+            with self._lock:
+                return self._use(name, HostedNoteBook(
+                    conn, self._cache_size, self._seqs.get(name)))
+        finally:
+            with self._lock:
+                del self._opening[name]
+            opening.set()
+
+    def _use(self, name, notebook):
+        self._notebooks[name] = notebook
+        notebook.users += 1
+        self._close_idle()
+        return notebook
+
+    def release(self, notebook):
+        """Give back a notebook from acquire()"""
+        with self._lock:
+            notebook.users -= 1
+            self._close_idle()
+
+    def _close_idle(self):
+        if len(self._notebooks) <= self.max_open:
+            return
+        for name, notebook in self._notebooks.items():
+            if notebook.users == 0:
+                self._close(name)
+                if len(self._notebooks) <= self.max_open:
+                    break
+
+    def _close(self, name):
+        notebook = self._notebooks.pop(name)
+        self._seqs[name] = notebook.changes.get_seq()
+        try:
+            notebook.conn.close()
+        except Exception, e:
+            keepnote.log_error(e)
+
+    def close(self):
+        """Close all notebooks"""
+        with self._lock:
+            for name in list(self._notebooks):
+                self._close(name)
+
+
+def iter_release(body, release):
+    """Iterate through a response body and call release() at its end"""
+    try:
+        for data in body:
+            yield data
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+        release()
+
+
+class BaseNoteBookHttpServer(object):
+    """
+    HTTP server for a notebook connection
+
+    workers  -- number of threads serving requests.  Requests that only
+                read the notebook run concurrently, while other requests
+                have exclusive access to the connection.  With more than
+                one worker, HTTP/1.1 connections are kept open between
+                requests.
+    compress -- if True, compress responses for clients that accept it
+    metrics  -- if True, collect request and connection statistics,
+                which are served at /metrics
+    cache_size -- maximum size in bytes of node attr and rendered tree
+                responses kept in memory for each notebook (0 to disable)
+    notebook_dir -- if given, the notebooks of this directory are served
+                at /notebooks/<name>/.  conn may then be None.
+    max_notebooks -- maximum number of notebooks of notebook_dir that are
+                kept open
+    """
+
+    def __init__(self, conn, host="", port=8000, workers=WORKERS,
+                 compress=True, metrics=False, cache_size=READ_CACHE_SIZE,
+                 notebook_dir=None, max_notebooks=MAX_OPEN_NOTEBOOKS):
+        self.metrics = ServerMetrics() if metrics else None
+        if conn is not None:
+            if self.metrics:
+                conn = MeteredConnection(conn, self.metrics)
+            self.notebook = HostedNoteBook(conn, cache_size)
+        else:
+            self.notebook = None
+        if notebook_dir is not None:
+            self.notebooks = NoteBookPool(
+                notebook_dir, self.open_conn, max_notebooks, cache_size)
+        else:
+            self.notebooks = None
+        self._local = threading.local()
         self.host = host
         self.port = port
-        self.notebook_prefixes = ['notebook/']
+        self.workers = workers
+        self.compress = compress
+        self.notebook_prefixes = []
 
         self.app = Bottle()
+        self.app.install(self.notebook_view)
+        self.app.install(self.lock_view)
         self.server = None
 
         # Setup web app routes.
         self.app.get('/', callback=self.home_view)
         self.app.get('/static/<filename:re:.*>',
                      callback=self.static_file_view)
+        if self.metrics:
+            self.app.get('/metrics', callback=self.metrics_view,
+                         skip=[self.lock_view])
+
+        # Notebook routes.
+        if self.notebook:
+            self.add_notebook_routes('notebook/')
+        if self.notebooks:
+            self.app.get('/notebooks/', callback=self.list_notebooks_view,
+                         skip=[self.lock_view])
+            self.add_notebook_routes('notebooks/<notebook:re:[^/]+>/')
+
+    def add_notebook_routes(self, prefix):
+        """Add the routes of the notebook API under a path prefix"""
+        self.notebook_prefixes.append(prefix)
+        prefix = '/' + prefix
+        nodes = prefix + 'nodes/'
+        node = nodes + '<nodeid:re:[^/]+>'
+        node_file = nodes + '<nodeid:re:[^/]*>/<filename:re:.*>'
 
         # Notebook node routes.
-        self.app.post('/notebook/',
-                      callback=self.command_view)
-        self.app.get('/notebook/nodes/',
-                     callback=self.read_root_view)
-        self.app.get('/notebook/nodes/<nodeid:re:[^/]+>',
-                     callback=self.read_node_view)
-        self.app.post('/notebook/nodes/',
-                      callback=self.create_node_view)
-        self.app.post('/notebook/nodes/<nodeid:re:[^/]+>',
-                      callback=self.create_node_view)
-        self.app.put('/notebook/nodes/<nodeid:re:[^/]+>',
-                     callback=self.update_node_view)
-        self.app.delete('/notebook/nodes/<nodeid:re:[^/]+>',
-                        callback=self.delete_node_view)
-        self.app.route('/notebook/nodes/<nodeid:re:[^/]+>', 'HEAD',
-                       callback=self.has_node_view)
+        self.app.post(prefix, callback=self.command_view)
+        self.app.post(prefix + 'nodes', callback=self.batch_view,
+                      skip=[self.lock_view])
+        self.app.get(prefix + 'changes',
+                     callback=self.changes_view, skip=[self.lock_view])
+        self.app.get(prefix + 'titles', callback=self.search_titles_view)
+        self.app.get(prefix + 'search', callback=self.search_contents_view)
+        self.app.get(nodes, callback=self.read_root_view)
+        self.app.get(node, callback=self.read_node_view)
+        self.app.post(nodes, callback=self.create_node_view)
+        self.app.post(node, callback=self.create_node_view)
+        self.app.put(node, callback=self.update_node_view)
+        self.app.delete(node, callback=self.delete_node_view)
+        self.app.route(node, 'HEAD', callback=self.has_node_view)
 
         # Notebook file routes.
-        self.app.get('/notebook/nodes/<nodeid:re:[^/]*>/<filename:re:.*>',
-                     callback=self.read_file_view)
-        self.app.post('/notebook/nodes/<nodeid:re:[^/]*>/<filename:re:.*>',
-                      callback=self.write_file_view)
-        self.app.put('/notebook/nodes/<nodeid:re:[^/]*>/<filename:re:.*>',
-                     callback=self.write_file_view)
-        self.app.delete('/notebook/nodes/<nodeid:re:[^/]*>/<filename:re:.*>',
-                        callback=self.delete_file_view)
-        self.app.route('/notebook/nodes/<nodeid:re:[^/]*>/<filename:re:.*>',
-                       'HEAD', callback=self.has_file_view)
-
-    def serve_forever(self, debug=False):
+        self.app.get(node_file, callback=self.read_file_view)
+        self.app.post(node_file, callback=self.write_file_view,
+                      skip=[self.lock_view])
+        self.app.put(node_file, callback=self.write_file_view,
+                     skip=[self.lock_view])
+        self.app.delete(node_file, callback=self.delete_file_view)
+        self.app.route(node_file, 'HEAD', callback=self.has_file_view)
+
+    def open_conn(self, path):
+        """Open the connection of a hosted notebook"""
+        conn = NoteBookConnectionFS()
+        conn.connect(path)
+        # let sync find changed nodes through the index
+        conn.index_attr("modified_time", "INTEGER", index_value=True)
+        if self.metrics:
+            conn = MeteredConnection(conn, self.metrics)
+        return conn
+
+    def get_current_notebook(self):
+        """Returns the notebook of the current request"""
+        return getattr(self._local, 'notebook', None) or self.notebook
+
+    # State of the current request's notebook.
+    conn = property(lambda self: self.get_current_notebook().conn)
+    lock = property(lambda self: self.get_current_notebook().lock)
+    changes = property(lambda self: self.get_current_notebook().changes)
+    cache = property(lambda self: self.get_current_notebook().cache)
+
+    def serve_forever(self, debug=False, quiet=False):
         """
         Run server.
+
+        quiet -- if True, do not log requests
         """
         if os.environ.get("KEEPNOTE_DEBUG"):
             debug = True
 
+        options = {}
+        if self.workers > 1:
+            # Connections are only kept alive with several workers, since
+            # an open connection holds its worker.
+            class Server (ThreadPoolWSGIServer):
+                pass
+
+            class Handler (KeepAliveRequestHandler):
+                pass
+            Server.workers = self.workers
+            Handler.quiet = quiet
+            options['server_class'] = Server
+            options['handler_class'] = Handler
+
         self.server = bottle.WSGIRefServer(
-            host=self.host, port=self.port, debug=debug)
-        self.app.run(
+            host=self.host, port=self.port, debug=debug, **options)
+        bottle.run(
+            app=self.get_wsgi_app(),
             host=self.host, port=self.port, server=self.server,
-            debug=debug, reloader=debug)
+            debug=debug, reloader=debug, quiet=quiet)
+
+    def get_wsgi_app(self):
+        """Returns the WSGI application of the server"""
+        app = self.app
+        if self.compress:
+            app = CompressionMiddleware(app)
+        if self.metrics:
+            app = MetricsMiddleware(app, self.metrics)
+        return app
 
     def shutdown(self):
         """
@@ -172,6 +1396,54 @@ class BaseNoteBookHttpServer(object):
         """
         if self.server:
             self.server.srv.shutdown()
+        if self.notebooks:
+            self.notebooks.close()
+
+    def notebook_view(self, callback):
+        """
+        Wrap a view with the hosted notebook named in its route
+
+        The notebook stays open until the response body has been sent.
+        """
+        def wrapper(*args, **kargs):
+            name = kargs.pop('notebook', None)
+            if name is None:
+                return callback(*args, **kargs)
+
+            try:
+                notebook = self.notebooks.acquire(urllib.unquote(name))
+            except UnknownNoteBook:
+                abort(NOT_FOUND, 'notebook not found')
+            release = True
+            self._local.notebook = notebook
+            try:
+                result = callback(*args, **kargs)
+                if hasattr(result, 'next') and not isinstance(result, file):
+                    release = False
+                    return iter_release(
+                        result, lambda: self.notebooks.release(notebook))
+                return result
+            finally:
+                self._local.notebook = None
+                if release:
+                    self.notebooks.release(notebook)
+        return wrapper
+
+    def lock_view(self, callback):
+        """
+        Wrap a view with the connection lock
+
+        GET and HEAD requests share the lock, other requests are exclusive.
+        Views that stream from the connection must lock it themselves.
+        """
+        def wrapper(*args, **kargs):
+            if request.method in ('GET', 'HEAD'):
+                lock = self.lock.reading()
+            else:
+                lock = self.lock.writing()
+            with lock:
+                return callback(*args, **kargs)
+        return wrapper
 
     def json_response(self, data):
         """
@@ -207,6 +1479,19 @@ class BaseNoteBookHttpServer(object):
 
             return self.json_response(result)
 
+    def list_notebooks_view(self):
+        """
+        List the hosted notebooks.
+        """
+        return self.json_response({'notebooks': self.notebooks.get_names()})
+
+    def metrics_view(self):
+        """
+        Return server statistics in the Prometheus text format.
+        """
+        response.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        return self.metrics.format()
+
     def read_root_view(self):
         """
         Return notebook root nodeid.
@@ -218,11 +1503,177 @@ class BaseNoteBookHttpServer(object):
         return self.json_response(result)
 
     def render_node_tree(self, nodeid):
+        key = ('tree', nodeid)
+        html = self.get_cached(key)
+        if html is not None:
+            return html
+
         body = StringIO()
+        nodeids = []
         body.write("<html><body>")
-        write_node_tree(body, self.conn, nodeid)
+        write_node_tree(body, self.conn, nodeid, nodeids)
         body.write("</body></html>")
-        return body.getvalue()
+        html = body.getvalue()
+
+        if self.cache:
+            self.set_cached(key, html, len(html), self.get_stamps(nodeids))
+        return html
+
+    def get_stamps(self, nodeids):
+        """
+        Returns a dict of the stamps of nodes, or None if a node's files
+        cannot be read
+        """
+        stamps = {}
+        for nodeid in nodeids:
+            stamp = get_node_stamp(self.conn, nodeid)
+            if stamp is False:
+                return None
+            stamps[nodeid] = stamp
+        return stamps
+
+    def get_cached(self, key):
+        """
+        Returns a cached value, or None if it is missing or one of its
+        nodes has changed on disk
+        """
+        if not self.cache:
+            return None
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        value, stamps = entry
+        for nodeid, stamp in stamps.iteritems():
+            if get_node_stamp(self.conn, nodeid) != stamp:
+                self.cache.remove(key)
+                return None
+        return value
+
+    def set_cached(self, key, value, size, stamps):
+        """Cache a value built from nodes with the given stamps"""
+        if stamps is not None:
+            self.cache.set(key, value, size, stamps)
+
+    def uncache_nodes(self, nodeids):
+        """Remove the cached responses of changed nodes"""
+        if self.cache:
+            for nodeid in nodeids:
+                self.cache.remove(('node', nodeid))
+            self.cache.clear('tree')
+
+    def changes_view(self):
+        """
+        List the changes made through the server.
+
+        Query parameters:
+          since -- seq number of the last change the client has seen.
+                   Without it, only the current seq number is returned.
+          wait  -- seconds to wait for a change if there are none yet
+
+        The response is {'seq': seq, 'changes': [change, ...],
+        'complete': bool}.  If complete is false, the client has missed
+        changes and must consider everything changed.
+        """
+        try:
+            since = request.query.get('since')
+            wait = min(float(request.query.get('wait', 0)),
+                       MAX_CHANGES_WAIT)
+            if since is not None:
+                since = int(since)
+        except ValueError:
+            abort(BAD_REQUEST, 'invalid changes request')
+
+        if since is None:
+            seq, changes, complete = self.changes.get_seq(), [], True
+        else:
+            seq, changes, complete = self.changes.get_changes(since, wait)
+        return self.json_response({
+            'seq': seq,
+            'changes': changes,
+            'complete': complete,
+        })
+
+    def get_search_query(self):
+        """Returns (text, offset, limit) of a search request"""
+        text = request.query.getunicode('q', default=u'')
+        try:
+            offset = int(request.query.get('offset', 0))
+            limit = int(request.query.get('limit', SEARCH_LIMIT))
+            if offset < 0 or limit < 1:
+                raise ValueError()
+        except ValueError:
+            abort(BAD_REQUEST, 'invalid search request')
+        return text, offset, min(limit, MAX_SEARCH_LIMIT)
+
+    def search_response(self, results, offset, limit, titles=False):
+        """
+        Return one page of search results
+
+        'results' are the results from 'offset' on.  If titles is True,
+        results are nodeids whose titles are added.
+        """
+        page = list(islice(results, limit + 1))
+        more = len(page) > limit
+        page = page[:limit]
+
+        if titles:
+            page = [[nodeid, attr.get('title', u'') if attr else u'']
+                    for nodeid, attr in zip(page, self.conn.read_nodes(page))]
+
+        return self.json_response({
+            'results': page,
+            'offset': offset,
+            'more': more,
+        })
+
+    def search_titles_view(self):
+        """
+        Search node titles.
+
+        Query parameters:
+          q      -- text contained in the titles
+          offset -- number of results to skip
+          limit  -- maximum number of results (default: 20)
+
+        The response is {'results': [[nodeid, title], ...], 'offset': offset,
+        'more': bool}, ranked by the connection's index.
+        """
+        text, offset, limit = self.get_search_query()
+        # one more result tells whether there are more
+        return self.search_response(
+            iter(self.conn.search_node_titles(text, limit + 1, offset)),
+            offset, limit)
+
+    def search_contents_view(self):
+        """
+        Search node contents.
+
+        The query parameters and response are the same as for title search.
+        """
+        text, offset, limit = self.get_search_query()
+        results = self.conn.search_node_contents(text)
+        try:
+            return self.search_response(
+                islice((nodeid for nodeid in results if nodeid is not None),
+                       offset, None),
+                offset, limit, titles=True)
+        finally:
+            if hasattr(results, 'close'):
+                results.close()
+
+    def add_node_change(self, nodeid, kind, parentids=None):
+        """Record a change to a node and its parents"""
+        parentids = [parentid for parentid in parentids or ()
+                     if parentid is not None]
+        self.uncache_nodes([nodeid] + parentids)
+        self.changes.add(nodeid, kind)
+        for parentid in parentids:
+            self.changes.add(parentid, 'update')
+
+    def add_file_change(self, nodeid, filename):
+        """Record a change to a node file"""
+        self.uncache_nodes([nodeid])
+        self.changes.add(nodeid, 'file', filename)
 
     def read_node_view(self, nodeid):
         """
@@ -235,18 +1686,188 @@ class BaseNoteBookHttpServer(object):
             response.content_type = 'text/html'
             return self.render_node_tree(nodeid)
 
+        if 'tree' in request.query:
+            return self.read_tree_view(nodeid)
+
+        key = ('node', nodeid)
+        cached = self.get_cached(key)
+        if cached is not None:
+            body, etag = cached
+            if match_etag(etag):
+                return not_modified()
+            response.content_type = 'application/json'
+            return body
+
         try:
             # return node attr
+            stamps = self.get_stamps([nodeid]) if self.cache else None
             attr = self.conn.read_node(nodeid)
             if attr.get("parentids") == [None]:
                 del attr["parentids"]
 
-            return self.json_response(attr)
+            etag = get_node_etag(attr)
+            body = self.json_response(attr)
+            if self.cache:
+                self.set_cached(key, (body, etag), len(body), stamps)
+            if match_etag(etag):
+                return not_modified()
+            return body
 
         except connlib.UnknownNode, e:
             keepnote.log_error()
             abort(NOT_FOUND, 'node not found ' + str(e))
 
+    def batch_view(self):
+        """
+        Perform several node operations in one request.
+
+        The body is a JSON list of operations [name, arg1, ...] and the
+        response lists {'result': value} or {'error': name, 'message': text}
+        for each operation.
+
+        read_node operations may give the ETag of a cached copy as a second
+        argument.  Their results include the node's 'etag' and, when it
+        matches, 'not_modified' instead of the attr.
+
+        A batch of reads only takes the shared lock.
+        """
+        if 'batch' not in request.query:
+            abort(BAD_REQUEST, 'unknown nodes request')
+
+        try:
+            ops = json.loads(request.body.read())
+        except ValueError, e:
+            abort(BAD_REQUEST, 'invalid batch ' + str(e))
+        if not isinstance(ops, list) or len(ops) > MAX_BATCH_SIZE:
+            abort(BAD_REQUEST, 'batch must be a list of at most %d '
+                  'operations' % MAX_BATCH_SIZE)
+        for op in ops:
+            if (not isinstance(op, list) or not op or
+                    op[0] not in connlib.BATCH_OPERATIONS):
+                abort(BAD_REQUEST, 'invalid batch operation ' + repr(op))
+            min_args, max_args = BATCH_ARGS[op[0]]
+            if not min_args <= len(op) - 1 <= max_args:
+                abort(BAD_REQUEST, 'wrong number of arguments for batch '
+                      'operation ' + repr(op))
+
+        # Strip cached ETags from read_node operations.  The client may
+        # have cached the ETag of a compressed response.
+        etags = {}
+        for i, op in enumerate(ops):
+            if op[0] == 'read_node' and len(op) > 2:
+                if isinstance(op[2], basestring):
+                    etags[i] = strip_etag_coding(op[2])
+                ops[i] = op[:2]
+
+        if any(op[0] in BATCH_WRITES for op in ops):
+            lock = self.lock.writing()
+        else:
+            lock = self.lock.reading()
+        with lock:
+            return self.json_response(self.run_batch(ops, etags))
+
+    def run_batch(self, ops, etags):
+        """
+        Perform the operations of a batch request
+
+        'etags' maps the index of read_node operations to the ETag of the
+        client's cached copy.  Returns the results of the response.
+        """
+        # Read the parents of updated nodes, which change if they move.
+        updates = [i for i, op in enumerate(ops)
+                   if op[0] == 'update_node' and len(op) > 1]
+        old_parentids = {}
+        for i, attr in zip(updates, self.conn.read_nodes(
+                [ops[i][1] for i in updates])):
+            if attr is not None:
+                old_parentids[i] = attr.get('parentids')
+
+        results = []
+        for i, (op, result) in enumerate(zip(ops, self.conn.batch(ops))):
+            if isinstance(result, connlib.ConnectionError):
+                error = type(result).__name__
+                if error not in connlib.BATCH_ERRORS:
+                    error = 'ConnectionError'
+                results.append({'error': error, 'message': str(result)})
+            else:
+                if op[0] == 'update_node':
+                    self.add_node_change(op[1], 'update', get_moved_parentids(
+                        old_parentids.get(i), op[2]))
+                if op[0] != 'read_node':
+                    results.append({'result': result})
+                    continue
+                if result.get("parentids") == [None]:
+                    result = dict(result)
+                    del result["parentids"]
+                etag = get_node_etag(result)
+                if etags.get(i) == etag:
+                    results.append({'etag': etag, 'not_modified': True})
+                else:
+                    results.append({'result': result, 'etag': etag})
+
+        return results
+
+    def read_tree_view(self, nodeid):
+        """
+        Stream a node and its descendants.
+
+        The nodes are written in pre-order as newline-delimited JSON, one
+        {'nodeid': nodeid, 'depth': depth, 'attr': attr, 'etag': etag} per
+        line.  The etag is that of the whole node, as returned by read_node.
+        Query parameters:
+          depth -- number of levels of descendants (default: all)
+          attrs -- comma separated attr keys to return (default: all)
+        """
+        depth = request.query.get('depth')
+        if depth is not None:
+            try:
+                depth = int(depth)
+                if depth < 0:
+                    raise ValueError()
+            except ValueError:
+                abort(BAD_REQUEST, 'invalid depth ' + depth)
+
+        keys = request.query.get('attrs')
+        if keys:
+            keys = set(keys.split(','))
+
+        # Read the first node here, so that unknown nodes are reported.
+        lock = self.lock
+        nodes = iter_node_tree(self.conn, nodeid, depth)
+        try:
+            first = nodes.next()
+        except connlib.UnknownNode, e:
+            abort(NOT_FOUND, 'node not found ' + str(e))
+
+        def iter_nodes():
+            yield first
+            while True:
+                with lock.reading():
+                    try:
+                        item = nodes.next()
+                    except StopIteration:
+                        return
+                yield item
+
+        def write_lines():
+            for nodeid, level, attr in iter_nodes():
+                if attr.get("parentids") == [None]:
+                    attr = dict(attr)
+                    del attr["parentids"]
+                etag = get_node_etag(attr)
+                if keys:
+                    attr = dict((key, value) for key, value in attr.items()
+                                if key in keys)
+                yield json.dumps({
+                    'nodeid': nodeid,
+                    'depth': level,
+                    'attr': attr,
+                    'etag': etag,
+                }).encode('utf8') + '\n'
+
+        response.content_type = 'application/x-ndjson'
+        return write_lines()
+
     def create_node_view(self, nodeid=None):
         """
         Create new notebook node.
@@ -264,11 +1885,17 @@ class BaseNoteBookHttpServer(object):
         except connlib.NodeExists, e:
             keepnote.log_error()
             abort(FORBIDDEN, 'node already exists.' + str(e))
+        self.add_node_change(nodeid, 'create', attr.get('parentids'))
 
         return self.json_response(attr)
 
     def update_node_view(self, nodeid):
-        """Update notebook node attr."""
+        """
+        Update notebook node attr.
+
+        With an If-Match header, the node is only updated if its ETag
+        matches.
+        """
         nodeid = urllib.unquote(nodeid)
 
         # update node
@@ -276,10 +1903,15 @@ class BaseNoteBookHttpServer(object):
         attr = json.loads(data)
 
         try:
+            old_attr = self.conn.read_node(nodeid)
+            check_if_match(lambda: get_served_node_etag(old_attr))
+            parentids = old_attr.get('parentids')
             self.conn.update_node(nodeid, attr)
         except connlib.UnknownNode, e:
             keepnote.log_error()
             abort(NOT_FOUND, 'node not found ' + str(e))
+        self.add_node_change(nodeid, 'update',
+                             get_moved_parentids(parentids, attr))
 
         return self.json_response(attr)
 
@@ -287,10 +1919,12 @@ class BaseNoteBookHttpServer(object):
         """Delete notebook node."""
         nodeid = urllib.unquote(nodeid)
         try:
+            parentids = self.conn.read_node(nodeid).get('parentids')
             self.conn.delete_node(nodeid)
         except connlib.UnknownNode, e:
             keepnote.log_error()
             abort(NOT_FOUND, 'node not found ' + str(e))
+        self.add_node_change(nodeid, 'delete', parentids)
 
     def has_node_view(self, nodeid):
         """
@@ -314,19 +1948,19 @@ class BaseNoteBookHttpServer(object):
             if filename.endswith("/"):
                 # list directory
                 files = list(self.conn.list_dir(nodeid, filename))
-                return self.json_response({
+                body = self.json_response({
                     'files': files,
                 })
+                if match_etag(get_data_etag(body)):
+                    return not_modified()
+                return body
 
             else:
                 # return node file
-                with self.conn.open_file(nodeid, filename) as stream:
-                    mime, encoding = mimetypes.guess_type(
-                        filename, strict=False)
-                    response.content_type = (mime if mime else default_mime)
-
-                    # TODO: return stream.
-                    return stream.read()
+                stream = self.conn.open_file(nodeid, filename)
+                mime, encoding = mimetypes.guess_type(filename, strict=False)
+                response.content_type = (mime if mime else default_mime)
+                return self.stream_file_response(stream)
 
         except connlib.UnknownNode, e:
             keepnote.log_error()
@@ -335,9 +1969,64 @@ class BaseNoteBookHttpServer(object):
             keepnote.log_error()
             abort(FORBIDDEN, 'Could not read file ' + str(e))
 
+    def stream_file_response(self, stream):
+        """
+        Return a node file stream as the response body.
+
+        The file is sent in chunks.  When its size is known, Content-Length
+        is set and a single byte range can be requested with Range.  Plain
+        files get an ETag from their mtime and size.
+        """
+        etag = get_stream_etag(stream)
+        if etag and match_etag(etag) and 'HTTP_RANGE' not in request.environ:
+            stream.close()
+            return not_modified()
+
+        size = get_stream_size(stream)
+        if size is None:
+            return iter_stream(stream)
+        response.headers['Accept-Ranges'] = 'bytes'
+
+        if 'HTTP_RANGE' in request.environ:
+            ranges = list(bottle.parse_range_header(
+                request.environ['HTTP_RANGE'], size))
+            if not ranges:
+                stream.close()
+                response.headers['Content-Range'] = 'bytes */%d' % size
+                abort(REQUESTED_RANGE_NOT_SATISFIABLE,
+                      'Requested range not satisfiable')
+            offset, end = ranges[0]
+            response.status = PARTIAL_CONTENT
+            response.headers['Content-Range'] = 'bytes %d-%d/%d' % (
+                offset, end - 1, size)
+            response.content_length = end - offset
+            return iter_stream(stream, offset, end - offset)
+
+        response.content_length = size
+        if isinstance(stream, file):
+            # Let the server send plain files (wsgi.file_wrapper).
+            return stream
+        return iter_stream(stream)
+
+    def get_file_etag(self, nodeid, filename):
+        """Returns the ETag of a node file, or None if it does not exist"""
+        try:
+            stream = self.conn.open_file(nodeid, filename)
+        except connlib.ConnectionError:
+            return None
+        try:
+            return get_stream_etag(stream)
+        finally:
+            stream.close()
+
     def write_file_view(self, nodeid, filename):
         """
         Write node file.
+
+        With an If-Match header, the file is only written if its ETag
+        matches.  With a 'delta' query, the body is a delta of the file
+        (see NoteBookConnection.patch_file()).  The body is spooled
+        before the connection is locked for the write.
         """
         nodeid = urllib.unquote(nodeid)
         filename = urllib.unquote(filename)
@@ -346,29 +2035,39 @@ class BaseNoteBookHttpServer(object):
 
         if filename.endswith("/"):
             # Create dir.
-            if request.method == 'PUT':
-                self.conn.create_dir(nodeid, filename)
-            else:
+            if request.method != 'PUT':
                 abort(BAD_REQUEST, 'Invalid method on directory')
-
-        else:
-            # Write file.
-            try:
-                if request.query.get("mode", "w") == ["a"]:
-                    if request.method == 'PUT':
-                        abort(BAD_REQUEST, 'Invalid method for file append')
-                    stream = self.conn.open_file(nodeid, filename, "a")
+            with self.lock.writing():
+                self.conn.create_dir(nodeid, filename)
+                self.add_file_change(nodeid, filename)
+            return
+
+        # Write file.
+        mode = request.query.get("mode", "w")
+        if mode == "a" and request.method == 'PUT':
+            abort(BAD_REQUEST, 'Invalid method for file append')
+        body = spool_request_body()
+        try:
+            with self.lock.writing():
+                check_if_match(lambda: self.get_file_etag(nodeid, filename))
+                if 'delta' in request.query:
+                    self.conn.patch_file(nodeid, filename, body)
                 else:
-                    stream = self.conn.open_file(nodeid, filename, "w")
-                stream.write(request.body.read())
-                stream.close()
+                    stream = self.conn.open_file(
+                        nodeid, filename, "a" if mode == "a" else "w")
+                    copy_body(body, stream)
+                self.add_file_change(nodeid, filename)
 
-            except connlib.UnknownNode, e:
-                keepnote.log_error()
-                abort(NOT_FOUND, 'cannot find node ' + str(e))
-            except connlib.FileError, e:
-                keepnote.log_error()
-                abort(FORBIDDEN, 'Could not write file ' + str(e))
+        except connlib.UnknownNode, e:
+            keepnote.log_error()
+            abort(NOT_FOUND, 'cannot find node ' + str(e))
+        except connlib.DeltaBasisError, e:
+            abort(PRECONDITION_FAILED, 'Could not patch file ' + str(e))
+        except connlib.FileError, e:
+            keepnote.log_error()
+            abort(FORBIDDEN, 'Could not write file ' + str(e))
+        finally:
+            body.close()
 
     def delete_file_view(self, nodeid, filename):
         """
@@ -382,6 +2081,7 @@ class BaseNoteBookHttpServer(object):
         try:
             # delete file/dir
             self.conn.delete_file(nodeid, filename)
+            self.add_file_change(nodeid, filename)
         except connlib.UnknownNode, e:
             keepnote.log_error()
             abort(NOT_FOUND, 'cannot find node ' + str(e))
@@ -428,5 +2128,6 @@ class NoteBookHttpServer(BaseNoteBookHttpServer):
         except connlib.NodeExists, e:
             keepnote.log_error()
             abort(FORBIDDEN, 'node already exists.' + str(e))
+        self.add_node_change(nodeid, 'create', attr.get('parentids'))
 
         return self.json_response(attr)
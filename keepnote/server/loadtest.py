@@ -0,0 +1,457 @@
+"""
+
+    KeepNote
+
+    Load testing of the notebook HTTP server
+
+    Usage: python -m keepnote.server.loadtest [options]
+
+    A notebook of generated pages is served by a local NoteBookHttpServer
+    and a mix of requests is sent to it by concurrent clients.  The
+    throughput and latency percentiles of each operation are written as
+    JSON.
+
+"""
+
+#
+#  KeepNote
+#  Copyright (c) 2008-2011 Matt Rasmussen
+#  Author: Matt Rasmussen <rasmus@alum.mit.edu>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+
+# python imports
+import httplib
+import json
+import optparse
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import thread
+import threading
+import time
+import urllib
+
+# keepnote imports
+from keepnote import notebook as notebooklib
+from keepnote.server import NoteBookHttpServer
+from keepnote.server import WORKERS
+from keepnote.server import format_node_path
+
+
+# Default weights of the operations in the request mix.
+DEFAULT_MIX = {
+    'read_node': 50,
+    'list_dir': 10,
+    'read_file': 20,
+    'write_file': 5,
+    'search': 15,
+}
+
+# Words used for generated titles, page contents and search queries.
+WORDS = ('apple', 'banana', 'cherry', 'delta', 'echo', 'forest', 'garden',
+         'harbor', 'island', 'jungle', 'kettle', 'lemon', 'meadow', 'night',
+         'ocean', 'pepper', 'quartz', 'river', 'stone', 'tiger', 'umbrella',
+         'valley', 'winter', 'yellow', 'zebra')
+
+# Name of the file written by write_file operations.
+WRITE_FILENAME = 'loadtest.bin'
+
+
+def parse_mix(text):
+    """
+    Parse an operation mix such as 'read_node=50,search=10'
+
+    Returns a dict of operation weights.
+    """
+    mix = {}
+    for item in text.split(','):
+        name, _, weight = item.strip().partition('=')
+        if name not in DEFAULT_MIX:
+            raise ValueError('unknown operation %r' % name)
+        mix[name] = float(weight) if weight else 1.0
+        if mix[name] < 0:
+            raise ValueError('negative weight for %r' % name)
+    if not sum(mix.values()):
+        raise ValueError('operation mix is empty')
+    return mix
+
+
+def generate_notebook(filename, folders=10, pages=20, page_size=2000,
+                      seed=0):
+    """
+    Create a notebook of generated pages
+
+    The notebook has 'folders' pages under its root, each with 'pages'
+    child pages whose content is about page_size bytes of random words.
+    Returns the notebook, which must be closed by the caller.
+    """
+    rand = random.Random(seed)
+    book = notebooklib.NoteBook()
+    book.create(filename)
+
+    def new_page(parent):
+        title = u' '.join(rand.choice(WORDS) for i in xrange(3))
+        page = notebooklib.new_page(parent, title)
+        words = []
+        size = 0
+        while size < page_size:
+            word = rand.choice(WORDS)
+            words.append(word)
+            size += len(word) + 1
+        with page.open_file(notebooklib.PAGE_DATA_FILE, 'w') as out:
+            out.write(notebooklib.NOTE_HEADER)
+            out.write(' '.join(words))
+            out.write(notebooklib.NOTE_FOOTER)
+        page.save(True)
+        return page
+
+    for i in xrange(folders):
+        folder = new_page(book)
+        for j in xrange(pages):
+            new_page(folder)
+    return book
+
+
+def iter_nodes(node):
+    """Iterate through a node and its descendants"""
+    yield node
+    for child in node.get_children():
+        for node2 in iter_nodes(child):
+            yield node2
+
+
+def percentile(values, percent):
+    """Returns a percentile of sorted values by the nearest-rank method"""
+    if not values:
+        return None
+    rank = int(len(values) * percent / 100.0 + 0.999999)
+    return values[max(rank, 1) - 1]
+
+
+def summarize(latencies, errors, duration):
+    """Returns the statistics of a list of latencies in seconds"""
+    latencies = sorted(latencies)
+    count = len(latencies)
+
+    def ms(value):
+        return round(value * 1000, 3) if value is not None else None
+
+    return {
+        'requests': count,
+        'errors': errors,
+        'throughput': round(count / duration, 3) if duration else None,
+        'latency_ms': {
+            'mean': ms(sum(latencies) / count if count else None),
+            'p50': ms(percentile(latencies, 50)),
+            'p95': ms(percentile(latencies, 95)),
+            'p99': ms(percentile(latencies, 99)),
+            'max': ms(latencies[-1] if latencies else None),
+        },
+    }
+
+
+class LoadClient (object):
+    """
+    Client that sends a random mix of requests to a notebook server
+
+    Each client has its own HTTP connection and random generator, and
+    records the latency of every request by operation.
+    """
+
+    def __init__(self, host, port, nodeids, mix, file_size=4096, seed=0,
+                 prefix='/notebook/'):
+        self.host = host
+        self.port = port
+        self.nodeids = nodeids
+        self.prefix = prefix
+        self.file_size = file_size
+        self.rand = random.Random(seed)
+        self.ops = sorted(name for name, weight in mix.items() if weight > 0)
+        self.weights = [mix[name] for name in self.ops]
+        self.latencies = dict((name, []) for name in self.ops)
+        self.errors = dict((name, 0) for name in self.ops)
+        self._conn = None
+
+    def choose_op(self):
+        """Choose an operation by its weight"""
+        value = self.rand.random() * sum(self.weights)
+        for name, weight in zip(self.ops, self.weights):
+            value -= weight
+            if value < 0:
+                return name
+        return self.ops[-1]
+
+    def get_request(self, name):
+        """Returns (method, url, body) of a request for an operation"""
+        nodeid = self.rand.choice(self.nodeids)
+        if name == 'read_node':
+            return 'GET', format_node_path(
+                self.prefix + 'nodes/', nodeid), None
+        elif name == 'list_dir':
+            return 'GET', format_node_path(
+                self.prefix + 'nodes/', nodeid, ''), None
+        elif name == 'read_file':
+            return 'GET', format_node_path(
+                self.prefix + 'nodes/', nodeid,
+                notebooklib.PAGE_DATA_FILE), None
+        elif name == 'write_file':
+            return 'PUT', format_node_path(
+                self.prefix + 'nodes/', nodeid, WRITE_FILENAME), \
+                os.urandom(self.file_size)
+        elif name == 'search':
+            return 'GET', '%stitles?%s' % (self.prefix, urllib.urlencode(
+                {'q': self.rand.choice(WORDS)})), None
+        raise ValueError('unknown operation %r' % name)
+
+    def request(self, method, url, body=None):
+        """
+        Send a request and read its response, returning its status
+
+        The server may close an idle connection just as a request is sent
+        on it, so a request that fails on a reused connection is sent once
+        more on a new one.
+        """
+        reused = self._conn is not None
+        if not reused:
+            self._conn = httplib.HTTPConnection(self.host, self.port)
+        try:
+            self._conn.request(method, str(url), body)
+            response = self._conn.getresponse()
+            response.read()
+        except (socket.error, httplib.HTTPException):
+            self.close()
+            if not reused:
+                raise
+            return self.request(method, url, body)
+        if response.will_close:
+            self.close()
+        return response.status
+
+    def run(self, end_time=None, count=None):
+        """Send requests until end_time or until count requests are sent"""
+        sent = 0
+        while ((end_time is None or time.time() < end_time) and
+               (count is None or sent < count)):
+            name = self.choose_op()
+            method, url, body = self.get_request(name)
+            start = time.time()
+            try:
+                status = self.request(method, url, body)
+            except (socket.error, httplib.HTTPException):
+                status = None
+            self.latencies[name].append(time.time() - start)
+            if status is None or status >= 400:
+                self.errors[name] += 1
+            sent += 1
+        self.close()
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def run_clients(host, port, nodeids, mix=DEFAULT_MIX, clients=4,
+                duration=10.0, count=None, file_size=4096, seed=0):
+    """
+    Run concurrent clients against a notebook server
+
+    Each client runs for 'duration' seconds, or sends 'count' requests
+    if count is given.  Returns a report dict.
+    """
+    loaders = [LoadClient(host, port, nodeids, mix, file_size=file_size,
+                          seed=seed + i)
+               for i in xrange(clients)]
+    start = time.time()
+    end_time = start + duration if count is None else None
+    threads = [threading.Thread(target=loader.run, args=(end_time, count))
+               for loader in loaders]
+    for thread_ in threads:
+        thread_.start()
+    for thread_ in threads:
+        thread_.join()
+    elapsed = time.time() - start
+
+    latencies = []
+    errors = 0
+    operations = {}
+    for name in sorted(mix):
+        op_latencies = [latency for loader in loaders
+                        for latency in loader.latencies.get(name, ())]
+        op_errors = sum(loader.errors.get(name, 0) for loader in loaders)
+        if op_latencies:
+            operations[name] = summarize(op_latencies, op_errors, elapsed)
+        latencies.extend(op_latencies)
+        errors += op_errors
+
+    report = summarize(latencies, errors, elapsed)
+    report['duration'] = round(elapsed, 3)
+    report['clients'] = clients
+    report['operations'] = operations
+    return report
+
+
+def start_server(conn, host='localhost', port=0, workers=WORKERS,
+                 metrics=False):
+    """
+    Start a server for a notebook connection in a new thread
+
+    Returns the server and the port it listens on.
+    """
+    server = NoteBookHttpServer(conn, host=host, port=port, workers=workers,
+                                metrics=metrics)
+    thread.start_new_thread(server.serve_forever, (), {'quiet': True})
+
+    # Wait for the server to listen.
+    while getattr(server.server, 'srv', None) is None:
+        time.sleep(0.01)
+    port = server.server.srv.server_port
+    while True:
+        try:
+            socket.create_connection((host, port)).close()
+            break
+        except socket.error:
+            time.sleep(0.01)
+    return server, port
+
+
+def read_metrics(host, port):
+    """Returns the text a server serves at /metrics"""
+    conn = httplib.HTTPConnection(host, port)
+    try:
+        conn.request('GET', '/metrics')
+        response = conn.getresponse()
+        text = response.read()
+    finally:
+        conn.close()
+    if response.status != httplib.OK:
+        raise Exception("cannot read metrics: %d" % response.status)
+    return text
+
+
+def load_test(filename=None, folders=10, pages=20, page_size=2000,
+              mix=DEFAULT_MIX, clients=4, duration=10.0, count=None,
+              file_size=4096, workers=WORKERS, seed=0, metrics=False):
+    """
+    Serve a generated notebook locally and run clients against it
+
+    The notebook is created in filename, or in a temporary directory
+    that is removed afterwards.  Returns the report dict.  If metrics is
+    True, the server collects metrics and the report includes the text
+    it serves at /metrics.
+    """
+    tmpdir = None
+    if filename is None:
+        tmpdir = tempfile.mkdtemp(prefix='keepnote-loadtest-')
+        filename = os.path.join(tmpdir, 'notebook')
+
+    try:
+        book = generate_notebook(filename, folders, pages, page_size, seed)
+        nodeids = [node.get_attr('nodeid') for node in iter_nodes(book)
+                   if node.get_attr('content_type') ==
+                   notebooklib.CONTENT_TYPE_PAGE]
+        server, port = start_server(book._conn, workers=workers,
+                                    metrics=metrics)
+        try:
+            report = run_clients('localhost', port, nodeids, mix, clients,
+                                 duration, count, file_size, seed)
+            if metrics:
+                report['metrics'] = read_metrics('localhost', port)
+        finally:
+            server.shutdown()
+            book.close()
+    finally:
+        if tmpdir:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    report['config'] = {
+        'folders': folders,
+        'pages': pages,
+        'page_size': page_size,
+        'file_size': file_size,
+        'workers': workers,
+        'mix': mix,
+        'seed': seed,
+        'metrics': metrics,
+    }
+    return report
+
+
+def main(argv):
+    parser = optparse.OptionParser(
+        usage="%prog [options]",
+        description="Load test a local notebook HTTP server and print "
+        "throughput and latency as JSON.")
+    parser.add_option("-c", "--clients", type="int", default=4,
+                      help="number of concurrent clients (default: 4)")
+    parser.add_option("-d", "--duration", type="float", default=10.0,
+                      help="seconds to run (default: 10)")
+    parser.add_option("-n", "--requests", type="int", metavar="COUNT",
+                      help="send COUNT requests per client instead of "
+                      "running for a duration")
+    parser.add_option("-m", "--mix", default=None,
+                      help="operation weights, e.g. 'read_node=50,"
+                      "search=10' (default: %s)" % ",".join(
+                          "%s=%d" % item for item in sorted(
+                              DEFAULT_MIX.items())))
+    parser.add_option("-w", "--workers", type="int", default=WORKERS,
+                      help="server threads (default: %d)" % WORKERS)
+    parser.add_option("--folders", type="int", default=10,
+                      help="number of top-level pages (default: 10)")
+    parser.add_option("--pages", type="int", default=20,
+                      help="child pages per top-level page (default: 20)")
+    parser.add_option("--page-size", type="int", default=2000,
+                      help="bytes of text per page (default: 2000)")
+    parser.add_option("--file-size", type="int", default=4096,
+                      help="bytes written per file write (default: 4096)")
+    parser.add_option("--notebook", metavar="PATH",
+                      help="create the notebook at PATH instead of a "
+                      "temporary directory")
+    parser.add_option("--seed", type="int", default=0,
+                      help="random seed (default: 0)")
+    parser.add_option("--metrics", action="store_true", default=False,
+                      help="collect server metrics and add them to the "
+                      "report")
+    parser.add_option("-o", "--output", metavar="FILE",
+                      help="write the report to FILE instead of stdout")
+    options, args = parser.parse_args(argv[1:])
+
+    try:
+        mix = parse_mix(options.mix) if options.mix else DEFAULT_MIX
+    except ValueError, e:
+        parser.error(str(e))
+
+    report = load_test(
+        filename=options.notebook, folders=options.folders,
+        pages=options.pages, page_size=options.page_size, mix=mix,
+        clients=options.clients, duration=options.duration,
+        count=options.requests, file_size=options.file_size,
+        workers=options.workers, seed=options.seed,
+        metrics=options.metrics)
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as out:
+            out.write(text + '\n')
+    else:
+        print text
+
+
+if __name__ == '__main__':
+    main(sys.argv)
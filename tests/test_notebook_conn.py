@@ -8,6 +8,7 @@ import unittest
 from keepnote import notebook
 import keepnote.notebook.connection as connlib
 from keepnote.notebook.connection import FileError
+from keepnote.notebook.connection.delta import write_delta
 
 from . import TMP_DIR
 
@@ -203,6 +204,23 @@ class TestConnBase (unittest.TestCase):
         self.assertEqual(conn.open_file('node1', 'copied-file').read(),
                          data)
 
+        # Patch a file with a delta.
+        signature = conn.get_file_signature('node1', 'copied-file', 4)
+        self.assertEqual(signature['size'], len(data))
+        delta = StringIO()
+        write_delta(delta, signature, StringIO('hello there world'))
+        delta.seek(0)
+        conn.patch_file('node1', 'copied-file', delta)
+        self.assertEqual(conn.open_file('node1', 'copied-file').read(),
+                         'hello there world')
+
+        # The delta no longer matches the file.
+        delta.seek(0)
+        self.assertRaises(FileError, lambda:
+                          conn.patch_file('node1', 'copied-file', delta))
+        self.assertEqual(conn.open_file('node1', 'copied-file').read(),
+                         'hello there world')
+
         # Ensure files aren't interpreted as children files.
         # Create a file that conflicts with a child node directory.
         conn.create_node('node3', {})
@@ -0,0 +1,104 @@
+# python imports
+from StringIO import StringIO
+import hashlib
+import random
+import unittest
+import zlib
+
+# keepnote imports
+from keepnote.notebook.connection import delta as deltalib
+
+
+def make_delta(basis, data, block_size):
+    signature = deltalib.get_signature(StringIO(basis), block_size)
+    out = StringIO()
+    deltalib.write_delta(out, signature, StringIO(data))
+    return out.getvalue()
+
+
+def patch(basis, delta):
+    stream = StringIO(delta)
+    header = deltalib.read_delta_header(stream)
+    out = StringIO()
+    deltalib.apply_delta(StringIO(basis), stream, out, header['block_size'])
+    return out.getvalue()
+
+
+class Delta (unittest.TestCase):
+
+    def setUp(self):
+        rand = random.Random(0)
+        self.data = ''.join(chr(rand.randrange(256)) for i in xrange(50000))
+
+    def test_signature(self):
+        data = self.data
+        signature = deltalib.get_signature(StringIO(data), 1024)
+        self.assertEqual(signature['size'], len(data))
+        self.assertEqual(len(signature['blocks']), 49)
+        self.assertEqual(signature['blocks'][0][0],
+                         zlib.adler32(data[:1024]) & 0xffffffff)
+        self.assertEqual(signature['blocks'][-1][0],
+                         zlib.adler32(data[48 * 1024:]) & 0xffffffff)
+
+    def test_delta(self):
+        data = self.data
+        changes = [
+            data,
+            data[:100] + 'insert' + data[100:],
+            data[:20000] + data[21000:],
+            data[:30000] + 'x' * 500 + data[30500:],
+            data + 'append',
+            'prepend' + data,
+            data[25000:] + data[:25000],
+            data[:10],
+            '',
+        ]
+        for new in changes:
+            delta = make_delta(data, new, 1024)
+            self.assertEqual(patch(data, delta), new)
+
+        # only changed blocks are sent
+        self.assertTrue(len(make_delta(data, data, 1024)) < 200)
+        self.assertTrue(
+            len(make_delta(data, changes[1], 1024)) < 1024 + 200)
+        self.assertTrue(
+            len(make_delta(data, changes[6], 1024)) < 2 * 1024 + 200)
+
+        # an empty basis sends everything
+        self.assertEqual(patch('', make_delta('', data, 1024)), data)
+
+    def test_max_literal(self):
+        data = self.data
+        signature = deltalib.get_signature(StringIO(data), 1024)
+
+        def write(new, max_literal):
+            out = StringIO()
+            deltalib.write_delta(out, signature, StringIO(new), max_literal)
+            return out
+
+        # small changes fit
+        new = data[:100] + 'insert' + data[100:]
+        delta = write(new, 2000)
+        self.assertEqual(patch(data, delta.getvalue()), new)
+        self.assertEqual(deltalib.read_delta_hash(delta),
+                         hashlib.sha1(new).hexdigest())
+
+        # a file that changed throughout is given up on early
+        new = data[::-1] * 100
+        stream = StringIO(new)
+        self.assertRaises(deltalib.DeltaTooLarge, deltalib.write_delta,
+                          StringIO(), signature, stream, 10000)
+        self.assertTrue(stream.tell() < len(new) / 2)
+        self.assertRaises(deltalib.DeltaTooLarge, write,
+                          data[:40000] + 'x' * 10000, 5000)
+
+    def test_bad_delta(self):
+        data = self.data
+        new = data[:100] + 'insert' + data[100:]
+        delta = make_delta(data, new, 1024)
+
+        self.assertRaises(deltalib.DeltaError, patch, data, 'not a delta')
+        self.assertRaises(deltalib.DeltaError, patch, data, delta[:-10])
+        self.assertRaises(deltalib.DeltaError, patch, data[:-2000], delta)
+        self.assertRaises(deltalib.DeltaError, patch,
+                          data[:5000] + 'y' + data[5001:], delta)
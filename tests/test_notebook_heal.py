@@ -2,6 +2,7 @@
 # python imports
 import unittest
 import os
+import shutil
 import time
 
 # keepnote imports
@@ -123,8 +124,11 @@ class Heal (unittest.TestCase):
         print "system"
         os.system((
             "sqlite3 %s/notebook_tamper/n1/__NOTEBOOK__/index.sqlite "
-            "'select mtime from NodeGraph where parentid == \"" +
-            notebook.UNIVERSAL_ROOT + "\";'") % _tmpdir)
+            "'select g.mtime from NodeGraph as g "
+            "join NodeIds as n on n.handle = g.parent "
+            "where hex(n.nodeid) == \"" +
+            notebook.UNIVERSAL_ROOT.replace("-", "").upper() + "\";'") %
+            _tmpdir)
 
         time.sleep(1)
 
@@ -141,3 +145,83 @@ class Heal (unittest.TestCase):
         book = notebook.NoteBook()
         book.load(_tmpdir + "/notebook_tamper/n1")
         book.close()
+
+    def test_index_changes(self):
+        """Unmanaged changes are found and reindexed after opening."""
+        make_clean_dir(_tmpdir)
+
+        book = notebook.NoteBook()
+        book.create(_tmpdir + "/n1")
+        a = notebook.new_page(book, "a")
+        a1 = notebook.new_page(a, "a1")
+        notebook.new_page(a, "a2")
+        b = notebook.new_page(book, "b")
+        b1 = notebook.new_page(b, "b1")
+        a1id = a1.get_attr("nodeid")
+        b1id = b1.get_attr("nodeid")
+        book.close()
+        time.sleep(1)
+
+        # Retitle a deep node behind the notebook's back.
+        path = _tmpdir + "/n1/a/a1"
+        attr, extra = fs.read_attr(path + "/node.xml")
+        attr["title"] = u"retitled"
+        fs.write_attr(path + "/node.xml", a1id, attr)
+
+        # Rename one node directory and delete another.
+        os.rename(_tmpdir + "/n1/b/b1", _tmpdir + "/n1/b/renamed")
+        shutil.rmtree(_tmpdir + "/n1/a/a2")
+
+        book = notebook.NoteBook()
+        book.load(_tmpdir + "/n1")
+        book._conn._index.flush_queue()
+        titles = dict((title, nodeid) for nodeid, title
+                      in book.search_node_titles(u""))
+        self.assertEqual(titles.get(u"retitled"), a1id)
+        self.assertFalse(u"a1" in titles)
+        self.assertFalse(u"a2" in titles)
+        self.assertEqual(book._conn.get_node_path(b1id),
+                         _tmpdir + "/n1/b/renamed")
+
+        # The index is now up to date.
+        self.assertEqual(book._conn._index.check_index(), [])
+        book.close()
+
+    def test_reindex_queue(self):
+        """Unmanaged changes found while reading are indexed in background."""
+        make_clean_dir(_tmpdir)
+
+        book = notebook.NoteBook()
+        book.create(_tmpdir + "/n1")
+        a = notebook.new_page(book, "a")
+        aid = a.get_attr("nodeid")
+        book.close()
+        time.sleep(1)
+
+        path = _tmpdir + "/n1/a"
+        attr, extra = fs.read_attr(path + "/node.xml")
+        attr["title"] = u"retitled"
+        fs.write_attr(path + "/node.xml", aid, attr)
+
+        conn = fs.NoteBookConnectionFS()
+        conn.connect(_tmpdir + "/n1")
+        index = conn._index
+
+        # Hold the worker back while reading the changed node twice.
+        with index._reindex._apply_lock:
+            conn.read_node(conn.get_rootid())
+            attr = conn.read_node(aid)
+            conn.read_node(aid)
+            self.assertEqual(attr["title"], u"retitled")
+            self.assertEqual(len(index._reindex), 1)
+            self.assertFalse(conn._node_index_current(aid, path)[0])
+            worker = index._reindex._thread
+
+        index.flush_queue()
+        self.assertEqual(len(index._reindex), 0)
+        self.assertTrue(conn._node_index_current(aid, path)[0])
+
+        # The worker closes its cursor when it is done.
+        worker.join()
+        self.assertEqual(index._cursors, [index.cur])
+        conn.close()
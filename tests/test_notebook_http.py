@@ -1,16 +1,40 @@
+import hashlib
+import httplib
 import json
+import os
 import socket
 import thread
+import threading
+import time
 import urllib
+import urllib2
+from StringIO import StringIO
+import zlib
 
 from keepnote import notebook as notebooklib
+from keepnote.notebook.connection.http import HttpFileWriter
 from keepnote.notebook.connection.http import NoteBookConnectionHttp
+from keepnote.notebook.connection.http import OfflineFile
+from keepnote.notebook.connection.http import PrefetchCache
+from keepnote.notebook.connection.http_cache import HttpCache
+from keepnote.notebook.connection.http_journal import WriteJournal
+import keepnote.notebook.connection as connlib
 from keepnote.notebook.connection import mem
+from keepnote.notebook.connection.delta import DELTA_BLOCK_SIZE
+from keepnote.notebook.connection.delta import write_delta
+from keepnote.notebook import sync
 from keepnote.server import BaseNoteBookHttpServer
+from keepnote.server import ChangeLog
 from keepnote.server import NoteBookHttpServer
+from keepnote.server import ReadCache
+from keepnote.server import WORKERS
+from keepnote.server import loadtest
 
+from . import make_clean_dir, TMP_DIR
 from .test_notebook_conn import TestConnBase
 
+_tmpdir = os.path.join(TMP_DIR, 'notebook_http')
+
 
 class TestHttp(TestConnBase):
 
@@ -88,3 +112,1284 @@ class TestHttp(TestConnBase):
 
         # Close server.
         server.shutdown()
+
+    def test_batch(self):
+        """
+        Several node operations can be performed in one request.
+        """
+        self.conn = mem.NoteBookConnectionMem()
+        self.notebook = notebooklib.NoteBook()
+        self.notebook.create('', self.conn)
+        for i in range(5):
+            notebooklib.new_page(self.notebook, 'page%d' % i)
+        self.notebook.save()
+
+        host = "localhost"
+        self.port = 8125
+        url = "http://%s:%d/notebook/" % (host, self.port)
+        server = NoteBookHttpServer(self.conn, port=self.port)
+        thread.start_new_thread(server.serve_forever, ())
+
+        conn2 = NoteBookConnectionHttp()
+        conn2.connect(url)
+        self.wait_for_server(conn2)
+
+        # Read several nodes at once, unknown nodes are None.
+        childids = [child.get_attr('nodeid')
+                    for child in self.notebook.get_children()]
+        attrs = conn2.read_nodes(childids + ['missing'])
+        self.assertEqual([attr['title'] for attr in attrs[:-1]],
+                         [self.conn.read_node(childid)['title']
+                          for childid in childids])
+        self.assertEqual(attrs[-1], None)
+
+        # Mixed operations return per-operation results and errors.
+        attr = attrs[0]
+        attr['title'] = 'new title'
+        results = conn2.batch([
+            ['update_node', childids[0], attr],
+            ['has_node', 'missing'],
+            ['list_dir', childids[0], '/'],
+            ['read_node', 'missing'],
+        ])
+        self.assertEqual(results[0], None)
+        self.assertEqual(results[1], False)
+        self.assertEqual(results[2], list(self.conn.list_dir(childids[0])))
+        self.assertTrue(isinstance(results[3], connlib.UnknownNode))
+        self.assertEqual(self.conn.read_node(childids[0])['title'],
+                         'new title')
+
+        # Invalid batches are rejected.
+        self.assertRaises(connlib.ConnectionError,
+                          conn2.batch, [['delete_node', childids[0]]])
+        self.assertTrue(self.conn.has_node(childids[0]))
+        for op in (['read_node'], ['has_file', childids[0]],
+                   ['has_node', childids[0], 'extra']):
+            try:
+                urllib2.urlopen(url + 'nodes?batch', json.dumps([op]))
+            except urllib2.HTTPError, e:
+                self.assertEqual(e.code, httplib.BAD_REQUEST)
+            else:
+                self.fail('batch accepted ' + repr(op))
+
+        # Batches of reads only take the shared lock.
+        writes = []
+        writing = server.lock.writing
+
+        def count_writing():
+            writes.append(True)
+            return writing()
+        server.lock.writing = count_writing
+        conn2.batch([['read_node', childids[0]], ['has_node', 'missing']])
+        self.assertEqual(writes, [])
+        conn2.batch([['update_node', childids[0], attr]])
+        self.assertEqual(writes, [True])
+        del server.lock.writing
+
+        conn2.close()
+        server.shutdown()
+        self.notebook.close()
+
+    def test_read_tree(self):
+        """
+        A subtree can be fetched in one request.
+        """
+        make_clean_dir(_tmpdir)
+        self.notebook = notebooklib.NoteBook()
+        self.notebook.create(_tmpdir + '/n1')
+        self.conn = self.notebook._conn
+        for i in range(3):
+            page = notebooklib.new_page(self.notebook, 'page%d' % i)
+            notebooklib.new_page(page, 'child%d' % i)
+        self.notebook.save()
+        rootid = self.notebook.get_attr('nodeid')
+
+        host = "localhost"
+        self.port = 8126
+        url = "http://%s:%d/notebook/" % (host, self.port)
+        server = NoteBookHttpServer(self.conn, port=self.port)
+        thread.start_new_thread(server.serve_forever, ())
+
+        conn2 = NoteBookConnectionHttp()
+        conn2.connect(url)
+        self.wait_for_server(conn2)
+
+        # Fetch subtree with depth and attr projection.
+        nodes = list(conn2.read_tree(rootid, depth=1, attrs=['title']))
+        self.assertEqual(nodes[0][0], rootid)
+        self.assertEqual(sorted(attr['title'] for nodeid, attr in nodes[1:]),
+                         ['Trash', 'page0', 'page1', 'page2'])
+        self.assertEqual(set(len(attr) for nodeid, attr in nodes), set([1]))
+
+        # Children follow their parent.
+        nodes = list(conn2.read_tree(rootid))
+        self.assertEqual(len(nodes), 8)
+        for i, (nodeid, attr) in enumerate(nodes):
+            if attr['title'].startswith('page'):
+                self.assertEqual(nodes[i + 1][1]['title'],
+                                 attr['title'].replace('page', 'child'))
+        self.assertRaises(connlib.UnknownNode, list,
+                          conn2.read_tree('missing'))
+
+        # Prefetched nodes are read without further requests.
+        requests = []
+        urlopen = conn2._pool.urlopen
+
+        def count_request(*args, **kargs):
+            requests.append(args)
+            return urlopen(*args, **kargs)
+        conn2._pool.urlopen = count_request
+
+        def node_requests():
+            # the change feed is also polled
+            return [args[1] for args in requests if 'changes' not in args[1]]
+
+        conn2.prefetch(rootid, depth=2)
+        attr = conn2.read_node(rootid)
+        attrs = conn2.read_nodes(attr['childrenids'])
+        conn2.read_nodes([childid for attr2 in attrs
+                          for childid in attr2['childrenids']])
+        self.assertEqual(len(node_requests()), 1)
+        self.assertEqual(len(attrs), 4)
+
+        # Nodes whose children are prefetched are read alone.
+        conn2.prefetch(rootid, depth=2)
+        del requests[:]
+        conn2.read_node(rootid)
+        self.assertEqual(node_requests(), [])
+        conn2.read_node(rootid)
+        self.assertEqual(len(node_requests()), 1)
+        self.assertFalse('?tree' in node_requests()[0])
+
+        # Prefetched attrs changed on the server are not used.
+        conn2._changes_interval = 0
+        conn3 = NoteBookConnectionHttp(prefetch_depth=0)
+        conn3.connect(url)
+        childid = attr['childrenids'][0]
+        attr3 = conn3.read_node(childid)
+        attr3['title'] = 'changed'
+        conn3.update_node(childid, attr3)
+        self.assertEqual(conn2.read_node(childid)['title'], 'changed')
+        conn3.close()
+
+        # Prefetched attrs are evicted oldest first and expire.
+        prefetched = PrefetchCache(limit=2, ttl=.2)
+        for i in range(3):
+            prefetched.set('n%d' % i, {'i': i})
+        self.assertEqual(len(prefetched), 2)
+        self.assertEqual(prefetched.pop('n0'), None)
+        self.assertEqual(prefetched.pop('n1'), {'i': 1})
+        self.assertEqual(prefetched.pop('n1'), None)
+        prefetched.set('c', {'parentids': ['p']})
+        self.assertTrue(prefetched.has_children('p'))
+        time.sleep(.3)
+        self.assertEqual(prefetched.pop('n2'), None)
+        self.assertFalse(prefetched.has_children('p'))
+        prefetched.set('c', {'parentids': ['p']})
+        prefetched.pop('c')
+        self.assertFalse(prefetched.has_children('p'))
+
+        conn2.close()
+        server.shutdown()
+        self.notebook.close()
+
+    def test_file_stream(self):
+        """
+        Node files are streamed and support byte ranges.
+        """
+        make_clean_dir(_tmpdir)
+        self.notebook = notebooklib.NoteBook()
+        self.notebook.create(_tmpdir + '/n1')
+        self.conn = self.notebook._conn
+        rootid = self.notebook.get_attr('nodeid')
+        data = ''.join(chr(i % 251) for i in xrange(300000))
+        with self.conn.open_file(rootid, 'big.bin', 'w') as out:
+            out.write(data)
+
+        host = "localhost"
+        self.port = 8127
+        url = "http://%s:%d/notebook/" % (host, self.port)
+        server = NoteBookHttpServer(self.conn, port=self.port)
+        thread.start_new_thread(server.serve_forever, ())
+
+        conn2 = NoteBookConnectionHttp()
+        conn2.connect(url)
+        self.wait_for_server(conn2)
+
+        # Read whole file, then seek around it.
+        with conn2.open_file(rootid, 'big.bin') as infile:
+            self.assertEqual(infile.read(), data)
+            self.assertEqual(infile.size, len(data))
+            infile.seek(1000)
+            self.assertEqual(infile.read(10), data[1000:1010])
+            self.assertEqual(infile.tell(), 1010)
+            infile.seek(-10, 2)
+            self.assertEqual(infile.read(), data[-10:])
+            infile.seek(len(data) + 10)
+            self.assertEqual(infile.read(), '')
+
+        # Files are hashed by the server.
+        self.assertEqual(conn2.get_file_hash(rootid, 'big.bin'),
+                         hashlib.sha1(data).hexdigest())
+        self.assertRaises(connlib.ConnectionError,
+                          conn2.get_file_hash, rootid, 'missing.bin')
+
+        # Range requests.
+        file_url = url + 'nodes/%s/big.bin' % rootid
+        req = urllib2.Request(file_url, headers={'Range': 'bytes=100-199'})
+        response = urllib2.urlopen(req)
+        self.assertEqual(response.getcode(), 206)
+        self.assertEqual(response.info()['Content-Range'],
+                         'bytes 100-199/%d' % len(data))
+        self.assertEqual(response.read(), data[100:200])
+
+        response = urllib2.urlopen(file_url)
+        self.assertEqual(response.info()['Content-Length'], str(len(data)))
+        self.assertEqual(response.read(), data)
+
+        req = urllib2.Request(file_url, headers={'Range': 'bytes=400000-'})
+        try:
+            urllib2.urlopen(req)
+            self.fail('expected range error')
+        except urllib2.HTTPError, e:
+            self.assertEqual(e.code, 416)
+
+        conn2.close()
+        server.shutdown()
+        self.notebook.close()
+
+    def test_file_delta(self):
+        """
+        Node files can be patched with deltas of the server's copy.
+        """
+        make_clean_dir(_tmpdir)
+        self.notebook = notebooklib.NoteBook()
+        self.notebook.create(_tmpdir + '/n1')
+        self.conn = self.notebook._conn
+        rootid = self.notebook.get_attr('nodeid')
+        data = os.urandom(sync.SYNC_DELTA_MIN_SIZE + 100000)
+        with self.conn.open_file(rootid, 'big.bin', 'w') as out:
+            out.write(data)
+
+        host = "localhost"
+        self.port = 8139
+        url = "http://%s:%d/notebook/" % (host, self.port)
+        server = NoteBookHttpServer(self.conn, port=self.port)
+        thread.start_new_thread(server.serve_forever, ())
+
+        conn2 = NoteBookConnectionHttp()
+        conn2.connect(url)
+        self.wait_for_server(conn2)
+
+        # The server makes the signature.
+        signature = conn2.get_file_signature(rootid, 'big.bin')
+        self.assertEqual(signature,
+                         self.conn.get_file_signature(rootid, 'big.bin'))
+
+        # Only changed blocks are sent.
+        data2 = data[:1000] + 'changed' + data[1100:]
+        delta = StringIO()
+        write_delta(delta, signature, StringIO(data2))
+        self.assertTrue(delta.tell() < 2 * DELTA_BLOCK_SIZE)
+        delta.seek(0)
+        conn2.patch_file(rootid, 'big.bin', delta)
+        with self.conn.open_file(rootid, 'big.bin') as infile:
+            self.assertEqual(infile.read(), data2)
+
+        # A stale delta is refused and the file is kept.
+        delta.seek(0)
+        self.assertRaises(connlib.FileError,
+                          conn2.patch_file, rootid, 'big.bin', delta)
+        with self.conn.open_file(rootid, 'big.bin') as infile:
+            self.assertEqual(infile.read(), data2)
+
+        # Syncing sends large files as deltas.
+        conn1 = mem.NoteBookConnectionMem()
+        conn1.create_node('n1', {})
+        data3 = data2[:500000] + data2[600000:]
+        with conn1.open_file('n1', 'big.bin', 'w') as out:
+            out.write(data3)
+        self.assertTrue(sync.copy_file_delta(conn1, 'n1', 'big.bin',
+                                             conn2, rootid, 'big.bin'))
+        with conn2.open_file(rootid, 'big.bin') as infile:
+            self.assertEqual(infile.read(), data3)
+
+        conn2.close()
+        server.shutdown()
+        self.notebook.close()
+
+    def test_file_upload(self):
+        """
+        Node files are uploaded in chunks as they are written.
+        """
+        make_clean_dir(_tmpdir)
+        self.notebook = notebooklib.NoteBook()
+        self.notebook.create(_tmpdir + '/n1')
+        self.conn = self.notebook._conn
+        rootid = self.notebook.get_attr('nodeid')
+
+        host = "localhost"
+        self.port = 8128
+        url = "http://%s:%d/notebook/" % (host, self.port)
+        server = NoteBookHttpServer(self.conn, port=self.port)
+        thread.start_new_thread(server.serve_forever, ())
+
+        conn2 = NoteBookConnectionHttp()
+        conn2.connect(url)
+        self.wait_for_server(conn2)
+
+        # Large files are sent with chunked transfer encoding.
+        data = ''.join(chr(i % 251) for i in xrange(300000))
+        with conn2.open_file(rootid, 'big.bin', 'w') as out:
+            for i in xrange(0, len(data), 1000):
+                out.write(data[i:i+1000])
+        with self.conn.open_file(rootid, 'big.bin') as infile:
+            self.assertEqual(infile.read(), data)
+
+        # Small files and appends.
+        with conn2.open_file(rootid, 'small.txt', 'w') as out:
+            out.write('hello')
+        with conn2.open_file(rootid, 'small.txt', 'a') as out:
+            out.write(' world')
+        with self.conn.open_file(rootid, 'small.txt') as infile:
+            self.assertEqual(infile.read(), 'hello world')
+
+        # Errors are reported on close.
+        out = conn2.open_file('missing', 'file.txt', 'w')
+        out.write('data')
+        self.assertRaises(connlib.FileError, out.close)
+
+        conn2.close()
+        server.shutdown()
+        self.notebook.close()
+
+    def test_etag_cache(self):
+        # Make a notebook on disk.
+        make_clean_dir(_tmpdir)
+        self.notebook = notebooklib.NoteBook()
+        self.notebook.create(_tmpdir + '/n1')
+        self.conn = self.notebook._conn
+        rootid = self.notebook.get_attr('nodeid')
+        with self.conn.open_file(rootid, 'file.txt', 'w') as out:
+            out.write('hello world')
+
+        host = "localhost"
+        self.port = 8129
+        url = "http://%s:%d/notebook/" % (host, self.port)
+        server = NoteBookHttpServer(self.conn, port=self.port)
+        thread.start_new_thread(server.serve_forever, ())
+
+        conn2 = NoteBookConnectionHttp(
+            prefetch_depth=0, cache_file=_tmpdir + '/cache.sqlite',
+            changes_interval=0)
+        conn2.connect(url)
+        self.wait_for_server(conn2)
+
+        # Unchanged nodes and files are answered with 304.
+        for path in ('nodes/' + rootid, 'nodes/%s/file.txt' % rootid,
+                     'nodes/%s/' % rootid):
+            stream = urllib2.urlopen(url + path)
+            etag = stream.info()['ETag']
+            stream.read()
+            request = urllib2.Request(url + path)
+            request.add_header('If-None-Match', etag)
+            try:
+                urllib2.urlopen(request)
+                self.fail('expected 304')
+            except urllib2.HTTPError, e:
+                self.assertEqual(e.code, 304)
+
+        # Reads are cached and revalidated.
+        attr = conn2.read_node(rootid)
+        self.assertEqual(conn2.read_node(rootid), attr)
+        self.assertTrue(conn2._cache.get_etag(
+            conn2._cache_key('/notebook/nodes/' + rootid)))
+        self.assertTrue('file.txt' in conn2.list_dir(rootid))
+        for i in range(2):
+            with conn2.open_file(rootid, 'file.txt') as infile:
+                self.assertEqual(infile.read(), 'hello world')
+        self.assertEqual(conn2.read_nodes([rootid]), [attr])
+
+        # Attrs of cached nodes are revalidated.
+        self.assertEqual(conn2.get_attr_by_id(rootid, 'title'),
+                         attr['title'])
+        attr2 = self.conn.read_node(rootid)
+        attr2['title'] = 'edited elsewhere'
+        self.conn.update_node(rootid, attr2)
+        self.assertEqual(conn2.get_attr_by_id(rootid, 'title'),
+                         'edited elsewhere')
+
+        # Attrs revalidated recently are used without a request.
+        conn3 = NoteBookConnectionHttp(
+            prefetch_depth=0, cache=conn2._cache, changes_interval=60)
+        conn3.connect(url)
+        conn3.read_node(rootid)
+        requests = []
+        urlopen = conn3._pool.urlopen
+
+        def count_request(*args, **kargs):
+            requests.append(args)
+            return urlopen(*args, **kargs)
+        conn3._pool.urlopen = count_request
+        for i in range(3):
+            self.assertEqual(conn3.get_attr_by_id(rootid, 'title'),
+                             'edited elsewhere')
+        self.assertEqual(requests, [])
+        conn3.close()
+
+        # Changes on the server are seen.
+        attr2 = self.conn.read_node(rootid)
+        attr2['title'] = 'new title'
+        self.conn.update_node(rootid, attr2)
+        self.assertEqual(conn2.read_node(rootid)['title'], 'new title')
+        self.assertEqual(conn2.read_nodes([rootid])[0]['title'], 'new title')
+        with self.conn.open_file(rootid, 'file.txt', 'w') as out:
+            out.write('new data')
+        with conn2.open_file(rootid, 'file.txt') as infile:
+            self.assertEqual(infile.read(), 'new data')
+
+        # Without server hashing, files are only downloaded to hash them
+        # when their ETag, i.e. size and mtime, changed.
+        def connect():
+            conn = NoteBookConnectionHttp(
+                prefetch_depth=0, cache_file=_tmpdir + '/cache.sqlite')
+            conn.connect(url)
+            index = conn.index
+            open_file = conn.open_file
+            conn.index = lambda query: (
+                None if query[0] == "file_hash" else index(query))
+
+            def count_open_file(*args, **kargs):
+                opened.append(args)
+                return open_file(*args, **kargs)
+            conn.open_file = count_open_file
+            return conn
+        opened = []
+        conn3 = connect()
+        digest = hashlib.sha1('new data').hexdigest()
+        self.assertEqual(conn3.get_file_hash(rootid, 'file.txt'), digest)
+        self.assertEqual(conn3.get_file_hash(rootid, 'file.txt'), digest)
+        self.assertEqual(len(opened), 1)
+        conn3.close()
+
+        # Hashes are kept in the cache file.
+        conn3 = connect()
+        self.assertEqual(conn3.get_file_hash(rootid, 'file.txt'), digest)
+        self.assertEqual(len(opened), 1)
+        with self.conn.open_file(rootid, 'file.txt', 'w') as out:
+            out.write('newer data')
+        self.assertEqual(conn3.get_file_hash(rootid, 'file.txt'),
+                         hashlib.sha1('newer data').hexdigest())
+        self.assertEqual(len(opened), 2)
+        with self.conn.open_file(rootid, 'empty.txt', 'w'):
+            pass
+        self.assertEqual(conn3.get_file_hash(rootid, 'empty.txt'),
+                         hashlib.sha1('').hexdigest())
+        self.assertRaises(connlib.UnknownFile,
+                          conn3.get_file_hash, rootid, 'missing.txt')
+        conn3.close()
+
+        conn2.close()
+        server.shutdown()
+        self.notebook.close()
+
+    def test_pool(self):
+        self.conn = mem.NoteBookConnectionMem()
+        self.notebook = notebooklib.NoteBook()
+        self.notebook.create('', self.conn)
+
+        host = "localhost"
+        self.port = 8130
+        url = "http://%s:%d/notebook/" % (host, self.port)
+        server = BaseNoteBookHttpServer(self.conn, port=self.port)
+        thread.start_new_thread(server.serve_forever, ())
+
+        conn2 = NoteBookConnectionHttp(prefetch_depth=0)
+        conn2.connect(url)
+        self.wait_for_server(conn2)
+        rootid = conn2.get_rootid()
+
+        # Several threads can use the connection at once.
+        errors = []
+
+        def read():
+            try:
+                for i in range(20):
+                    conn2.read_node(rootid)
+                    conn2.list_dir(rootid)
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=read) for i in range(8)]
+        for thread2 in threads:
+            thread2.start()
+        for thread2 in threads:
+            thread2.join()
+        self.assertEqual(errors, [])
+
+        # The server keeps connections open between requests.
+        connects = []
+        new_connection = conn2._pool.new_connection
+
+        def count_connects():
+            conn = new_connection()
+            connect = conn.connect
+
+            def connect2():
+                connects.append(True)
+                connect()
+            conn.connect = connect2
+            return conn
+        conn2._pool.new_connection = count_connects
+        conn2._pool.close()
+        for i in range(5):
+            self.assertEqual(conn2.get_rootid(), rootid)
+            conn2.read_nodes([rootid])
+        self.assertEqual(len(connects), 1)
+        del conn2._pool.new_connection
+
+        # Idle connections give up their worker to waiting requests.
+        conn2._pool.close()
+        start = time.time()
+        idle = [socket.create_connection((host, self.port))
+                for i in range(WORKERS)]
+        for sock in idle:
+            sock.sendall('GET /notebook/nodes/ HTTP/1.1\r\n'
+                         'Host: localhost\r\n\r\n')
+            self.assertTrue(sock.recv(1000).startswith('HTTP/1.1 200'))
+        self.assertEqual(conn2.get_rootid(), rootid)
+        self.assertTrue(time.time() - start < 2)
+        for sock in idle:
+            sock.close()
+
+        # Stale connections are replaced.
+        stale = httplib.HTTPConnection(conn2._pool.netloc)
+        stale.connect()
+        stale.sock.close()
+        conn2._pool._idle.append(stale)
+        self.assertEqual(conn2.get_rootid(), rootid)
+
+        # File streams use connections of the pool and give them back.
+        conn2._pool.close()
+        with conn2.open_file(rootid, "pool.txt", "w") as out:
+            out.write("hello")
+        self.assertEqual(len(conn2._pool._idle), 1)
+        with conn2.open_file(rootid, "pool.txt") as infile:
+            self.assertEqual(infile.read(), "hello")
+        self.assertEqual(len(conn2._pool._idle), 1)
+
+        # Unfinished reads hold their connection until closed.
+        infiles = [conn2.open_file(rootid, "pool.txt") for i in range(2)]
+        self.assertEqual(len(conn2._pool._idle), 0)
+        for infile in infiles:
+            infile.close()
+        for i in range(20):
+            with conn2.open_file(rootid, "pool.txt") as infile:
+                self.assertEqual(infile.read(), "hello")
+
+        conn2.close()
+        server.shutdown()
+        self.conn.close()
+
+    def test_workers(self):
+        self.conn = mem.NoteBookConnectionMem()
+        self.notebook = notebooklib.NoteBook()
+        self.notebook.create('', self.conn)
+
+        host = "localhost"
+        self.port = 8131
+        url = "http://%s:%d/notebook/" % (host, self.port)
+        server = BaseNoteBookHttpServer(self.conn, port=self.port, workers=2)
+        thread.start_new_thread(server.serve_forever, ())
+
+        conn2 = NoteBookConnectionHttp(prefetch_depth=0)
+        conn2.connect(url)
+        self.wait_for_server(conn2)
+
+        # A client that is slow to send its request does not block others.
+        slow = socket.create_connection((host, self.port))
+        slow.sendall('GET /notebook/nodes/ HTTP/1.0\r\n')
+        self.assertEqual(conn2.get_rootid(), self.notebook.get_attr('nodeid'))
+        slow.sendall('\r\n')
+        self.assertTrue(slow.recv(100).startswith('HTTP/1.1 200'))
+        slow.close()
+
+        # A slow file upload does not hold the write lock.
+        rootid = conn2.get_rootid()
+        slow = socket.create_connection((host, self.port))
+        slow.sendall('PUT /notebook/nodes/%s/slow.txt HTTP/1.0\r\n'
+                     'Content-Length: 10\r\n\r\nhello' % rootid)
+
+        def write():
+            with conn2.open_file(rootid, "fast.txt", "w") as out:
+                out.write("fast")
+        writer = threading.Thread(target=write)
+        writer.daemon = True
+        writer.start()
+        writer.join(10)
+        self.assertFalse(writer.is_alive())
+        slow.sendall('world')
+        self.assertTrue(slow.recv(100).startswith('HTTP/1.1 200'))
+        slow.close()
+        self.assertEqual(self.conn.open_file(rootid, "slow.txt").read(),
+                         "helloworld")
+        self.assertEqual(self.conn.open_file(rootid, "fast.txt").read(),
+                         "fast")
+
+        conn2.close()
+        server.shutdown()
+        self.conn.close()
+
+    def test_compression(self):
+        make_clean_dir(_tmpdir)
+        self.notebook = notebooklib.NoteBook()
+        self.notebook.create(_tmpdir + '/n1')
+        self.conn = self.notebook._conn
+        rootid = self.notebook.get_attr('nodeid')
+        text = 'hello world ' * 1000
+        for filename in ('page.html', 'image.png'):
+            with self.conn.open_file(rootid, filename, 'w') as out:
+                out.write(text)
+
+        host = "localhost"
+        self.port = 8132
+        url = "http://%s:%d/notebook/" % (host, self.port)
+        server = NoteBookHttpServer(self.conn, port=self.port)
+        thread.start_new_thread(server.serve_forever, ())
+
+        conn2 = NoteBookConnectionHttp(prefetch_depth=0)
+        conn2.connect(url)
+        self.wait_for_server(conn2)
+
+        def get(path, coding):
+            request = urllib2.Request(url + 'nodes/' + path)
+            request.add_header('Accept-Encoding', coding)
+            stream = urllib2.urlopen(request)
+            return stream.info().get('Content-Encoding'), stream.read()
+
+        # Large text responses are compressed.
+        coding, data = get(rootid + '/page.html', 'gzip')
+        self.assertEqual(coding, 'gzip')
+        self.assertEqual(zlib.decompress(data, 16 + zlib.MAX_WBITS), text)
+        coding, data = get(rootid + '/page.html', 'deflate;q=1, gzip;q=0.5')
+        self.assertEqual(coding, 'deflate')
+        self.assertEqual(zlib.decompress(data), text)
+        self.assertEqual(get(rootid + '/page.html', 'identity'),
+                         (None, text))
+
+        # Compressed types and small responses are sent as they are.
+        self.assertEqual(get(rootid + '/image.png', 'gzip'), (None, text))
+        self.assertEqual(get(rootid + '/', 'gzip')[0], None)
+
+        # The client decodes responses.
+        with conn2.open_file(rootid, 'page.html') as infile:
+            self.assertEqual(infile.read(), text)
+            self.assertEqual(infile.size, len(text))
+        with conn2.open_file(rootid, 'page.html') as infile:
+            infile.seek(-5, 2)
+            self.assertEqual(infile.read(), text[-5:])
+        nodes = list(conn2.read_tree(rootid))
+        self.assertEqual(nodes[0][0], rootid)
+
+        # Batch reads match the ETag of a compressed node.
+        nodeid = notebooklib.new_page(self.notebook, text).get_attr('nodeid')
+        request = urllib2.Request(url + 'nodes/' + nodeid)
+        request.add_header('Accept-Encoding', 'gzip')
+        etag = urllib2.urlopen(request).info().get('ETag')
+        self.assertTrue(etag.endswith('-gzip"'))
+        results = json.loads(urllib2.urlopen(
+            url + 'nodes?batch',
+            json.dumps([['read_node', nodeid, etag]])).read())
+        self.assertTrue(results[0]['not_modified'])
+
+        conn2.close()
+        server.shutdown()
+        self.notebook.close()
+
+    def test_changes(self):
+        make_clean_dir(_tmpdir)
+        self.notebook = notebooklib.NoteBook()
+        self.notebook.create(_tmpdir + '/n1')
+        self.conn = self.notebook._conn
+        rootid = self.notebook.get_attr('nodeid')
+
+        host = "localhost"
+        self.port = 8133
+        url = "http://%s:%d/notebook/" % (host, self.port)
+        server = NoteBookHttpServer(self.conn, port=self.port)
+        thread.start_new_thread(server.serve_forever, ())
+
+        conn2 = NoteBookConnectionHttp(prefetch_depth=0)
+        conn2.connect(url)
+        self.wait_for_server(conn2)
+        conn3 = NoteBookConnectionHttp(prefetch_depth=0)
+        conn3.connect(url)
+        self.assertEqual(conn2.poll_changes(), [])
+
+        # Changes made by other clients are listed.
+        conn3.create_node('n1', {'title': 'apple', 'parentids': [rootid]})
+        with conn3.open_file('n1', 'file.txt', 'w') as out:
+            out.write('hello')
+        changes = conn2.poll_changes()
+        self.assertEqual([(change['nodeid'], change['kind'])
+                          for change in changes],
+                         [('n1', 'create'), (rootid, 'update'),
+                          ('n1', 'file')])
+        self.assertEqual(changes[-1]['filename'], 'file.txt')
+        self.assertEqual(conn2.poll_changes(), [])
+
+        # Titles stay up to date.
+        self.assertEqual(conn2.search_node_titles('apple'),
+                         [('n1', 'apple')])
+        attr = conn3.read_node('n1')
+        attr['title'] = 'banana'
+        conn3.update_node('n1', attr)
+        self.assertEqual(conn2.search_node_titles('apple'), [])
+        self.assertEqual(conn2.search_node_titles('banana'),
+                         [('n1', 'banana')])
+
+        # Waiting for changes.
+        seq = conn2.get_changes()[0]
+        self.assertEqual(conn2.get_changes(seq, wait=0.1), (seq, [], True))
+
+        def update():
+            time.sleep(0.2)
+            conn3.delete_node('n1')
+        thread.start_new_thread(update, ())
+        seq2, changes, complete = conn2.get_changes(seq, wait=10)
+        self.assertEqual(changes[0]['kind'], 'delete')
+
+        conn2.close()
+        conn3.close()
+        server.shutdown()
+        self.notebook.close()
+
+    def test_search(self):
+        make_clean_dir(_tmpdir)
+        self.notebook = notebooklib.NoteBook()
+        self.notebook.create(_tmpdir + '/n1')
+        self.conn = self.notebook._conn
+        for title, text in [('crab apple', 'zebra'), ('apple pie', 'zebra'),
+                            ('banana', 'zebra'), ('apple', 'zebra'),
+                            ('stripes', 'zebra zebra zebra')]:
+            page = notebooklib.new_page(self.notebook, title)
+            with page.open_file(notebooklib.PAGE_DATA_FILE, 'w') as out:
+                out.write(notebooklib.NOTE_HEADER)
+                out.write('%s %s' % (title, text))
+                out.write(notebooklib.NOTE_FOOTER)
+            page.save(True)
+
+        host = "localhost"
+        self.port = 8134
+        url = "http://%s:%d/notebook/" % (host, self.port)
+        server = NoteBookHttpServer(self.conn, port=self.port)
+        thread.start_new_thread(server.serve_forever, ())
+
+        conn2 = NoteBookConnectionHttp(prefetch_depth=0)
+        conn2.connect(url)
+        self.wait_for_server(conn2)
+
+        # Titles are ranked and paged by the server.
+        results, more = conn2.search_titles('apple', limit=2)
+        self.assertEqual([title for nodeid, title in results],
+                         ['apple', 'apple pie'])
+        self.assertTrue(more)
+        results, more = conn2.search_titles('apple', offset=2, limit=2)
+        self.assertEqual([title for nodeid, title in results],
+                         ['crab apple'])
+        self.assertFalse(more)
+        self.assertEqual([title for nodeid, title in
+                          conn2.search_node_titles('apple')],
+                         ['apple', 'apple pie', 'crab apple'])
+
+        # Limited searches only fetch the results they need.
+        urls = []
+        request = conn2._request
+
+        def count_request(method, url, *args, **kargs):
+            urls.append(url)
+            return request(method, url, *args, **kargs)
+        conn2._request = count_request
+        self.assertEqual([title for nodeid, title in
+                          conn2.search_node_titles('apple', 1, 1)],
+                         ['apple pie'])
+        self.assertEqual(len(urls), 1)
+        self.assertTrue('limit=1' in urls[0] and 'offset=1' in urls[0])
+        del conn2._request
+
+        # Contents are ranked by their number of hits.
+        results, more = conn2.search_contents('zebra', limit=3)
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0][1], 'stripes')
+        self.assertTrue(more)
+        self.assertEqual(len(conn2.search_node_contents('zebra')), 5)
+        self.assertEqual(
+            [title for nodeid, title in conn2.search_contents('banana')[0]],
+            ['banana'])
+
+        conn2.close()
+        server.shutdown()
+        self.notebook.close()
+
+    def test_metrics(self):
+        make_clean_dir(_tmpdir)
+        self.notebook = notebooklib.NoteBook()
+        self.notebook.create(_tmpdir + '/n1')
+        self.conn = self.notebook._conn
+        rootid = self.notebook.get_attr('nodeid')
+
+        # Metrics are off by default.
+        self.assertEqual(NoteBookHttpServer(self.conn).metrics, None)
+
+        host = "localhost"
+        self.port = 8135
+        url = "http://%s:%d/notebook/" % (host, self.port)
+        server = NoteBookHttpServer(self.conn, port=self.port, metrics=True)
+        thread.start_new_thread(server.serve_forever, ())
+
+        conn2 = NoteBookConnectionHttp(prefetch_depth=0)
+        conn2.connect(url)
+        self.wait_for_server(conn2)
+
+        conn2.read_node(rootid)
+        with conn2.open_file(rootid, 'file.txt', 'w') as out:
+            out.write('hello world')
+        with conn2.open_file(rootid, 'file.txt') as infile:
+            infile.read()
+        self.assertRaises(connlib.UnknownNode, conn2.read_node, 'missing')
+
+        stream = urllib2.urlopen('http://%s:%d/metrics' % (host, self.port))
+        self.assertTrue(stream.info()['Content-Type'].startswith(
+            'text/plain'))
+        lines = stream.read().splitlines()
+        metrics = dict(line.rsplit(' ', 1) for line in lines
+                       if not line.startswith('#'))
+
+        node_route = 'method="GET",route="/notebook/nodes/<nodeid:re:[^/]+>"'
+        file_route = ('route="/notebook/nodes/<nodeid:re:[^/]*>/'
+                      '<filename:re:.*>"')
+        self.assertEqual(metrics['keepnote_http_requests_total{%s,'
+                                 'status="200"}' % node_route], '1')
+        self.assertEqual(metrics['keepnote_http_requests_total{%s,'
+                                 'status="404"}' % node_route], '1')
+        self.assertEqual(metrics['keepnote_http_request_duration_seconds_'
+                                 'bucket{%s,le="+Inf"}' % node_route], '2')
+        self.assertEqual(metrics['keepnote_http_request_bytes_total'
+                                 '{method="POST",%s}' % file_route], '11')
+        self.assertEqual(metrics['keepnote_http_response_bytes_total'
+                                 '{method="GET",%s}' % file_route], '11')
+        self.assertEqual(metrics['keepnote_http_requests_in_flight'], '1')
+        self.assertEqual(metrics['keepnote_connection_call_duration_seconds_'
+                                 'count{call="read_node"}'], '2')
+        self.assertEqual(metrics['keepnote_connection_call_duration_seconds_'
+                                 'count{call="open_file"}'], '2')
+
+        conn2.close()
+        server.shutdown()
+        self.notebook.close()
+
+    def test_loadtest(self):
+        make_clean_dir(_tmpdir)
+        mix = loadtest.parse_mix('read_node=2,search,write_file=1')
+        self.assertEqual(mix, {'read_node': 2, 'search': 1, 'write_file': 1})
+        self.assertRaises(ValueError, loadtest.parse_mix, 'unknown=1')
+
+        report = loadtest.load_test(
+            _tmpdir + '/n1', folders=2, pages=2, clients=2, count=10,
+            workers=2)
+        self.assertEqual(report['requests'], 20)
+        self.assertEqual(report['errors'], 0)
+        self.assertEqual(sum(op['requests'] for op in
+                             report['operations'].values()), 20)
+        latency = report['latency_ms']
+        self.assertTrue(latency['p50'] <= latency['p95'] <= latency['p99'])
+        self.assertFalse('metrics' in report)
+
+        # The server serves /metrics when the flag is on.
+        loadtest.main(['loadtest', '--metrics', '--notebook',
+                       _tmpdir + '/n2', '--folders', '2', '--pages', '2',
+                       '-c', '1', '-n', '5', '-o', _tmpdir + '/report.json'])
+        with open(_tmpdir + '/report.json') as infile:
+            report = json.load(infile)
+        self.assertTrue(report['config']['metrics'])
+        self.assertTrue('keepnote_http_requests_total{' in report['metrics'])
+
+    def test_read_cache(self):
+        make_clean_dir(_tmpdir)
+        self.notebook = notebooklib.NoteBook()
+        self.notebook.create(_tmpdir + '/n1')
+        self.conn = self.notebook._conn
+        rootid = self.notebook.get_attr('nodeid')
+        page = notebooklib.new_page(self.notebook, 'page1')
+        nodeid = page.get_attr('nodeid')
+
+        host = "localhost"
+        self.port = 8136
+        url = "http://%s:%d/notebook/" % (host, self.port)
+        server = NoteBookHttpServer(self.conn, port=self.port)
+        thread.start_new_thread(server.serve_forever, ())
+
+        conn2 = NoteBookConnectionHttp(prefetch_depth=0)
+        conn2.connect(url)
+        self.wait_for_server(conn2)
+
+        # Count node reads by the server.
+        reads = []
+        read_node = self.conn.read_node
+
+        def read_node2(nodeid, *args, **kargs):
+            reads.append(nodeid)
+            return read_node(nodeid, *args, **kargs)
+        self.conn.read_node = read_node2
+
+        def get(path):
+            return urllib2.urlopen(url + 'nodes/' + path).read()
+
+        self.assertEqual(json.loads(get(nodeid))['title'], 'page1')
+        self.assertEqual(json.loads(get(nodeid))['title'], 'page1')
+        self.assertEqual(reads, [nodeid])
+        self.assertTrue('page1' in get(rootid + '?all'))
+        del reads[:]
+        self.assertTrue('page1' in get(rootid + '?all'))
+        self.assertEqual(reads, [])
+
+        # Changes through the server are seen.
+        attr = conn2.read_node(nodeid)
+        attr['title'] = 'page2'
+        conn2.update_node(nodeid, attr)
+        self.assertEqual(json.loads(get(nodeid))['title'], 'page2')
+        self.assertTrue('page2' in get(rootid + '?all'))
+        conn2.create_node('n2', {'nodeid': 'n2', 'title': 'page3',
+                                 'parentids': [rootid]})
+        self.assertTrue('n2' in json.loads(get(rootid))['childrenids'])
+        self.assertTrue('page3' in get(rootid + '?all'))
+
+        # Changes on disk are seen.
+        attr = read_node(nodeid)
+        attr['title'] = 'page four'
+        self.conn.update_node(nodeid, attr)
+        self.assertEqual(json.loads(get(nodeid))['title'], 'page four')
+        self.assertTrue('page four' in get(rootid + '?all'))
+
+        # Cached node responses keep their ETags.
+        request = urllib2.Request(url + 'nodes/' + nodeid)
+        request.add_header('If-None-Match',
+                           urllib2.urlopen(request).info()['ETag'])
+        try:
+            urllib2.urlopen(request)
+            self.fail('expected 304')
+        except urllib2.HTTPError, e:
+            self.assertEqual(e.code, 304)
+
+        self.assertEqual(NoteBookHttpServer(self.conn, cache_size=0).cache,
+                         None)
+
+        conn2.close()
+        server.shutdown()
+        self.notebook.close()
+
+        # Least recently used entries are evicted.
+        cache = ReadCache(max_size=10)
+        cache.set(('node', 'a'), 'a', 4, {})
+        cache.set(('node', 'b'), 'b', 4, {})
+        cache.get(('node', 'a'))
+        cache.set(('tree', 'c'), 'c', 4, {})
+        self.assertEqual(cache.get(('node', 'b')), None)
+        self.assertEqual(cache.get(('node', 'a')), ('a', {}))
+        self.assertEqual(cache.get_size(), 8)
+        cache.clear('tree')
+        self.assertEqual(cache.get(('tree', 'c')), None)
+        self.assertEqual(cache.get_size(), 4)
+
+    def test_notebooks(self):
+        make_clean_dir(_tmpdir)
+        names = ['a', 'b', 'c']
+        for name in names:
+            book = notebooklib.NoteBook()
+            book.create(os.path.join(_tmpdir, name))
+            notebooklib.new_page(book, 'page in ' + name)
+            book.close()
+        os.mkdir(os.path.join(_tmpdir, 'other'))
+
+        host = "localhost"
+        self.port = 8137
+        url = "http://%s:%d/notebooks/" % (host, self.port)
+        server = NoteBookHttpServer(None, port=self.port,
+                                    notebook_dir=_tmpdir, max_notebooks=2)
+        thread.start_new_thread(server.serve_forever, ())
+
+        conns = {}
+        for name in names:
+            conns[name] = NoteBookConnectionHttp(prefetch_depth=0)
+            conns[name].connect(url + name + '/')
+        self.wait_for_server(conns['a'])
+
+        self.assertEqual(json.loads(urllib2.urlopen(url).read()),
+                         {'notebooks': names})
+
+        # Each notebook is served from its own directory.
+        for name in names:
+            conn = conns[name]
+            rootid = conn.get_rootid()
+            titles = [attr['title'] for nodeid, attr in
+                      conn.read_tree(rootid, depth=1) if nodeid != rootid]
+            self.assertEqual(sorted(titles), ['Trash', 'page in ' + name])
+            self.assertTrue(len(server.notebooks.get_open_names()) <= 2)
+        self.assertEqual(server.notebooks.get_open_names(), ['b', 'c'])
+
+        # Reopened notebooks keep their change seq numbers.
+        conn = conns['a']
+        rootid = conn.get_rootid()
+        conn.poll_changes()
+        seq = conn.get_changes()[0]
+        conn.create_node('n1', {'nodeid': 'n1', 'title': 'new',
+                                'parentids': [rootid]})
+        conns['b'].get_rootid()
+        conns['c'].get_rootid()
+        self.assertFalse('a' in server.notebooks.get_open_names())
+        seq2, changes, complete = conn.get_changes(seq)
+        self.assertFalse(complete)
+        self.assertTrue(seq2 > seq)
+        self.assertTrue(conn.has_node('n1'))
+
+        # A notebook is opened once, without blocking the others.
+        pool = server.notebooks
+        pool.close()
+        opening = threading.Event()
+        proceed = threading.Event()
+        opened = []
+        open_conn = pool._open_conn
+
+        def slow_open(path):
+            opened.append(os.path.basename(path))
+            if os.path.basename(path) == 'a':
+                opening.set()
+                proceed.wait(10)
+            return open_conn(path)
+        pool._open_conn = slow_open
+        acquired = []
+        threads = [threading.Thread(
+            target=lambda: acquired.append(pool.acquire('a')))
+            for i in range(2)]
+        for thread2 in threads:
+            thread2.start()
+        opening.wait(10)
+        start = time.time()
+        pool.release(pool.acquire('b'))
+        self.assertTrue(time.time() - start < 5)
+        proceed.set()
+        for thread2 in threads:
+            thread2.join()
+        self.assertEqual(opened, ['a', 'b'])
+        self.assertTrue(acquired[0] is acquired[1])
+        for notebook in acquired:
+            pool.release(notebook)
+        pool._open_conn = open_conn
+
+        # Unknown notebooks are not found.
+        for name in ['other', '..', 'missing']:
+            conn2 = NoteBookConnectionHttp()
+            conn2.connect(url + name + '/')
+            self.assertRaises(connlib.ConnectionError, conn2.get_rootid)
+
+        for conn in conns.values():
+            conn.close()
+        server.shutdown()
+        self.assertEqual(server.notebooks.get_open_names(), [])
+
+    def test_offline(self):
+        make_clean_dir(_tmpdir)
+        self.notebook = notebooklib.NoteBook()
+        self.notebook.create(_tmpdir + '/n1')
+        self.conn = self.notebook._conn
+        rootid = self.notebook.get_attr('nodeid')
+        nodeid1 = notebooklib.new_page(self.notebook, 'page1').get_attr(
+            'nodeid')
+        nodeid2 = notebooklib.new_page(self.notebook, 'page2').get_attr(
+            'nodeid')
+        with self.conn.open_file(nodeid1, 'file.txt', 'w') as out:
+            out.write('hello')
+
+        host = "localhost"
+        self.port = 8138
+        url = "http://%s:%d/notebook/" % (host, self.port)
+        server = NoteBookHttpServer(self.conn, port=self.port)
+        thread.start_new_thread(server.serve_forever, ())
+
+        # Wait without a journal, which would go offline.
+        conn = NoteBookConnectionHttp()
+        conn.connect(url)
+        self.wait_for_server(conn)
+        conn.close()
+
+        journal = WriteJournal(_tmpdir + '/journal.log')
+        conn2 = NoteBookConnectionHttp(
+            cache_file=_tmpdir + '/cache.sqlite', journal=journal)
+        conn2.connect(url)
+
+        # Fill the cache while online.
+        self.assertEqual(conn2.get_rootid(), rootid)
+        conn2.read_node(rootid)
+        attr1 = conn2.read_node(nodeid1)
+        attr2 = conn2.read_node(nodeid2)
+        with conn2.open_file(nodeid1, 'file.txt') as infile:
+            self.assertEqual(infile.read(), 'hello')
+        self.assertTrue('file.txt' in conn2.list_dir(nodeid1))
+        server.shutdown()
+
+        # A file write finds the server down and is journaled.
+        self.assertFalse(conn2.is_offline())
+        with conn2.open_file(nodeid2, 'page.html', 'w') as out:
+            out.write('offline page')
+        self.assertTrue(conn2.is_offline())
+        with conn2.open_file(nodeid2, 'page.html') as infile:
+            self.assertEqual(infile.read(), 'offline page')
+
+        # Data already sent in chunks goes to the fallback too.
+        written = []
+        writer = HttpFileWriter(
+            conn2._pool, '/notebook/nodes/%s/f.txt' % nodeid2,
+            chunk_size=4,
+            fallback=lambda: OfflineFile(on_close=written.append))
+        writer.write('hello ')
+        writer.write('world')
+        writer.close()
+        self.assertEqual(written, ['hello world'])
+
+        # Reads are served from the cache and writes are journaled.
+        self.assertEqual(conn2.get_rootid(), rootid)
+        self.assertTrue(conn2.is_offline())
+        self.assertEqual(conn2.read_node(nodeid1)['title'], 'page1')
+        attr1['title'] = 'page1 offline'
+        conn2.update_node(nodeid1, attr1)
+        attr1['title'] = 'page1 edited'
+        conn2.update_node(nodeid1, attr1)
+        self.assertEqual(conn2.read_node(nodeid1)['title'], 'page1 edited')
+        attr2['title'] = 'page2 offline'
+        conn2.update_node(nodeid2, attr2)
+        with conn2.open_file(nodeid1, 'file.txt', 'a') as out:
+            out.write(' world')
+        with conn2.open_file(nodeid1, 'file.txt') as infile:
+            self.assertEqual(infile.read(), 'hello world')
+        conn2.create_node('n3', {'nodeid': 'n3', 'title': 'page3',
+                                 'parentids': [rootid]})
+        with conn2.open_file('n3', 'new.txt', 'w') as out:
+            out.write('new')
+        self.assertTrue('n3' in conn2.read_node(rootid)['childrenids'])
+        self.assertEqual(conn2.list_dir('n3'), ['new.txt'])
+        self.assertRaises(connlib.ConnectionError, conn2.delete_node, 'n3')
+        attr3 = conn2.read_node('n3')
+        attr3['title'] = 'page3 edited'
+        conn2.update_node('n3', attr3)
+        conn2.create_node('n4', {'nodeid': 'n4', 'title': 'page4',
+                                 'parentids': [rootid]})
+        conn2.update_node('n4', {'nodeid': 'n4', 'title': 'page4 edited',
+                                 'parentids': [rootid]})
+        self.assertEqual(len(journal.get_entries()), 10)
+
+        # The journal survives a restart.
+        self.assertEqual(len(WriteJournal(
+            _tmpdir + '/journal.log').get_entries()), 10)
+
+        # Skipped entries stay skipped after a restart.
+        journal2 = WriteJournal(_tmpdir + '/journal2.log')
+        for nodeid in ('a', 'b', 'c'):
+            journal2.append('create_node', nodeid, attr={'nodeid': nodeid})
+        journal2.skip(1)
+        journal2.skip(1)
+        self.assertEqual([entry['nodeid'] for entry in WriteJournal(
+            _tmpdir + '/journal2.log').get_entries()], ['c'])
+        journal2.compact()
+        self.assertEqual(len(open(_tmpdir + '/journal2.log').readlines()),
+                         1)
+
+        # Meanwhile, page2 changes and a node n4 is made on the server.
+        attr = self.conn.read_node(nodeid2)
+        attr['title'] = 'page2 server'
+        self.conn.update_node(nodeid2, attr)
+        self.conn.create_node('n4', {'nodeid': 'n4', 'title': 'server n4',
+                                     'parentids': [rootid]})
+
+        server = NoteBookHttpServer(self.conn, port=self.port)
+        thread.start_new_thread(server.serve_forever, ())
+        time.sleep(0.5)
+
+        # Writes are replayed in order, except conflicting ones.
+        conflicts = conn2.replay()
+        self.assertFalse(conn2.is_offline())
+        self.assertEqual([(entry['op'], entry['nodeid'])
+                          for entry in conflicts],
+                         [('update_node', nodeid2), ('create_node', 'n4'),
+                          ('update_node', 'n4')])
+        self.assertEqual([entry['nodeid'] for entry in
+                          conn2.get_conflicts()], [nodeid2, 'n4', 'n4'])
+        self.assertFalse(journal.has_entries())
+        self.assertEqual(WriteJournal(
+            _tmpdir + '/journal.log').get_entries(), [])
+        self.assertEqual(self.conn.read_node(nodeid1)['title'],
+                         'page1 edited')
+        self.assertEqual(self.conn.read_node(nodeid2)['title'],
+                         'page2 server')
+        self.assertEqual(self.conn.read_node('n3')['title'], 'page3 edited')
+        self.assertEqual(self.conn.read_node('n4')['title'], 'server n4')
+        with self.conn.open_file(nodeid1, 'file.txt') as infile:
+            self.assertEqual(infile.read(), 'hello world')
+        with self.conn.open_file('n3', 'new.txt') as infile:
+            self.assertEqual(infile.read(), 'new')
+        with self.conn.open_file(nodeid2, 'page.html') as infile:
+            self.assertEqual(infile.read(), 'offline page')
+        self.assertEqual(conn2.read_node(nodeid1)['title'], 'page1 edited')
+
+        conn2.close()
+        server.shutdown()
+        self.notebook.close()
+
+    def test_change_log(self):
+        log = ChangeLog(size=3, seq=0)
+        for i in range(5):
+            log.add('n%d' % i, 'update')
+        self.assertEqual(log.get_seq(), 5)
+
+        seq, changes, complete = log.get_changes(2)
+        self.assertEqual([change['nodeid'] for change in changes],
+                         ['n2', 'n3', 'n4'])
+        self.assertTrue(complete)
+
+        # Missed changes and unknown seq numbers are reported.
+        self.assertFalse(log.get_changes(1)[2])
+        self.assertEqual(log.get_changes(7), (5, [], False))
+
+        # A new log, as after a server restart, does not reuse seq numbers.
+        log = ChangeLog()
+        for i in range(5):
+            log.add('n%d' % i, 'update')
+        seq = log.get_seq()
+        time.sleep(0.01)
+        log = ChangeLog()
+        self.assertTrue(log.get_seq() > seq)
+        self.assertFalse(log.get_changes(seq)[2])
+
+    def test_cache_eviction(self):
+        make_clean_dir(_tmpdir)
+        filename = _tmpdir + '/cache.sqlite'
+        cache = HttpCache(filename, max_size=100)
+        cache.set('http://host/a', '"a"', 'a' * 40)
+        cache.set('http://host/b', '"b"', 'b' * 40)
+        cache.get('http://host/a')
+
+        # The least recently used entry is evicted.
+        cache.set('http://host/c', '"c"', 'c' * 40)
+        self.assertEqual(cache.get('http://host/a'), ('"a"', 'a' * 40))
+        self.assertEqual(cache.get('http://host/b'), None)
+        self.assertEqual(cache.get_size(), 80)
+
+        # Entries larger than the cache are not kept.
+        cache.set('http://host/a', '"a2"', 'a' * 200)
+        self.assertEqual(cache.get('http://host/a'), None)
+        self.assertEqual(cache.get_size(), 40)
+        cache.close()
+
+        # The cache persists.
+        cache = HttpCache(filename, max_size=100)
+        self.assertEqual(cache.get('http://host/c'), ('"c"', 'c' * 40))
+        self.assertEqual(cache.get_size(), 40)
+        cache.close()
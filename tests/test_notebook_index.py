@@ -11,6 +11,10 @@ import traceback
 
 # keepnote imports
 from keepnote import notebook
+from keepnote import tasklib
+from keepnote.notebook.connection.fs import index as notebook_index
+from keepnote.notebook.connection.index import key_to_nodeid
+from keepnote.notebook.connection.index import nodeid_to_key
 
 from . import clean_dir, TMP_DIR
 
@@ -135,6 +139,11 @@ class Index (unittest.TestCase):
         results = book.search_node_titles("Page")
         self.assertTrue(len(results) >= 7)
 
+        # Results can be limited.
+        self.assertEqual(book.search_node_titles("Page", 3), results[:3])
+        self.assertEqual(book._conn.search_node_titles("Page", 3, 2),
+                         results[2:5])
+
         book.close()
 
     def test_index_all(self):
@@ -147,6 +156,190 @@ class Index (unittest.TestCase):
 
         book.close()
 
+    def test_nodeid_keys(self):
+        """Nodeids are stored as compact keys."""
+        nodeid = notebook.new_nodeid()
+        key = nodeid_to_key(nodeid)
+        self.assertEqual(len(key), 16)
+        self.assertEqual(key_to_nodeid(key), nodeid)
+
+        # Non-canonical nodeids are stored unchanged.
+        for nodeid in [u'n1', nodeid.upper(), u'']:
+            self.assertEqual(nodeid_to_key(nodeid), nodeid)
+            self.assertEqual(key_to_nodeid(nodeid_to_key(nodeid)), nodeid)
+
+    def test_index_handles(self):
+        """Index tables are keyed by integer node handles."""
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+        index_file = book._conn._get_index_file()
+        book.close()
+
+        con = sqlite.connect(index_file)
+        keys = [key for (key,) in con.execute("SELECT nodeid FROM NodeIds")]
+        self.assertTrue(len(keys) >= 7)
+        self.assertTrue(all(len(key) == 16 for key in keys))
+        self.assertTrue(self._pagex_nodeid in map(key_to_nodeid, keys))
+
+        row = con.execute("""SELECT t.value
+            FROM Attr_title AS t JOIN NodeIds AS n ON n.handle = t.handle
+            WHERE n.nodeid = ?""", (nodeid_to_key(self._pagex_nodeid),))
+        self.assertEqual(row.fetchone()[0], 'Page X')
+        con.close()
+
+    def test_index_remove_node(self):
+        """Removing a node removes its subtree and their handles."""
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+        conn = book._conn
+        index_file = conn._get_index_file()
+        page = notebook.new_page(book, 'Removed')
+        child = notebook.new_page(page, 'Removed child')
+        book.save()
+        keys = [nodeid_to_key(node.get_attr('nodeid'))
+                for node in (page, child)]
+
+        # the subtree is deleted on disk with its root
+        conn.delete_node(page.get_attr('nodeid'))
+        book.close()
+
+        con = sqlite.connect(index_file)
+        for key in keys:
+            self.assertEqual(con.execute(
+                "SELECT COUNT(*) FROM NodeIds WHERE nodeid=?",
+                (key,)).fetchone()[0], 0)
+        self.assertEqual(con.execute(
+            """SELECT COUNT(*) FROM NodeGraph AS g
+               LEFT JOIN NodeIds AS n ON n.handle = g.handle
+               WHERE n.handle IS NULL""").fetchone()[0], 0)
+        con.close()
+
+    def test_index_rollback(self):
+        """Handles created in a rolled back transaction are forgotten."""
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+        index = book._conn._index
+        # the background reindexing commits as it goes
+        index._reindex.stop()
+        nodeid = notebook.new_nodeid()
+        handle = index.get_handle(index.cur, nodeid, create=True)
+        self.assertEqual(index.get_handle(index.cur, nodeid), handle)
+        index.rollback()
+        self.assertEqual(index.get_handle(index.cur, nodeid), None)
+        book.close()
+
+    def test_index_file_hashes(self):
+        """File hashes are stored in the index and bounded."""
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+        conn = book._conn
+        index_file = conn._get_index_file()
+        page = notebook.new_page(book, 'Hashed')
+        nodeid = page.get_attr('nodeid')
+        for i in range(4):
+            with page.open_file('file%d' % i, 'w') as out:
+                out.write('data %d' % i)
+        book.save()
+
+        limit = notebook_index.FILE_HASH_LIMIT
+        notebook_index.FILE_HASH_LIMIT = 2
+        try:
+            digests = [conn.get_file_hash(nodeid, 'file%d' % i)
+                       for i in range(4)]
+        finally:
+            notebook_index.FILE_HASH_LIMIT = limit
+        book.close()
+
+        # only the newest hashes are kept
+        con = sqlite.connect(index_file)
+        rows = con.execute("SELECT filename, hash FROM FileHashes").fetchall()
+        self.assertEqual(sorted(rows), [('file2', digests[2]),
+                                        ('file3', digests[3])])
+        con.execute("UPDATE FileHashes SET hash='stored' "
+                    "WHERE filename='file3'")
+        con.commit()
+        con.close()
+
+        # stored hashes are used after reopening
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+        self.assertEqual(book._conn.get_file_hash(nodeid, 'file3'), 'stored')
+        self.assertEqual(book._conn.get_file_hash(nodeid, 'file0'),
+                         digests[0])
+
+        # and removed with their node
+        book.get_node_by_id(nodeid).delete()
+        book.empty_trash()
+        book.save()
+        book.close()
+        con = sqlite.connect(index_file)
+        self.assertEqual(
+            con.execute("SELECT COUNT(*) FROM FileHashes").fetchone()[0], 0)
+        con.close()
+
+    def test_index_version_upgrade(self):
+        """An index with an old version is rebuilt."""
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+        index_file = book._conn._get_index_file()
+        book.close()
+
+        con = sqlite.connect(index_file)
+        con.execute("INSERT INTO Version VALUES (?, datetime('now'));",
+                    (notebook_index.INDEX_VERSION - 1,))
+        con.execute("DELETE FROM Version WHERE version = ?;",
+                    (notebook_index.INDEX_VERSION,))
+        con.commit()
+        con.close()
+
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+        self.assertTrue(book.index_needed())
+        for node in book.index_all():
+            pass
+        self.assertFalse(book.index_needed())
+
+        node = book.get_node_by_id(self._pagex_nodeid)
+        self.assertEqual(node.get_title(), 'Page X')
+        book.close()
+
+    def test_index_maintenance(self):
+        """Index maintenance reclaims free pages in small steps."""
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+
+        stats = book.index(["index_stats"])
+        self.assertEqual(stats["auto_vacuum"],
+                         notebook_index.AUTO_VACUUM_INCREMENTAL)
+
+        # Create and delete pages to produce free pages.
+        pages = [notebook.new_page(book, 'Temp %d' % i) for i in range(20)]
+        for page in pages:
+            write_content(page, 'temporary ' * 1000)
+        book.save()
+        for page in pages:
+            page.delete()
+        book.save()
+
+        task = tasklib.Task()
+        steps = list(book.index(["maintain", task, 4]))
+        self.assertTrue(steps.count("vacuum") > 1)
+        self.assertEqual(steps[-1], "check")
+        if sqlite.sqlite_version_info >= (3, 33, 0):
+            # The check is done a table at a time.
+            self.assertTrue(steps.count("check") > 1)
+
+        stats = task.get_result()
+        self.assertTrue(stats["ok"])
+        self.assertEqual(stats["freelist_count"], 0)
+        self.assertEqual(task.get_percent(), 1.0)
+
+        # Full compaction also works.
+        book.index(["compact"])
+        results = list(book.search_node_contents('world'))
+        self.assertEqual(len(results), 2)
+        book.close()
+
     def test_fts3(self):
         """Ensure full-text search is available."""
         con = sqlite.connect(":memory:")
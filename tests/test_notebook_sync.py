@@ -1,10 +1,16 @@
 
 # python imports
+import hashlib
 import os
+import threading
+import time
 import unittest
 
 # keepnote imports
 from keepnote import notebook
+from keepnote import tasklib
+from keepnote.notebook.connection.fs import NoteBookConnectionFS
+from keepnote.notebook.connection.mem import NoteBookConnectionMem
 import keepnote.notebook.sync as sync
 
 from . import clean_dir, makedirs, TMP_DIR
@@ -77,3 +83,413 @@ class Sync (unittest.TestCase):
         attr = notebook2._conn.read_node(n.get_attr("nodeid"))
         self.assert_(attr["title"] == "node2")
         notebook2.close()
+
+    def test_sync_files(self):
+
+        # initialize two notebooks
+        clean_dir(_datapath + "/n5")
+        clean_dir(_datapath + "/n6")
+        makedirs(_datapath)
+
+        notebook1 = notebook.NoteBook()
+        notebook1.create(_datapath + "/n5")
+        conn1 = notebook1._conn
+        conn2 = NoteBookConnectionFS()
+        conn2.connect(_datapath + "/n6")
+
+        n = notebook1.new_child("text/html", "node1")
+        nodeid = n.get_attr("nodeid")
+        for name in ["file1", "file2", "dir/file3"]:
+            out = n.open_file(name, "w")
+            out.write("hello " + name)
+            out.close()
+        sync.sync_tree(conn1, conn2)
+
+        # file hashes match between connections
+        digest = hashlib.sha1("hello file1").hexdigest()
+        self.assertEqual(conn1.get_file_hash(nodeid, "file1"), digest)
+        self.assertEqual(conn2.get_file_hash(nodeid, "file1"), digest)
+        conn3 = NoteBookConnectionMem()
+        sync.sync_tree(conn1, conn3)
+        self.assertEqual(conn3.get_file_hash(nodeid, "file1"), digest)
+
+        # only changed files are copied
+        def get_inode(name):
+            return os.stat(os.path.join(_datapath, "n6", "node1", name)).st_ino
+        inodes = dict((name, get_inode(name))
+                      for name in ["file1", "file2", "dir/file3"])
+        out = n.open_file("file2", "w")
+        out.write("changed")
+        out.close()
+        self.assertEqual(conn1.get_file_hash(nodeid, "file2"),
+                         hashlib.sha1("changed").hexdigest())
+        sync.sync_files(conn1, nodeid, conn2, nodeid)
+
+        self.assertEqual(get_inode("file1"), inodes["file1"])
+        self.assertEqual(get_inode("dir/file3"), inodes["dir/file3"])
+        self.assertNotEqual(get_inode("file2"), inodes["file2"])
+        stream = conn2.open_file(nodeid, "file2")
+        self.assertEqual(stream.read(), "changed")
+        stream.close()
+
+        conn2.close()
+        notebook1.close()
+
+    def test_sync_delta(self):
+
+        clean_dir(_datapath + "/n14")
+        clean_dir(_datapath + "/n15")
+        makedirs(_datapath)
+
+        notebook1 = notebook.NoteBook()
+        notebook1.create(_datapath + "/n14")
+        conn1 = notebook1._conn
+        conn2 = NoteBookConnectionFS()
+        conn2.connect(_datapath + "/n15")
+
+        n = notebook1.new_child("text/html", "node1")
+        nodeid = n.get_attr("nodeid")
+        data = os.urandom(sync.SYNC_DELTA_MIN_SIZE + 100000)
+        for name, size in [("big", len(data)), ("small", 1000)]:
+            out = n.open_file(name, "w")
+            out.write(data[:size])
+            out.close()
+        sync.sync_tree(conn1, conn2)
+
+        def write(name, data):
+            out = n.open_file(name, "w")
+            out.write(data)
+            out.close()
+
+        def read(name):
+            stream = conn2.open_file(nodeid, name)
+            data = stream.read()
+            stream.close()
+            return data
+
+        # large files are sent as deltas
+        data = data[:500000] + "changed" + data[500100:]
+        write("big", data)
+        self.assertTrue(sync.copy_file_delta(conn1, nodeid, "big",
+                                             conn2, nodeid, "big"))
+        self.assertEqual(read("big"), data)
+        write("small", "changed")
+        self.assertFalse(sync.copy_file_delta(conn1, nodeid, "small",
+                                              conn2, nodeid, "small"))
+
+        data = "prepend" + data + "append"
+        write("big", data)
+        sync.sync_files(conn1, nodeid, conn2, nodeid)
+        self.assertEqual(read("big"), data)
+        self.assertEqual(read("small"), "changed")
+
+        # files that changed throughout are copied whole
+        data = os.urandom(len(data))
+        write("big", data)
+        self.assertFalse(sync.copy_file_delta(conn1, nodeid, "big",
+                                              conn2, nodeid, "big"))
+        sync.sync_files(conn1, nodeid, conn2, nodeid)
+        self.assertEqual(read("big"), data)
+
+        # patched files are recorded in the checkpoint
+        data = data[:500000] + "changed again" + data[500100:]
+        write("big", data)
+        checkpoint = sync.SyncCheckpoint(_datapath + "/n15.checkpoint")
+        self.assertTrue(sync.copy_file_delta(
+            conn1, nodeid, "big",
+            sync.SyncConnection(conn2, checkpoint=checkpoint), nodeid, "big"))
+        self.assertEqual(read("big"), data)
+        self.assertEqual(checkpoint.get_file_hash(nodeid, "big"),
+                         hashlib.sha1(data).hexdigest())
+        checkpoint.clear()
+        checkpoint.close()
+
+        conn2.close()
+        notebook1.close()
+
+    def test_sync_tree(self):
+
+        # initialize notebook with a fresh index
+        clean_dir(_datapath + "/n3")
+        clean_dir(_datapath + "/n3-copy")
+        clean_dir(_datapath + "/n3-sync")
+        makedirs(_datapath + "/n3-sync")
+        watermarks_file = _datapath + "/n3-sync/watermarks.json"
+
+        book = notebook.NoteBook()
+        book.create(_datapath + "/n3")
+        nodes = []
+        for i in range(3):
+            node = book.new_child("text/html", "node%d" % i)
+            node.new_child("text/html", "child%d" % i)
+            nodes.append(node)
+        out = nodes[0].open_file("page.html", "w")
+        out.write("hello")
+        out.close()
+        book.save()
+        list(book.index_all())
+        conn = book._conn
+
+        # first sync copies every node
+        conn2 = NoteBookConnectionFS()
+        conn2.connect(_datapath + "/n3-copy")
+        watermarks = sync.SyncWatermarks(watermarks_file)
+        watermark = sync.sync_tree(conn, conn2, watermarks, "n3")
+        self.assertEqual(len(list(sync.iter_tree_attrs(conn2))), 8)
+        self.assertEqual(watermarks.get("n3"), watermark)
+        stream = conn2.open_file(nodes[0].get_attr("nodeid"), "page.html")
+        self.assertEqual(stream.read(), "hello")
+        stream.close()
+
+        # changed nodes are found through the index
+        nodes[1].set_attr("title", "renamed")
+        nodes[1].set_attr("modified_time", watermark + 10)
+        book.save()
+        self.assertEqual(conn.index(["modified_since", watermark + 1]),
+                         [(nodes[1].get_attr("nodeid"), watermark + 10)])
+        sync.sync_tree(conn, conn2, watermarks, "n3")
+        self.assertEqual(
+            conn2.read_node(nodes[1].get_attr("nodeid"))["title"], "renamed")
+
+        # only nodes changed since the last sync are synced
+        # (nodes modified at the watermark itself are synced again)
+        nodes[2].set_attr("title", "renamed2")
+        nodes[2].set_attr("modified_time", watermark + 20)
+        book.save()
+        task = tasklib.Task()
+        watermarks = sync.SyncWatermarks(watermarks_file)
+        self.assertEqual(watermarks.get("n3"), watermark + 10)
+        self.assertEqual(sync.sync_tree(conn, conn2, watermarks, "n3",
+                                        task=task), watermark + 20)
+        self.assertEqual(sorted(msg for kind, msg in task.get_messages()
+                                if kind == "detail"), ["renamed", "renamed2"])
+        self.assertEqual(task.get_percent(), 1.0)
+        self.assertEqual(
+            conn2.read_node(nodes[2].get_attr("nodeid"))["title"], "renamed2")
+
+        # without an up to date index the tree is walked
+        self.assertEqual(conn2.index(["modified_since", 0]), None)
+        self.assertEqual(
+            sorted(attr["nodeid"] for attr in
+                   sync.get_changed_attrs(conn2, watermark + 10)),
+            sorted([nodes[1].get_attr("nodeid"),
+                    nodes[2].get_attr("nodeid")]))
+        conn2.close()
+        book.close()
+
+    def test_sync_deleted(self):
+
+        clean_dir(_datapath + "/n16")
+        clean_dir(_datapath + "/n16-copy")
+        clean_dir(_datapath + "/n16-sync")
+        makedirs(_datapath + "/n16-sync")
+        watermarks_file = _datapath + "/n16-sync/watermarks.json"
+
+        book = notebook.NoteBook()
+        book.create(_datapath + "/n16")
+        nodes = []
+        for i in range(3):
+            node = book.new_child("text/html", "node%d" % i)
+            node.new_child("text/html", "child%d" % i)
+            nodes.append(node)
+        book.save()
+        conn = book._conn
+        nodeids = [n.get_attr("nodeid") for n in nodes]
+        childids = [n.get_children()[0].get_attr("nodeid") for n in nodes]
+
+        conn2 = NoteBookConnectionFS()
+        conn2.connect(_datapath + "/n16-copy")
+        watermarks = sync.SyncWatermarks(watermarks_file)
+        sync.sync_tree(conn, conn2, watermarks, "n16")
+        self.assertEqual(len(list(sync.iter_tree_attrs(conn2))), 8)
+
+        # deleted nodes are recorded in the index
+        start = time.time()
+        nodes[0].delete()
+        nodes[1].delete()
+        nodes[2].get_children()[0].delete()
+        book.save()
+        self.assertEqual(
+            sorted(nodeid for nodeid, mtime in
+                   conn.index(["deleted_since", start])),
+            sorted(nodeids[:2] + childids))
+        self.assertEqual(conn.index(["deleted_since", 0]), None)
+
+        # and deleted from the copy, unless changed there after
+        changed = conn2.read_node(nodeids[1])
+        changed["modified_time"] = time.time() + 100
+        conn2.update_node(nodeids[1], changed)
+        task = tasklib.Task()
+        sync.sync_tree(conn, conn2, watermarks, "n16", task=task)
+        remaining = [attr["nodeid"] for attr in sync.iter_tree_attrs(conn2)]
+        self.assertFalse(nodeids[0] in remaining)
+        self.assertFalse(childids[0] in remaining)
+        self.assertFalse(childids[2] in remaining)
+        self.assertTrue(nodeids[1] in remaining)
+        self.assertTrue(childids[1] not in remaining)
+        self.assertTrue(("detail", "kept changed note 'node1'")
+                        in task.get_messages())
+
+        # deletions that are not recorded are reported
+        conn3 = NoteBookConnectionMem()
+        conn3.create_node(conn.get_rootid(), conn.read_node(conn.get_rootid()))
+        task = tasklib.Task()
+        sync.sync_tree(conn3, conn2, task=task)
+        self.assertTrue(("text", "deleted notes were not synced")
+                        in task.get_messages())
+
+        conn2.close()
+        book.close()
+
+    def test_sync_resume(self):
+
+        clean_dir(_datapath + "/n7")
+        clean_dir(_datapath + "/n7-copy")
+        clean_dir(_datapath + "/n7-sync")
+        makedirs(_datapath + "/n7-sync")
+        watermarks_file = _datapath + "/n7-sync/watermarks.json"
+
+        book = notebook.NoteBook()
+        book.create(_datapath + "/n7")
+        node = book.new_child("text/html", "node")
+        nodeid = node.get_attr("nodeid")
+        for name in ["file1", "file2"]:
+            out = node.open_file(name, "w")
+            out.write("hello " + name)
+            out.close()
+        for i in range(3):
+            book.new_child("text/html", "other%d" % i)
+        book.save()
+        conn = book._conn
+        conn2 = NoteBookConnectionFS()
+        conn2.connect(_datapath + "/n7-copy")
+
+        # interrupt the sync while the node's second file is written
+        class FailingConnection (object):
+            def __init__(self, conn):
+                self._conn = conn
+                self.written = []
+
+            def open_file(self, nodeid, filename, mode="r", codec=None):
+                if mode == "w" and nodeid == node.get_attr("nodeid"):
+                    if len(self.written) == 1:
+                        raise IOError("interrupted")
+                    self.written.append(filename)
+                return self._conn.open_file(nodeid, filename, mode, codec)
+
+            def __getattr__(self, name):
+                return getattr(self._conn, name)
+
+        failing = FailingConnection(conn2)
+        watermarks = sync.SyncWatermarks(watermarks_file)
+        self.assertRaises(IOError, sync.sync_tree, conn, failing,
+                          watermarks, "n7", workers=1, dest="n7-copy")
+        self.assertEqual(watermarks.get("n7", "n7-copy"), None)
+
+        # syncs to other destinations have their own checkpoints
+        self.assertFalse(watermarks.get_checkpoint("n7").has_entries())
+        self.assertFalse(
+            watermarks.get_checkpoint("n7", "n7-other").has_entries())
+
+        checkpoint = watermarks.get_checkpoint("n7", "n7-copy")
+        attrs = list(sync.iter_tree_attrs(conn))
+        done = [attr["title"] for attr in attrs if checkpoint.is_done(attr)]
+        self.assertTrue(checkpoint.is_started(nodeid))
+        self.assertTrue(done)
+        self.assertFalse("node" in done)
+        self.assertTrue(checkpoint.get_file_hash(nodeid, failing.written[0]))
+        checkpoint.close()
+
+        # resuming skips the nodes and files that were done
+        written = os.path.join(_datapath, "n7-copy", "node",
+                               failing.written[0])
+        inode = os.stat(written).st_ino
+        task = tasklib.Task()
+        watermark = sync.sync_tree(conn, conn2, watermarks, "n7", task=task,
+                                   workers=1, dest="n7-copy")
+        self.assertEqual(watermarks.get("n7", "n7-copy"), watermark)
+        self.assertEqual(watermarks.get("n7"), None)
+        self.assertEqual(
+            sorted(msg for kind, msg in task.get_messages()
+                   if kind == "detail"),
+            sorted(attr["title"] for attr in attrs
+                   if attr["title"] not in done))
+        self.assertEqual(os.stat(written).st_ino, inode)
+        for name in ["file1", "file2"]:
+            stream = conn2.open_file(nodeid, name)
+            self.assertEqual(stream.read(), "hello " + name)
+            stream.close()
+
+        # the checkpoint is removed once the sync is done
+        self.assertFalse(
+            watermarks.get_checkpoint("n7", "n7-copy").has_entries())
+        self.assertEqual(os.listdir(_datapath + "/n7-sync"),
+                         ["watermarks.json"])
+
+        conn2.close()
+        book.close()
+
+    def test_sync_parallel(self):
+
+        attrs = ([{"nodeid": "root", "parentids": []}] +
+                 [{"nodeid": x, "parentids": ["root"]} for x in "abcd"] +
+                 [{"nodeid": x + "1", "parentids": [x]} for x in "abcd"])
+        lock = threading.Lock()
+        done = []
+        running = [0, 0]
+
+        def func(attr):
+            with lock:
+                running[0] += 1
+                running[1] = max(running[1], running[0])
+            time.sleep(.05)
+            with lock:
+                running[0] -= 1
+                done.append(attr["nodeid"])
+
+        # nodes run in parallel after their parents
+        self.assertTrue(sync.sync_parallel(attrs, func, workers=4))
+        self.assertEqual(sorted(done), sorted(a["nodeid"] for a in attrs))
+        self.assertEqual(done[0], "root")
+        for x in "abcd":
+            self.assertTrue(done.index(x) < done.index(x + "1"))
+        self.assertTrue(running[1] > 1)
+
+        # errors are raised once the workers stop
+        def fail(attr):
+            if attr["nodeid"] == "b":
+                raise ValueError("failed")
+        self.assertRaises(ValueError, sync.sync_parallel, attrs, fail, 4)
+
+        # no nodes are started once the task is stopped
+        done = []
+        results = []
+
+        def stop(attr):
+            done.append(attr["nodeid"])
+            task.stop()
+        task = tasklib.Task(lambda task: results.append(
+            sync.sync_parallel(attrs, stop, 2, task)))
+        task.run()
+        task.join()
+        self.assertEqual(results, [False])
+        self.assertEqual(done, ["root"])
+
+    def test_byte_budget(self):
+
+        budget = sync.ByteBudget(100)
+        self.assertEqual(budget.acquire(60), 60)
+        acquired = []
+        thread = threading.Thread(
+            target=lambda: acquired.append(budget.acquire(60)))
+        thread.start()
+        time.sleep(.05)
+        self.assertEqual(acquired, [])
+        budget.release(60)
+        thread.join()
+        self.assertEqual(acquired, [60])
+
+        # files larger than the limit wait until they are alone
+        budget.release(60)
+        self.assertEqual(budget.acquire(500), 100)
+        self.assertEqual(budget.get_used(), 100)